@@ -0,0 +1,368 @@
+"""Local stand-in for the Intacct XML gateway.
+
+Implements the functions the target sends (getAPISession, query,
+readByQuery, get, create/update, create_supdoc/update_supdoc/delete_supdoc,
+create_supdocfolder, create_apadjustment, create_potransaction and
+update_potransaction) over an in-memory store, with injected latency and
+errors. Attachments are served with GET /attachments/<name>?size=<bytes>.
+"""
+
+import datetime as dt
+import itertools
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import xmltodict
+
+DATE_FORMAT = "%m/%d/%Y %H:%M:%S"
+# content of the attachments served, repeated to the requested size
+PATTERN = bytes(range(251))
+
+
+class GatewayState:
+    """Objects stored by the gateway, keyed by object name."""
+
+    def __init__(self):
+        self.tables = {}
+        self.supdocs = {}
+        self.folders = set()
+        self.lock = threading.Lock()
+        self.recordnos = itertools.count(100000)
+
+    def add(self, intacct_object, row):
+        row = dict(row)
+        row.setdefault("RECORDNO", str(next(self.recordnos)))
+        row.setdefault("WHENMODIFIED", dt.datetime.utcnow().strftime(DATE_FORMAT))
+        self.tables.setdefault(intacct_object, []).append(row)
+        return row
+
+    def find(self, intacct_object, field, value):
+        for row in self.tables.get(intacct_object, []):
+            if row.get(field) == value:
+                return row
+        return None
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def matches(row, filter):
+    """Return whether row matches an Intacct query filter."""
+    for operator, conditions in (filter or {}).items():
+        if operator in ("and", "or"):
+            results = [
+                matches(row, {inner: condition})
+                for inner, values in conditions.items()
+                for condition in as_list(values)
+            ]
+            if not (all(results) if operator == "and" else any(results)):
+                return False
+            continue
+        for condition in as_list(conditions):
+            value = row.get(condition["field"])
+            expected = condition.get("value")
+            if operator == "equalto" and value != expected:
+                return False
+            if operator == "notequalto" and value == expected:
+                return False
+            if operator == "in" and value not in as_list(expected):
+                return False
+            if operator == "notin" and value in as_list(expected):
+                return False
+            if operator in ("greaterthanorequalto", "lessthan"):
+                try:
+                    newer = dt.datetime.strptime(value, DATE_FORMAT) >= dt.datetime.strptime(expected, DATE_FORMAT)
+                except (TypeError, ValueError):
+                    newer = str(value) >= str(expected)
+                if newer != (operator == "greaterthanorequalto"):
+                    return False
+    return True
+
+
+def select(row, fields):
+    if not fields or fields == "*":
+        return dict(row)
+    return {field: row.get(field) for field in fields}
+
+
+def flatten(payload):
+    """Return the scalar fields of a create/update payload."""
+    return {key: value for key, value in payload.items() if not isinstance(value, (dict, list))}
+
+
+class MockGateway:
+    """Threaded HTTP server answering Intacct XML gateway requests.
+
+    latency is added to every request, plus latency_per_function for each
+    function in it and a uniform jitter. http_error_rate and throttle_rate
+    answer whole requests with 503 and 429, function_error_rate fails single
+    functions.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        latency_per_function=0.0,
+        jitter=0.0,
+        http_error_rate=0.0,
+        throttle_rate=0.0,
+        function_error_rate=0.0,
+        seed=0,
+    ):
+        self.latency = latency
+        self.latency_per_function = latency_per_function
+        self.jitter = jitter
+        self.http_error_rate = http_error_rate
+        self.throttle_rate = throttle_rate
+        self.function_error_rate = function_error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.state = GatewayState()
+        self.sessions = set()
+        self.stats_lock = threading.Lock()
+        self.requests = []
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/ia/xml/xmlgw.phtml"
+
+    def start(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # send each response in one write, without waiting on delayed acks
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                started = time.perf_counter()
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, response, functions = gateway.handle(body)
+                self.send(status, response, "application/xml")
+                gateway.record(started, status, functions, len(body))
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                size = int(parse_qs(url.query).get("size", ["1024"])[0])
+                self.send(200, (PATTERN * (size // len(PATTERN) + 1))[:size], "application/octet-stream")
+
+            def send(self, status, content, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def chance(self, rate):
+        with self.random_lock:
+            return rate > 0 and self.random.random() < rate
+
+    def record(self, started, status, functions, size):
+        with self.stats_lock:
+            self.requests.append({
+                "latency": time.perf_counter() - started,
+                "status": status,
+                "functions": functions,
+                "bytes": size,
+            })
+
+    def handle(self, body):
+        """Return the HTTP status, xml response and function names of a request."""
+        request = xmltodict.parse(body, dict_constructor=dict)["request"]
+        operation = request.get("operation") or {}
+        functions = as_list((operation.get("content") or {}).get("function"))
+        names = [next(key for key in function if not key.startswith("@")) for function in functions]
+
+        with self.random_lock:
+            jitter = self.random.uniform(0, self.jitter) if self.jitter else 0
+        time.sleep(self.latency + self.latency_per_function * len(functions) + jitter)
+
+        if self.chance(self.throttle_rate):
+            return 429, self.failure("XL03000009", "Rate limit exceeded"), names
+        if self.chance(self.http_error_rate):
+            return 503, self.failure("XL03000006", "Service unavailable"), names
+
+        authentication = operation.get("authentication") or {}
+        if "login" in authentication:
+            return 200, self.login(functions), names
+        if authentication.get("sessionid") not in self.sessions:
+            return 200, self.failure("XL03000006", "Invalid session"), names
+
+        results = []
+        for function, name in zip(functions, names):
+            controlid = function.get("@controlid")
+            try:
+                if self.chance(self.function_error_rate):
+                    raise ValueError("Injected function error")
+                with self.state.lock:
+                    result = getattr(self, f"do_{name}")(function[name])
+                result = {"status": "success", "function": name, "controlid": controlid, **result}
+            except Exception as e:
+                result = {
+                    "status": "failure",
+                    "function": name,
+                    "controlid": controlid,
+                    "errormessage": {"error": {"errorno": "BL01001973", "description2": str(e)}},
+                }
+            results.append(result)
+
+        return 200, self.render({
+            "control": {"status": "success"},
+            "operation": {
+                "authentication": {"status": "success"},
+                "result": results[0] if len(results) == 1 else results,
+            },
+        }), names
+
+    def render(self, response):
+        return xmltodict.unparse({"response": response}).encode("utf-8")
+
+    def failure(self, errorno, description):
+        return self.render({
+            "control": {"status": "failure"},
+            "errormessage": {"error": {"errorno": errorno, "description2": description}},
+        })
+
+    def login(self, functions):
+        with self.state.lock:
+            session_id = f"session-{len(self.sessions)}"
+            self.sessions.add(session_id)
+        timeout = dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=1)
+        return self.render({
+            "control": {"status": "success"},
+            "operation": {
+                "authentication": {"status": "success", "sessiontimeout": timeout.isoformat()},
+                "result": {
+                    "status": "success",
+                    "function": "getAPISession",
+                    "controlid": functions[0].get("@controlid") if functions else None,
+                    "data": {"api": {"sessionid": session_id, "endpoint": self.url}},
+                },
+            },
+        })
+
+    def do_query(self, query):
+        intacct_object = query["object"]
+        rows = self.state.tables.get(intacct_object, [])
+        if query.get("docparid"):
+            rows = [row for row in rows if row.get("DOCPARID", query["docparid"]) == query["docparid"]]
+        rows = [row for row in rows if matches(row, query.get("filter"))]
+        offset = int(query.get("offset") or 0)
+        page = rows[offset:offset + int(query.get("pagesize") or 100)]
+        fields = as_list((query.get("select") or {}).get("field"))
+        data = {
+            "@listtype": intacct_object,
+            "@count": str(len(page)),
+            "@totalcount": str(len(rows)),
+            "@numremaining": str(max(len(rows) - offset - len(page), 0)),
+            "@offset": str(offset),
+        }
+        if page:
+            data[intacct_object] = [select(row, fields) for row in page]
+        return {"data": data}
+
+    def do_readByQuery(self, query):
+        intacct_object = query["object"]
+        match = re.match(r"\s*(\w+)\s*(=|IN)\s*\(?([^)]*)\)?", query.get("query") or "", re.I)
+        rows = self.state.tables.get(intacct_object, [])
+        if match:
+            field, _, values = match.groups()
+            values = {value.strip(" '") for value in values.split(",")}
+            rows = [row for row in rows if str(row.get(field)) in values]
+        rows = rows[:int(query.get("pagesize") or 100)]
+        fields = [field.strip() for field in str(query.get("fields") or "*").split(",")]
+        for row in rows:
+            row.setdefault("RECORD_URL", f"https://intacct.example/{intacct_object}/{row['RECORDNO']}")
+        data = {"@listtype": intacct_object.lower(), "@count": str(len(rows)), "@totalcount": str(len(rows))}
+        if rows:
+            data[intacct_object.lower()] = [select(row, fields if fields != ["*"] else None) for row in rows]
+        return {"data": data}
+
+    def do_get(self, get):
+        intacct_object, key = get["@object"], get["@key"]
+        if intacct_object == "supdoc" and key in self.state.supdocs:
+            return {"data": {"supdoc": self.state.supdocs[key]}}
+        if intacct_object == "supdocfolder" and key in self.state.folders:
+            return {"data": {"supdocfolder": {"name": key}}}
+        return {"data": {"@listtype": intacct_object, "@count": "0"}}
+
+    def do_create(self, create):
+        results = {}
+        for intacct_object, payload in create.items():
+            row = self.state.add(intacct_object, flatten(payload))
+            results[intacct_object.lower()] = {"RECORDNO": row["RECORDNO"]}
+        return {"key": row["RECORDNO"], "data": results}
+
+    def do_update(self, update):
+        results = {}
+        for intacct_object, payload in update.items():
+            row = None
+            if payload.get("RECORDNO"):
+                row = self.state.find(intacct_object, "RECORDNO", payload["RECORDNO"])
+            elif intacct_object == "VENDOR":
+                row = self.state.find(intacct_object, "VENDORID", payload.get("VENDORID"))
+            if row is None:
+                raise ValueError(f"{intacct_object} to update was not found")
+            row.update(flatten(payload))
+            row["WHENMODIFIED"] = dt.datetime.utcnow().strftime(DATE_FORMAT)
+            results[intacct_object.lower()] = {"RECORDNO": row["RECORDNO"]}
+        return {"key": row["RECORDNO"], "data": results}
+
+    def do_create_apadjustment(self, payload):
+        return {"key": self.state.add("APADJUSTMENT", flatten(payload))["RECORDNO"]}
+
+    def do_create_potransaction(self, payload):
+        docno = str(len(self.state.tables.get("PODOCUMENT", [])) + 1)
+        row = self.state.add("PODOCUMENT", {**flatten(payload), "DOCNO": docno, "DOCPARID": "Purchase Order"})
+        return {"key": f"Purchase Order-{row['DOCNO']}"}
+
+    def do_update_potransaction(self, payload):
+        docno = payload["@key"].split("-", 1)[1]
+        if not self.state.find("PODOCUMENT", "DOCNO", docno):
+            raise ValueError(f"Purchase Order-{docno} was not found")
+        return {"key": payload["@key"]}
+
+    def do_create_supdocfolder(self, payload):
+        self.state.folders.add(payload["supdocfoldername"])
+        return {"key": payload["supdocfoldername"]}
+
+    def do_create_supdoc(self, payload):
+        self.state.supdocs[payload["supdocid"]] = {
+            "supdocid": payload["supdocid"],
+            "attachments": payload.get("attachments") or {},
+        }
+        return {"key": payload["supdocid"]}
+
+    def do_update_supdoc(self, payload):
+        supdoc = self.state.supdocs.setdefault(payload["supdocid"], {"supdocid": payload["supdocid"], "attachments": {}})
+        existing = as_list((supdoc.get("attachments") or {}).get("attachment"))
+        added = as_list((payload.get("attachments") or {}).get("attachment"))
+        supdoc["attachments"] = {"attachment": existing + added}
+        return {"key": payload["supdocid"]}
+
+    def do_delete_supdoc(self, payload):
+        self.state.supdocs.pop(payload["@key"], None)
+        return {"key": payload["@key"]}
@@ -0,0 +1,177 @@
+"""Run the target against the local gateway and report its throughput.
+
+Each stream runs in its own target process against a fresh gateway:
+
+    python -m benchmarks.run --streams Bills JournalEntries --records 500 \\
+        --latency 0.05 --config '{"batch_size": 20, "max_workers": 4}'
+
+Reports records/sec, gateway requests per record, p50/p99 request latency
+as measured by the gateway, and the peak RSS of the target process.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.gateway import MockGateway
+from benchmarks.streams import STREAMS, seed_reference_data, singer_messages
+
+TARGET = "from target_intacct_v3.target import TargetIntacctV3; TargetIntacctV3.cli()"
+
+COLUMNS = [
+    ("stream", "{}"),
+    ("records", "{}"),
+    ("success", "{}"),
+    ("updated", "{}"),
+    ("fail", "{}"),
+    ("seconds", "{:.2f}"),
+    ("records_per_sec", "{:.1f}"),
+    ("requests", "{}"),
+    ("requests_per_record", "{:.2f}"),
+    ("p50_ms", "{:.1f}"),
+    ("p99_ms", "{:.1f}"),
+    ("peak_rss_mb", "{:.1f}"),
+]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))]
+
+
+def wait(process):
+    """Wait for process, returning its exit code and peak RSS in MB."""
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return process.returncode, peak_rss
+
+
+def run_stream(stream, args, target_config):
+    gateway = MockGateway(
+        latency=args.latency,
+        latency_per_function=args.latency_per_function,
+        jitter=args.jitter,
+        http_error_rate=args.http_error_rate,
+        throttle_rate=args.throttle_rate,
+        function_error_rate=args.function_error_rate,
+        seed=args.seed,
+    ).start()
+    seed_reference_data(gateway.state)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            config = {
+                "company_id": "benchmark",
+                "sender_id": "sender",
+                "sender_password": "password",
+                "user_id": "user",
+                "user_password": "password",
+                "input_path": str(tmp),
+                "base_url": gateway.url,
+                **target_config,
+            }
+            (tmp / "config.json").write_text(json.dumps(config))
+            messages = singer_messages(
+                stream,
+                args.records,
+                seed=args.seed,
+                lines=args.lines,
+                attachments=args.attachments,
+                attachment_size=args.attachment_size,
+                gateway_url=gateway.url,
+            )
+            with open(tmp / "input.jsonl", "w") as input_file:
+                for message in messages:
+                    input_file.write(json.dumps(message) + "\n")
+
+            with open(tmp / "input.jsonl") as stdin, open(tmp / "output.jsonl", "w") as stdout, open(tmp / "target.log", "w") as stderr:
+                started = time.perf_counter()
+                process = subprocess.Popen(
+                    [sys.executable, "-c", TARGET, "--config", str(tmp / "config.json")],
+                    stdin=stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                )
+                exit_code, peak_rss = wait(process)
+                seconds = time.perf_counter() - started
+
+            lines = (tmp / "output.jsonl").read_text().strip().splitlines()
+            state = json.loads(lines[-1]) if lines else {}
+            summary = state.get("summary", {}).get(stream, {})
+            if exit_code:
+                log = (tmp / "target.log").read_text().strip().splitlines()
+                print(f"{stream}: target exited with {exit_code}", *log[-20:], sep="\n", file=sys.stderr)
+    finally:
+        gateway.stop()
+
+    latencies = [request["latency"] * 1000 for request in gateway.requests]
+    return {
+        "stream": stream,
+        "records": args.records,
+        "success": summary.get("success", 0),
+        "updated": summary.get("updated", 0),
+        "fail": summary.get("fail", 0),
+        "exit_code": exit_code,
+        "seconds": seconds,
+        "records_per_sec": args.records / seconds if seconds else 0.0,
+        "requests": len(gateway.requests),
+        "requests_per_record": len(gateway.requests) / args.records if args.records else 0.0,
+        "functions": sum(len(request["functions"]) for request in gateway.requests),
+        "http_errors": sum(1 for request in gateway.requests if request["status"] != 200),
+        "p50_ms": percentile(latencies, 0.50),
+        "p99_ms": percentile(latencies, 0.99),
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def print_report(results):
+    rows = [[name for name, _ in COLUMNS]]
+    for result in results:
+        rows.append([fmt.format(result[name]) for name, fmt in COLUMNS])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(COLUMNS))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", nargs="+", choices=list(STREAMS), default=list(STREAMS))
+    parser.add_argument("--records", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=5, help="line items per record")
+    parser.add_argument("--attachments", type=int, default=0, help="attachments per bill")
+    parser.add_argument("--attachment-size", type=int, default=50000, help="bytes per attachment")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--latency-per-function", type=float, default=0.0, help="seconds added per function in a request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many seconds added at random")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--function-error-rate", type=float, default=0.0, help="share of functions that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", default="{}", help="target config as json, or the path of a json file")
+    parser.add_argument("--output", help="write the results as json to this path")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = args.config
+    target_config = json.loads(Path(config).read_text() if os.path.isfile(config) else config)
+
+    results = [run_stream(stream, args, target_config) for stream in args.streams]
+    print_report(results)
+    if args.output:
+        Path(args.output).write_text(json.dumps({"args": vars(args), "results": results}, indent=2))
+    return 1 if any(result["exit_code"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""Canned reference data and Singer input streams for the benchmarks.
+
+Everything is generated from a seed, so runs with the same arguments send
+the same records to the same gateway state.
+"""
+
+import json
+import random
+
+REFERENCE_SIZE = 200
+
+
+def seed_reference_data(state, size=REFERENCE_SIZE):
+    """Fill the gateway with the reference objects the sinks look up."""
+    for i in range(size):
+        state.add("VENDOR", {"RECORDNO": str(i + 1), "VENDORID": f"V{i:04}", "NAME": f"Vendor {i}"})
+        state.add("GLACCOUNT", {"RECORDNO": str(i + 1), "ACCOUNTNO": f"{6000 + i}", "TITLE": f"Account {i}"})
+        state.add("LOCATION", {"RECORDNO": str(i + 1), "LOCATIONID": f"L{i}", "NAME": f"Location {i}", "STATUS": "active"})
+        state.add("CLASS", {"RECORDNO": str(i + 1), "CLASSID": f"C{i}", "NAME": f"Class {i}"})
+        state.add("DEPARTMENT", {"RECORDNO": str(i + 1), "DEPARTMENTID": f"D{i}", "TITLE": f"Department {i}"})
+        state.add("PROJECT", {"RECORDNO": str(i + 1), "PROJECTID": f"P{i}", "NAME": f"Project {i}"})
+        state.add("CUSTOMER", {"RECORDNO": str(i + 1), "CUSTOMERID": f"CU{i}", "NAME": f"Customer {i}"})
+        state.add("ITEM", {"RECORDNO": str(i + 1), "ITEMID": f"I{i}", "NAME": f"Item {i}"})
+        state.add("EMPLOYEE", {"RECORDNO": str(i + 1), "EMPLOYEEID": f"E{i}"})
+    for i in range(size):
+        # bills to pay in BillPayment and to update in Bills/PurchaseInvoices
+        state.add("APBILL", {
+            "RECORDNO": str(50000 + i),
+            "RECORDID": f"INV-{i:06}",
+            "VENDORID": f"V{i % size:04}",
+            "VENDORNAME": f"Vendor {i % size}",
+            "DOCNUMBER": f"DOC-{i}",
+            "CURRENCY": "USD",
+            "TRX_TOTALDUE": "100.00",
+            "STATE": "Posted",
+        })
+
+
+def line_items(rng, lines, size=REFERENCE_SIZE):
+    return [
+        {
+            "accountNumber": f"{6000 + rng.randrange(size)}",
+            "accountId": str(rng.randrange(size) + 1) if rng.random() < 0.3 else None,
+            "employeeId": str(rng.randrange(size) + 1) if rng.random() < 0.3 else None,
+            "amount": round(rng.uniform(1, 1000), 2),
+            "description": f"Line {n}",
+            "className": f"Class {rng.randrange(size)}",
+            "department": f"Department {rng.randrange(size)}",
+            "location": f"Location {rng.randrange(size)}",
+        }
+        for n in range(lines)
+    ]
+
+
+def attachments(rng, count, size, gateway_url):
+    base = gateway_url.rsplit("/ia/", 1)[0]
+    return [
+        {"name": f"receipt-{rng.randrange(10 ** 6)}.pdf", "url": f"{base}/attachments/receipt?size={size}"}
+        for _ in range(count)
+    ]
+
+
+def suppliers(rng, i, options):
+    return {
+        "vendorNumber": f"NEW{i:05}" if i % 2 else f"V{i % REFERENCE_SIZE:04}",
+        "vendorName": f"Supplier {i}",
+        "currency": "USD",
+        "addresses": json.dumps([{"line1": f"{i} Main St", "city": "Springfield", "postalCode": "12345", "country": "US"}]),
+        "phoneNumbers": json.dumps([{"number": "555-0100"}]),
+    }
+
+
+def ap_adjustments(rng, i, options):
+    return {
+        "vendorId": f"V{rng.randrange(REFERENCE_SIZE):04}",
+        "transactionDate": "2024-03-15",
+        "adjustmentNumber": f"ADJ-{i}",
+        "description": "Benchmark adjustment",
+        "currency": "USD",
+        "lineItems": json.dumps([
+            {"accountNumber": f"{6000 + rng.randrange(REFERENCE_SIZE)}", "amount": 10, "className": f"Class {rng.randrange(REFERENCE_SIZE)}"}
+            for _ in range(options["lines"])
+        ]),
+    }
+
+
+def journal_entries(rng, i, options):
+    lines = []
+    for n in range(options["lines"]):
+        lines.append({
+            "accountNumber": f"{6000 + rng.randrange(REFERENCE_SIZE)}",
+            "amount": 25,
+            "postingType": "debit" if n % 2 == 0 else "credit",
+            "description": f"Entry {i}/{n}",
+            "departmentName": f"Department {rng.randrange(REFERENCE_SIZE)}",
+            "locationName": f"Location {rng.randrange(REFERENCE_SIZE)}",
+            "className": f"Class {rng.randrange(REFERENCE_SIZE)}",
+            "customerName": f"Customer {rng.randrange(REFERENCE_SIZE)}",
+        })
+    return {"type": "GJ", "transactionDate": "2024-03-15T00:00:00Z", "lines": json.dumps(lines)}
+
+
+def bills(rng, i, options):
+    # every fourth bill already exists and is updated
+    invoice = f"INV-{i:06}" if i % 4 == 0 and i < REFERENCE_SIZE else f"BENCH-{i:06}"
+    return {
+        "invoiceNumber": invoice,
+        "vendorName": f"Vendor {i % REFERENCE_SIZE}",
+        "issueDate": "2024-03-15",
+        "dueDate": "2024-04-15",
+        "createdAt": "2024-03-15T00:00:00Z",
+        "currency": "USD",
+        "location": f"Location {rng.randrange(REFERENCE_SIZE)}",
+        "lineItems": json.dumps(line_items(rng, options["lines"])),
+        "attachments": json.dumps(attachments(rng, options["attachments"], options["attachment_size"], options["gateway_url"])),
+    }
+
+
+def purchase_invoices(rng, i, options):
+    invoice = f"INV-{i:06}" if i % 4 == 0 and i < REFERENCE_SIZE else f"BENCH-{i:06}"
+    return {
+        "invoiceNumber": invoice,
+        "supplierName": f"Vendor {i % REFERENCE_SIZE}",
+        "issueDate": "2024-03-15",
+        "dueDate": "2024-04-15",
+        "createdAt": "2024-03-15T00:00:00Z",
+        "currency": "USD",
+        "location": f"Location {rng.randrange(REFERENCE_SIZE)}",
+        "lineItems": json.dumps(line_items(rng, options["lines"])),
+        "attachments": json.dumps(attachments(rng, options["attachments"], options["attachment_size"], options["gateway_url"])),
+    }
+
+
+def bill_payments(rng, i, options):
+    return {
+        "billId": str(50000 + i % REFERENCE_SIZE),
+        "paymentDate": "03/20/2024",
+        "bankAccountName": "Checking",
+        "paymentMethod": "Cash",
+        "amount": 100,
+    }
+
+
+def purchase_orders(rng, i, options):
+    return {
+        "transactionDate": "2024-03-15",
+        "vendorName": f"Vendor {rng.randrange(REFERENCE_SIZE)}",
+        "number": f"PO-{i}",
+        "currency": "USD",
+        "lineItems": [
+            {"productId": f"I{rng.randrange(REFERENCE_SIZE)}", "quantity": 2, "unitPrice": 5, "className": f"Class {rng.randrange(REFERENCE_SIZE)}"}
+            for _ in range(options["lines"])
+        ],
+    }
+
+
+# stream name -> record generator, one per sink in sinks.py
+STREAMS = {
+    "Suppliers": suppliers,
+    "APAdjustment": ap_adjustments,
+    "JournalEntries": journal_entries,
+    "Bills": bills,
+    "PurchaseInvoices": purchase_invoices,
+    "BillPayment": bill_payments,
+    "PurchaseOrders": purchase_orders,
+}
+
+
+def json_schema(value):
+    if isinstance(value, bool):
+        return {"type": ["boolean", "null"]}
+    if isinstance(value, int):
+        return {"type": ["integer", "null"]}
+    if isinstance(value, float):
+        return {"type": ["number", "null"]}
+    if isinstance(value, list):
+        return {"type": ["array", "null"], "items": json_schema(value[0]) if value else {}}
+    if isinstance(value, dict):
+        return {"type": ["object", "null"], "properties": {k: json_schema(v) for k, v in value.items()}}
+    return {"type": ["string", "null"]}
+
+
+def singer_messages(stream, records, seed=0, **options):
+    """Yield the SCHEMA and RECORD messages of a canned stream."""
+    options = {"lines": 5, "attachments": 0, "attachment_size": 50000, "gateway_url": "", **options}
+    rng = random.Random(seed)
+    generate = STREAMS[stream]
+    rows = [generate(rng, i, options) for i in range(records)]
+    properties = {}
+    for row in rows:
+        for key, value in row.items():
+            if value is not None and key not in properties:
+                properties[key] = json_schema(value)
+    yield {"type": "SCHEMA", "stream": stream, "schema": {"type": "object", "properties": properties}, "key_properties": []}
+    for row in rows:
+        yield {"type": "RECORD", "stream": stream, "record": row}
@@ -1,7 +1,12 @@
 import base64
+import hashlib
+import logging
+import os
 import datetime as dt
-import json
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import backoff
@@ -11,12 +16,27 @@ from pendulum import parse
 from singer_sdk.exceptions import FatalAPIError, RetriableAPIError
 from target_hotglue.client import HotglueSink
 
-from target_intacct_v3.util import dictify, parse_objs
+from target_intacct_v3.serializer import RequestEnvelope, unparse
+from target_intacct_v3.util import (
+    REFERENCE_CACHE_VERSION,
+    ControlIdRegistry,
+    LRUCache,
+    ReferenceIndex,
+    encode_base64,
+    get_retry_after,
+    iter_path_values,
+    parse_intacct_datetime,
+    parse_objs,
+    read_reference_cache,
+    summarize,
+    write_reference_cache,
+)
 
 
 class IntacctSink(HotglueSink):
-    base_url = "https://api.intacct.com/ia/xml/xmlgw.phtml"
     endpoint = ""
+    # functions that only read, a request of these alone is sent again after a read timeout
+    read_functions = {"query", "readByQuery", "readMore", "read", "get", "get_list"}
     vendors = None
     vendors_recordno = None
     vendors_by_id = None
@@ -26,9 +46,113 @@ class IntacctSink(HotglueSink):
     classes = None
     departments = None
     departments_recordno = None
+    customers = None
     items = None
-    previous_stream = None
-    controlid_list = []
+    # reference objects loaded into the maps above: map name -> (key field, value field)
+    reference_objects = {
+        "VENDOR": {
+            "fields": ["VENDORID", "NAME", "RECORDNO"],
+            "maps": {
+                "vendors": ("NAME", "VENDORID"),
+                "vendors_recordno": ("RECORDNO", "VENDORID"),
+                "vendors_by_id": ("VENDORID", "NAME"),
+            },
+        },
+        "GLACCOUNT": {
+            "fields": ["RECORDNO", "ACCOUNTNO", "TITLE"],
+            "maps": {"accounts": ("TITLE", "ACCOUNTNO")},
+        },
+        "PROJECT": {
+            "fields": ["PROJECTID", "NAME"],
+            "maps": {"projects": ("NAME", "PROJECTID")},
+        },
+        "LOCATION": {
+            "fields": ["LOCATIONID", "NAME", "STATUS"],
+            "maps": {"locations": ("NAME", "LOCATIONID")},
+            "active_only": True,
+        },
+        "CLASS": {
+            "fields": ["CLASSID", "NAME"],
+            "maps": {"classes": ("NAME", "CLASSID")},
+        },
+        "DEPARTMENT": {
+            "fields": ["DEPARTMENTID", "TITLE", "RECORDNO"],
+            "maps": {
+                "departments": ("TITLE", "DEPARTMENTID"),
+                "departments_recordno": ("RECORDNO", "DEPARTMENTID"),
+            },
+        },
+        "CUSTOMER": {
+            "fields": ["CUSTOMERID", "NAME"],
+            "maps": {"customers": ("NAME", "CUSTOMERID")},
+        },
+        "ITEM": {
+            "fields": ["ITEMID", "NAME"],
+            "maps": {"items": ("NAME", "ITEMID")},
+        },
+    }
+    reference_map_objects = {
+        name: intacct_object
+        for intacct_object, reference in reference_objects.items()
+        for name in reference["maps"]
+    }
+    # each object is loaded once, different objects concurrently
+    reference_load_locks = {intacct_object: threading.Lock() for intacct_object in reference_objects}
+    # record fields a sink looks up in the reference objects: object -> field -> paths,
+    # "lineItems.className" reads className in each of the lineItems
+    reference_fields = {}
+    # point lookups by RECORDNO: cache name -> (object, field)
+    point_lookups = {
+        "account_nos": ("GLACCOUNT", "ACCOUNTNO"),
+        "employee_ids": ("EMPLOYEE", "EMPLOYEEID"),
+    }
+    point_lookup_caches = {}
+    reference_synced_at = {}
+    reference_misses = set()
+    # when each object was last refreshed, see refresh_reference
+    reference_refreshed_at = {}
+    reference_refresh_locks = {intacct_object: threading.Lock() for intacct_object in reference_objects}
+    # objects loaded only for the values records need: object -> (field, value) pairs queried
+    reference_targeted = {}
+    # queries left before loading a targeted object whole is cheaper, in auto mode
+    reference_targeted_budget = {}
+    # class level lookup state besides the maps, kept between warm real-time runs
+    reference_state_names = (
+        "reference_synced_at",
+        "reference_misses",
+        "reference_refreshed_at",
+        "reference_targeted",
+        "reference_targeted_budget",
+        "point_lookup_caches",
+    )
+    # control ids of the most recent requests, to catch an id sent twice
+    controlids = ControlIdRegistry(100000)
+    # guard the class level state shared by sinks writing concurrently
+    session_lock = threading.Lock()
+    reference_lock = threading.RLock()
+    # seconds before expiry at which a session is refreshed
+    session_refresh_margin = 120
+    # sinks whose writes are a single function can be sent in multi-function requests
+    batchable = True
+    # keys per `in` filter when prefetching a batch
+    prefetch_chunk_size = 100
+    # bytes read from an attachment at a time, a multiple of 3 so each chunk base64-encodes on its own
+    attachment_chunk_size = 3 * 64 * 1024
+
+    def __init__(self, target, stream_name, schema, key_properties) -> None:
+        super().__init__(target, stream_name, schema, key_properties)
+        self.pending_records = []
+        self.existing_bills = {}
+        self.existing_bills_by_recordno = {}
+        # record urls to resolve once the batch being written is done
+        self.pending_record_urls = None
+        # record urls of records written one by one, resolved a chunk at a time
+        # or when the sink is drained, before its state is written
+        self.deferred_record_urls = []
+
+    @property
+    def base_url(self) -> str:
+        return self.config.get("base_url") or "https://api.intacct.com/ia/xml/xmlgw.phtml"
 
     @property
     def http_headers(self) -> dict:
@@ -36,14 +160,20 @@ class IntacctSink(HotglueSink):
         headers = {"content-type": "application/xml"}
         return headers
     
-    @classmethod
-    def register_controlid(cls, controlid):
-        cls.controlid_list.append(controlid)
+    def get_controlid(self, *request_xml) -> str:
+        """Return the control id of a request, a digest of its xml without the control id.
+
+        A random nonce is digested too, so each send of the same xml, like a
+        refresh or a retried write, gets its own id. Raises if an id repeats.
+        """
+        digest = hashlib.blake2b(uuid.uuid4().bytes, digest_size=16)
+        for xml in request_xml:
+            digest.update(xml)
+        controlid = digest.hexdigest()
+        if not IntacctSink.controlids.register(controlid):
+            raise Exception(f"Request body duplicity identified: {b''.join(request_xml).decode('utf-8')}")
+        return controlid
 
-    @classmethod
-    def check_request_body_duplicity(cls, controlid):
-        return controlid in cls.controlid_list
-    
     def get_request_body(self, sender_id, sender_password, login_payload = {}, content = {}, operation = None):
         request_body = {
                 "request": {
@@ -69,55 +199,74 @@ class IntacctSink(HotglueSink):
                     }
         elif operation == "send_content":
             request_body["request"]["operation"] = {
-                    "authentication": {"sessionid": self._target.session_id},
+                    "authentication": {"sessionid": self.session_id},
                     "content": content,
                 }
         else:
             raise Exception(f"Invalid operation given when requesting the request body: {operation}")
         
-        controlid = hash(str(request_body))
-        if self.check_request_body_duplicity(controlid):
-            raise Exception(f"Request body duplicity identified: {request_body}")
-        
-        request_body["request"]["control"]["controlid"] = controlid
-        self.register_controlid(controlid)
+        request_body["request"]["control"]["controlid"] = self.get_controlid(unparse(request_body))
 
         return request_body
 
-    def login(self):
+    def get_login_payload(self) -> dict:
         user_id = self.config.get("user_id")
         company_id = self.config.get("company_id")
         user_password = self.config.get("user_password")
         location_id = self.config.get("location_id")
-        sender_id = self.config.get("sender_id")
-        sender_password = self.config.get("sender_password")
         login_payload = {
             "userid": user_id,
             "companyid": company_id,
             "password": user_password,
         }
 
-        # register current stream
-        IntacctSink.previous_stream = self.name
-
         if (
             self.config.get("use_locations")
             and location_id
             and self.name not in ["Suppliers"]
         ):
             login_payload["locationid"] = location_id
+        return login_payload
+
+    @property
+    def session_key(self) -> tuple:
+        """Return the key of the session this sink uses, shared by sinks with the same login."""
+        login_payload = self.get_login_payload()
+        return (
+            login_payload["companyid"],
+            login_payload["userid"],
+            login_payload.get("locationid"),
+        )
+
+    @property
+    def session_id(self):
+        session = self._target.sessions.get(self.session_key) or {}
+        return session.get("session_id")
+
+    def login(self):
+        sender_id = self.config.get("sender_id")
+        sender_password = self.config.get("sender_password")
+        login_payload = self.get_login_payload()
 
         request_body = self.get_request_body(sender_id, sender_password, login_payload= login_payload, operation='login')
 
-        xml_request_body = xmltodict.unparse(request_body).encode("utf-8")
+        xml_request_body = unparse(request_body)
+        self.count_metric("login_count")
         try:
-            response = requests.post(self.base_url, headers=self.http_headers, data=xml_request_body)
-            self.validate_response(response)
-            res_json = self.parse_response(response)["response"]["operation"]
+            with self.stage_timer("login"):
+                response = self.send_request(
+                    "POST", self.base_url, headers=self.http_headers, data=xml_request_body
+                )
+            res_json = self.validate_response(response)["response"]["operation"]
             if res_json["authentication"]["status"] == "success":
                 session_details = res_json["result"]["data"]["api"]
-                self._target.session_id = session_details["sessionid"]
-                self._target.session_timeout = self._get_session_timeout(res_json)
+                self._target.sessions[self.session_key] = {
+                    "session_id": session_details["sessionid"],
+                    "session_timeout": self._get_session_timeout(res_json),
+                    "envelope": RequestEnvelope(
+                        sender_id, sender_password, session_details["sessionid"]
+                    ),
+                }
 
         except requests.RequestException as e:
             raise FatalAPIError(f"Login request failed: {e.__repr__()}")
@@ -132,32 +281,50 @@ class IntacctSink(HotglueSink):
             return dt.datetime.now(dt.timezone.utc) + dt.timedelta(hours=1)
 
     def parse_response(self, response):
-        parsed_xml = xmltodict.parse(response.text)
-        parsed_response = json.loads(json.dumps(parsed_xml))
-        return parsed_response
+        # plain dicts straight from the parser, from the raw bytes so the
+        # xml declaration decides the encoding
+        with self.stage_timer("parse"):
+            return xmltodict.parse(response.content, dict_constructor=dict)
 
     def is_session_valid(self):
         now = round(dt.datetime.now(dt.timezone.utc).timestamp())
-        session_timeout = self._target.session_timeout
-        if not self._target.session_id:
+        session = self._target.sessions.get(self.session_key)
+        if not session or not session["session_id"]:
             return False
-        if self.name != IntacctSink.previous_stream:
-            return False
-        if session_timeout is not None:
-            session_timeout = session_timeout.timestamp()
-        return not ((session_timeout - now) < 120)
+        session_timeout = session["session_timeout"].timestamp()
+        # refresh the session ahead of its expiry
+        return not ((session_timeout - now) < self.session_refresh_margin)
 
     def format_payload(self, payload):
         content = {"function": {"@controlid": str(uuid.uuid4())}}
         content["function"].update(payload)
+        for function in payload:
+            self.count_metric("function_count", function=function)
+        return self.serialize_content(content)
+
+    def format_batch_payload(self, functions):
+        """Wrap each payload in its own function, keyed by the given controlid."""
+        content = {"function": []}
+        for controlid, payload in functions.items():
+            function = {"@controlid": controlid}
+            function.update(payload)
+            content["function"].append(function)
+            for name in payload:
+                self.count_metric("function_count", function=name)
+        return self.serialize_content(content)
 
-        dict_body = self.get_request_body(self.config.get("sender_id"),self.config.get("sender_password"), content= content, operation='send_content')
-        # transform payload to xml
-        body = xmltodict.unparse(dict_body).encode("utf-8")
-        return body
+    def serialize_content(self, content):
+        """Return the xml request for content in the envelope of the current session."""
+        with self.stage_timer("serialize"):
+            envelope = self._target.sessions[self.session_key]["envelope"]
+            content_xml = envelope.render_content(content)
+            # the envelope middle holds the session id
+            controlid = self.get_controlid(envelope.middle, content_xml)
+            return envelope.render(controlid, content_xml)
 
     def request_api(
-        self, http_method, endpoint=None, params=None, request_data=None, headers=None
+        self, http_method, endpoint=None, params=None, request_data=None, headers=None,
+        log_payload=True,
     ):
         """Request records from REST endpoint(s), returning response records."""
         # check if session is still valid before sending any request
@@ -166,16 +333,52 @@ class IntacctSink(HotglueSink):
         if headers is None:
             headers = {}
 
-        if not self.is_session_valid():
-            self.login()
+        with IntacctSink.session_lock:
+            if not self.is_session_valid():
+                self.login()
+        read_only = set(request_data) <= self.read_functions
         # wrap and format payload
         request_data = self.format_payload(request_data)
         # send request
-        resp = self._request(http_method, endpoint, params, request_data, headers)
+        resp = self._request(
+            http_method, endpoint, params, request_data, headers, log_payload=log_payload,
+            read_only=read_only,
+        )
         return resp
 
-    def validate_response(self, response) -> None:
-        """Validate HTTP response."""
+    def request_api_batch(
+        self, http_method, functions, endpoint=None, params=None, headers=None,
+        log_payload=True,
+    ):
+        """Send several functions in one request, returning their results by the keys of functions.
+
+        Each function is sent with its own uuid controlid, so sending the same
+        functions again makes a different request.
+        """
+        if params is None:
+            params = {}
+        if headers is None:
+            headers = {}
+
+        with IntacctSink.session_lock:
+            if not self.is_session_valid():
+                self.login()
+        read_only = all(set(payload) <= self.read_functions for payload in functions.values())
+        keys = {str(uuid.uuid4()): key for key in functions}
+        request_data = self.format_batch_payload(
+            {controlid: functions[key] for controlid, key in keys.items()}
+        )
+        results = self._request(
+            http_method, endpoint, params, request_data, headers, log_payload=log_payload,
+            read_only=read_only,
+        )
+        # a single function result is returned as a dict instead of a list
+        if isinstance(results, dict):
+            results = [results]
+        return {keys.get(result.get("controlid")): result for result in results}
+
+    def validate_response(self, response) -> dict:
+        """Validate HTTP response and return it parsed."""
         try:
             # Parse response
             parsed_response = self.parse_response(response)
@@ -184,6 +387,9 @@ class IntacctSink(HotglueSink):
 
             # Check if status exists
             operation_result = result.get("operation", {}).get("result", {})
+            if isinstance(operation_result, list):
+                # multi-function request, each result status is checked by the caller
+                return parsed_response
             status = operation_result.get("status", "")
             if status != "success":
                 # Extract error message
@@ -197,20 +403,26 @@ class IntacctSink(HotglueSink):
                     raise RetriableAPIError(error)
                 else:
                     raise FatalAPIError(error)
+            return parsed_response
 
         except (KeyError, ValueError, TypeError) as e:
             raise FatalAPIError(f"Failed to parse response: {e.__repr__()}")
 
     @backoff.on_exception(
         backoff.expo,
-        (RetriableAPIError, requests.exceptions.ReadTimeout),
+        (RetriableAPIError, requests.exceptions.Timeout),
         max_tries=5,
         factor=2,
     )
     def _request(
-        self, http_method, endpoint, params=None, request_data=None, headers=None
+        self, http_method, endpoint, params=None, request_data=None, headers=None,
+        log_payload=True, read_only=False,
     ) -> requests.PreparedRequest:
-        """Prepare a request object."""
+        """Prepare a request object.
+
+        A connect timeout is retried, and so is a read timeout of a read_only request.
+        The read timeout of a write is fatal, as Intacct may have applied it.
+        """
         if params is None:
             params = {}
         if headers is None:
@@ -220,26 +432,25 @@ class IntacctSink(HotglueSink):
         headers.update(self.default_headers)
         params.update(self.params)
 
-        if "attachmentdata" not in str(request_data):
-            self.logger.info(f"Making request to {url} with payload: {request_data}")
+        # attachment payloads are not logged at all
+        if log_payload:
+            self.log_payload(f"Making request to {url} with payload", request_data)
 
         try:
-            response = requests.request(
-                method=http_method,
-                url=url,
-                params=params,
-                headers=headers,
-                data=request_data,
+            response = self.send_request(
+                http_method, url, params=params, headers=headers, data=request_data
             )
-            self.validate_response(response)
-            # parse response
-            parsed_response = self.parse_response(response)
-
-            # validate response
+            parsed_response = self.validate_response(response)
             result = parsed_response["response"]["operation"]["result"]
-            self.logger.info(f"Succesful request to {url} with response: {result}")
+            self.log_payload(f"Succesful request to {url} with response", result)
             return result
-        
+
+        except requests.exceptions.Timeout as e:
+            if read_only or isinstance(e, requests.exceptions.ConnectTimeout):
+                self.logger.warning(f"Request to {url} timed out: {e.__repr__()}")
+                raise
+            self.logger.error(f"Request to {url} timed out: {e.__repr__()}")
+            raise FatalAPIError(f"HTTP request timed out: {e.__repr__()}")
         except requests.RequestException as e:
             self.logger.error(f"Request to {url} failed: {e.__repr__()}")
             raise FatalAPIError(f"HTTP request failed: {e.__repr__()}")
@@ -247,144 +458,573 @@ class IntacctSink(HotglueSink):
             self.logger.error(f"Failed to parse response from {url}: {e.__repr__()}")
             raise FatalAPIError(f"Malformed response: {e.__repr__()}")
 
-    def get_records(self, intacct_object, fields, filter=None, docparid=None):
+    def stage_timer(self, stage):
+        """Time a stage of this stream, see RunMetrics."""
+        return self._target.metrics.timer(self.name, stage)
+
+    def count_metric(self, metric, **tags) -> None:
+        self._target.metrics.count(self.name, metric, **tags)
+
+    def send_request(self, http_method, url, **kwargs) -> requests.Response:
+        """Send an http request once the company's scheduler allows it."""
+        scheduler = self._target.get_scheduler()
+        with self.stage_timer("throttle"):
+            granted = scheduler.acquire()
+        response = None
+        started = time.perf_counter()
+        try:
+            response = self._target.http_session.request(
+                http_method, url, timeout=self._target.request_timeout, **kwargs
+            )
+            return response
+        finally:
+            seconds = time.perf_counter() - started
+            self.record_request(url, seconds, response)
+            status_code = response.status_code if response is not None else None
+            if scheduler.release(granted, status_code, seconds, get_retry_after(response)):
+                self.count_metric("concurrency_decrease")
+                self.logger.warning(
+                    f"Lowered the request concurrency to {int(scheduler.limit)} after a "
+                    f"{status_code or 'failed'} response in {seconds:.1f}s"
+                )
+
+    def record_request(self, url, seconds, response) -> None:
+        """Count and time one http request, whether it succeeded or not."""
+        status_code = response.status_code if response is not None else None
+        succeeded = status_code is not None and status_code < 400
+        self._target.metrics.add_time(self.name, "network", seconds)
+        self.count_metric("http_request_count", http_status_code=status_code)
+        if self._target.metrics.enabled:
+            self._target.metrics.emit("timer", "http_request_duration", round(seconds, 6), {
+                "stream": self.name,
+                "endpoint": url,
+                "http_status_code": status_code,
+                "status": "succeeded" if succeeded else "failed",
+            })
+
+    @property
+    def log_payload_size(self) -> int:
+        """Return the number of characters of payloads and responses that are logged."""
+        size = self.config.get("log_payload_size")
+        return 10000 if size is None else int(size)
+
+    def log_payload(self, message, payload) -> None:
+        """Log message with the payload, cut to log_payload_size characters."""
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        if self.log_payload_size > 0:
+            message = f"{message}: {summarize(payload, self.log_payload_size)}"
+        self.logger.info(message)
+
+    @property
+    def page_size(self) -> int:
+        """Return the number of rows requested per query page."""
+        return int(self.config.get("page_size") or 1000)
+
+    @property
+    def page_workers(self) -> int:
+        """Return how many query pages are fetched at once."""
+        return int(self.config.get("page_workers") or 1)
+
+    def get_page(self, intacct_object, fields, filter, docparid, offset, page_size=None):
+        """Return the total count and the rows of the query page starting at offset."""
+        data = {
+            "query": {
+                "object": intacct_object,
+                "select": {"field": fields},
+                "options": {"showprivate": "true"},
+                "pagesize": page_size or self.page_size,
+                "offset": offset,
+            }
+        }
+        if filter:
+            data["query"].update(filter)
+
+        if docparid:
+            data["query"]["docparid"] = docparid
+
+        try:
+            response = self.request_api("POST", request_data=data)
+            count = int(response.get("data", {}).get("@totalcount", 0))
+            intacct_objects = response.get("data", {}).get(intacct_object, [])
+            # When only 1 object is found, Intacct returns a dict, otherwise it returns a list of dicts.
+            if isinstance(intacct_objects, dict):
+                intacct_objects = [intacct_objects]
+            return count, intacct_objects
+        except (KeyError, ValueError, TypeError) as e:
+            self.logger.error(f"Failed to retrieve records: {e.__repr__()}")
+            raise FatalAPIError(f"Error while fetching records: {e.__repr__()}")
+
+    def iter_records(self, intacct_object, fields, filter=None, docparid=None, first_page=None):
+        """Yield the rows of a query page by page.
+
+        The first page gives the total count, the remaining pages are then
+        fetched page_workers at a time so only those pages are held in memory.
+        first_page is the (count, rows) at offset 0 when it was already fetched.
+        """
         if filter is None:
             filter = {}
- 
-        pagesize = 1000
-        offset = 0
-        total_intacct_objects = []
-
-        while True:
-            data = {
-                "query": {
-                    "object": intacct_object,
-                    "select": {"field": fields},
-                    "options": {"showprivate": "true"},
-                    "pagesize": pagesize,
-                    "offset": offset,
-                }
-            }
-            if filter:
-                data["query"].update(filter)
 
-            if docparid:
-                data["query"]["docparid"] = docparid
+        if first_page is None:
+            first_page = self.get_page(intacct_object, fields, filter, docparid, 0)
+        count, intacct_objects = first_page
+        yield from intacct_objects
 
-            try:
-                response = self.request_api("POST", request_data=data)
-                count = int(response.get("data", {}).get("@totalcount", 0))
-                intacct_objects = response.get("data", {}).get(intacct_object, [])
-                # When only 1 object is found, Intacct returns a dict, otherwise it returns a list of dicts.
-                if isinstance(intacct_objects, dict):
-                    intacct_objects = [intacct_objects]
-
-                total_intacct_objects.extend(intacct_objects)
-
-                if offset + pagesize >= count:
-                    break
-
-                offset += pagesize
-            except (KeyError, ValueError, TypeError) as e:
-                self.logger.error(f"Failed to retrieve records: {e.__repr__()}")
-                raise FatalAPIError(f"Error while fetching records: {e.__repr__()}")
-        
-        return total_intacct_objects
+        offsets = list(range(self.page_size, count, self.page_size))
+        for i in range(0, len(offsets), self.page_workers):
+            pages = self.map_concurrently(
+                lambda offset: self.get_page(intacct_object, fields, filter, docparid, offset)[1],
+                offsets[i:i + self.page_workers],
+                max_workers=self.page_workers,
+            )
+            for intacct_objects in pages:
+                yield from intacct_objects
+
+    def get_records(self, intacct_object, fields, filter=None, docparid=None, first_page=None):
+        return list(self.iter_records(intacct_object, fields, filter, docparid, first_page))
+
+    def get_reference_records(self, intacct_object, fields, first_page=None):
+        """Return the rows of a reference object, from the on-disk cache when enabled and fresh."""
+        cache_path = self.config.get("reference_cache_path")
+        if not cache_path:
+            return self.iter_records(intacct_object, fields, first_page=first_page)
+
+        path = Path(cache_path) / str(self.config.get("company_id")) / f"{intacct_object}.json"
+        version = f"{REFERENCE_CACHE_VERSION}:{','.join(fields)}"
+        ttl = float(self.config.get("reference_cache_ttl") or 3600)
+
+        rows = read_reference_cache(path, version, ttl)
+        if rows is not None:
+            self.logger.info(f"Loaded {len(rows)} {intacct_object} records from cache {path}")
+            return rows
+
+        rows = self.get_records(intacct_object, fields, first_page=first_page)
+        try:
+            write_reference_cache(path, version, rows)
+        except OSError as e:
+            self.logger.warning(f"Failed to write {intacct_object} cache {path}: {e.__repr__()}")
+        return rows
 
     def get_vendors(self):
-        if IntacctSink.vendors is None:
-            vendors = self.get_records("VENDOR", ["VENDORID", "NAME", "RECORDNO"])
-            IntacctSink.vendors = dictify(vendors, "NAME", "VENDORID")
-            IntacctSink.vendors_recordno = dictify(vendors, "RECORDNO", "VENDORID")
-            IntacctSink.vendors_by_id = dictify(vendors, "VENDORID", "NAME")
+        self.load_reference("VENDOR")
         return IntacctSink.vendors
 
     def get_accounts(self):
-        if IntacctSink.accounts is None:
-            accounts = self.get_records("GLACCOUNT", ["RECORDNO", "ACCOUNTNO", "TITLE"])
-            IntacctSink.accounts = dictify(accounts, "TITLE", "ACCOUNTNO")
+        self.load_reference("GLACCOUNT")
         return IntacctSink.accounts
 
     def get_projects(self):
-        if IntacctSink.projects is None:
-            projects = self.get_records("PROJECT", ["PROJECTID", "NAME"])
-            IntacctSink.projects = dictify(projects, "NAME", "PROJECTID")
+        self.load_reference("PROJECT")
         return IntacctSink.projects
 
     def get_locations(self):
-        if IntacctSink.locations is None:
-            locations = self.get_records("LOCATION", ["LOCATIONID", "NAME", "STATUS"])
-            # filter out locations with status "Inactive", not doing on the request because status filtering is not working for some reason
-            locations = [location for location in locations if location.get("STATUS").lower() == "active"]
-            IntacctSink.locations = dictify(locations, "NAME", "LOCATIONID")
+        self.load_reference("LOCATION")
         return IntacctSink.locations
 
     def get_classes(self):
-        if IntacctSink.classes is None:
-            classes = self.get_records("CLASS", ["CLASSID", "NAME"])
-            IntacctSink.classes = dictify(classes, "NAME", "CLASSID")
+        self.load_reference("CLASS")
         return IntacctSink.classes
 
     def get_departments(self):
-        if IntacctSink.departments is None:
-            departments = self.get_records("DEPARTMENT", ["DEPARTMENTID", "TITLE", "RECORDNO"])
-            IntacctSink.departments = dictify(departments, "TITLE", "DEPARTMENTID")
-            IntacctSink.departments_recordno = dictify(departments, "RECORDNO", "DEPARTMENTID")
+        self.load_reference("DEPARTMENT")
         return IntacctSink.departments
 
     def get_customers(self):
-        if IntacctSink.customers is None:
-            customers = self.get_records("CUSTOMER", ["CUSTOMERID", "NAME"])
-            IntacctSink.customers = dictify(customers, "NAME", "CUSTOMERID")
+        self.load_reference("CUSTOMER")
         return IntacctSink.customers
 
     def get_items(self):
-        if IntacctSink.items is None:
-            items = self.get_records("ITEM", ["ITEMID", "NAME"])
-            IntacctSink.items = dictify(items, "NAME", "ITEMID")
+        self.load_reference("ITEM")
         return IntacctSink.items
 
+    def is_reference_loaded(self, intacct_object):
+        maps = self.reference_objects[intacct_object]["maps"]
+        return all(getattr(IntacctSink, name) is not None for name in maps)
+
+    def load_reference(self, intacct_object, reload=False):
+        """Build the maps of a reference object on first use, or again when reload is set."""
+        if not reload and self.is_reference_loaded(intacct_object):
+            return
+        with IntacctSink.reference_load_locks[intacct_object]:
+            if not reload and self.is_reference_loaded(intacct_object):
+                return
+            self.load_reference_rows(intacct_object)
+
+    def load_reference_rows(self, intacct_object, first_page=None) -> None:
+        """Build the maps of a reference object from all its rows, under its load lock.
+
+        first_page is the (count, rows) at offset 0 when it was already fetched.
+        """
+        reference = self.reference_objects[intacct_object]
+        with self.stage_timer("reference_load"):
+            rows = self.get_reference_records(
+                intacct_object, reference["fields"] + ["WHENMODIFIED"], first_page
+            )
+            self.set_reference_rows(intacct_object, rows)
+
+    def set_reference_rows(self, intacct_object, rows) -> None:
+        """Replace the maps of a reference object with ones built from rows."""
+        maps = {name: ReferenceIndex() for name in self.reference_objects[intacct_object]["maps"]}
+        self.merge_reference_rows(intacct_object, rows, maps)
+        for name, values in maps.items():
+            setattr(IntacctSink, name, values)
+
+    @classmethod
+    def get_reference_state(cls) -> dict:
+        """Return the reference maps and lookups shared by all sinks, see set_reference_state."""
+        names = list(cls.reference_map_objects) + list(cls.reference_state_names)
+        return {name: getattr(IntacctSink, name) for name in names}
+
+    @classmethod
+    def set_reference_state(cls, state=None) -> None:
+        """Restore the reference maps and lookups saved by get_reference_state, or clear them.
+
+        The misses are always cleared, so each run refreshes on its own misses.
+        """
+        with IntacctSink.reference_lock:
+            for name in cls.reference_map_objects:
+                setattr(IntacctSink, name, (state or {}).get(name))
+            for name in cls.reference_state_names:
+                value = (state or {}).get(name)
+                if value is None or name == "reference_misses":
+                    value = type(getattr(IntacctSink, name))()
+                setattr(IntacctSink, name, value)
+
+    def collect_reference_values(self, records) -> dict:
+        """Return the values of the reference_fields of records: object -> field -> values."""
+        values = {}
+        for intacct_object, fields in self.reference_fields.items():
+            for field, paths in fields.items():
+                found = {value for record in records for path in paths for value in iter_path_values(record, path)}
+                if found:
+                    values.setdefault(intacct_object, {})[field] = found
+        return values
+
+    def prefetch_references(self, records) -> None:
+        """Load the reference objects records look up, concurrently, before they are mapped."""
+        values = [
+            (intacct_object, fields)
+            for intacct_object, fields in self.collect_reference_values(records).items()
+            if intacct_object in IntacctSink.reference_targeted
+            or not self.is_reference_loaded(intacct_object)
+        ]
+        self.map_concurrently(
+            lambda item: self.prefetch_reference(*item), values, max_workers=len(values)
+        )
+
+    def prefetch_reference(self, intacct_object, values) -> None:
+        """Load a reference object, or only the rows of values when the object is large."""
+        with IntacctSink.reference_load_locks[intacct_object]:
+            targeted = intacct_object in IntacctSink.reference_targeted
+            if not targeted and not self.is_reference_loaded(intacct_object):
+                targeted = self.use_targeted_reference(intacct_object, values)
+                if targeted:
+                    # empty maps mark the object loaded, lookups fill them
+                    for name in self.reference_objects[intacct_object]["maps"]:
+                        setattr(IntacctSink, name, ReferenceIndex())
+                    IntacctSink.reference_targeted[intacct_object] = set()
+        if targeted:
+            self.load_reference_values(intacct_object, values)
+        else:
+            self.load_reference(intacct_object)
+
+    @property
+    def reference_targeted_min_count(self) -> int:
+        return int(self.config.get("reference_targeted_min_count") or 5000)
+
+    def use_targeted_reference(self, intacct_object, values) -> bool:
+        """Return whether to load only the rows of values instead of the whole object.
+
+        In auto mode an object is loaded by value when it has at least
+        reference_targeted_min_count rows and the values take fewer `in`
+        queries than the object takes pages. Its first page gives the count,
+        and the object is otherwise loaded whole from there, without fetching
+        that page again. Objects cached on disk are always loaded whole.
+        """
+        mode = self.config.get("reference_load_mode") or "auto"
+        if mode == "full" or (mode == "auto" and self.config.get("reference_cache_path")):
+            return False
+        keys = sum(len(field_values) for field_values in values.values())
+        if mode == "auto":
+            fields = self.reference_objects[intacct_object]["fields"] + ["WHENMODIFIED"]
+            count, rows = self.get_page(intacct_object, fields, {}, None, 0)
+            pages = -(-count // self.page_size)
+            queries = sum(-(-len(field_values) // self.prefetch_chunk_size) for field_values in values.values())
+            if count <= len(rows) or count < self.reference_targeted_min_count or queries >= pages:
+                self.load_reference_rows(intacct_object, (count, rows))
+                return False
+            self.logger.info(f"Loading the {keys} {intacct_object} values looked up instead of all {count} records")
+            IntacctSink.reference_targeted_budget[intacct_object] = pages
+        return True
+
+    def load_reference_values(self, intacct_object, values) -> None:
+        """Merge the rows of a targeted object whose fields have values into its maps.
+
+        values maps fields to the values to query. Values that were already
+        queried are skipped, whether they were found or not.
+        """
+        reference = self.reference_objects[intacct_object]
+        queried = IntacctSink.reference_targeted[intacct_object]
+        pairs = {
+            (field, str(value))
+            for field, field_values in values.items()
+            for value in field_values
+            if (field, str(value)) not in queried
+        }
+        if not pairs:
+            return
+        size = self.prefetch_chunk_size
+        filters = []
+        for field in sorted({field for field, _ in pairs}):
+            field_values = sorted(value for pair_field, value in pairs if pair_field == field)
+            filters += [
+                {"in": {"field": field, "value": field_values[i:i + size]}}
+                for i in range(0, len(field_values), size)
+            ]
+        with self.stage_timer("reference_lookup"):
+            results = self.map_concurrently(
+                lambda filter: self.get_records(
+                    intacct_object, reference["fields"] + ["WHENMODIFIED"], filter={"filter": filter}
+                ),
+                filters,
+            )
+        with IntacctSink.reference_lock:
+            self.swap_reference_rows(intacct_object, [row for rows in results for row in rows])
+            queried.update(pairs)
+            budget = IntacctSink.reference_targeted_budget.get(intacct_object)
+            if budget is None:
+                return
+            IntacctSink.reference_targeted_budget[intacct_object] = budget - len(filters)
+            if budget > len(filters):
+                return
+            # the lookups so far cost as much as loading the object whole. The object stays
+            # targeted until it's loaded, so lookups in the meantime still query their values
+            del IntacctSink.reference_targeted_budget[intacct_object]
+        self.logger.info(f"Loading all {intacct_object} records after {len(queried)} values were looked up")
+        with IntacctSink.reference_load_locks[intacct_object]:
+            self.load_reference_rows(intacct_object)
+            with IntacctSink.reference_lock:
+                IntacctSink.reference_targeted.pop(intacct_object, None)
+
+    def merge_reference_rows(self, intacct_object, rows, maps):
+        """Merge reference rows into the object's maps and track the latest WHENMODIFIED."""
+        reference = self.reference_objects[intacct_object]
+        synced_at = IntacctSink.reference_synced_at.get(intacct_object)
+        for row in rows:
+            modified_at = parse_intacct_datetime(row.get("WHENMODIFIED"))
+            if modified_at and (synced_at is None or modified_at > parse_intacct_datetime(synced_at)):
+                synced_at = row["WHENMODIFIED"]
+
+            # filter out inactive rows, not doing on the request because status filtering is not working for some reason
+            inactive = reference.get("active_only") and (row.get("STATUS") or "").lower() != "active"
+            for name, (key, value) in reference["maps"].items():
+                if inactive:
+                    maps[name].pop(row[key], None)
+                else:
+                    maps[name][row[key]] = row[value]
+        IntacctSink.reference_synced_at[intacct_object] = synced_at
+
+    def swap_reference_rows(self, intacct_object, rows) -> None:
+        """Merge rows into copies of the object's maps and swap them in, under reference_lock.
+
+        Maps are never changed in place, so threads reading them aren't affected.
+        """
+        with IntacctSink.reference_lock:
+            maps = {
+                name: getattr(IntacctSink, name).copy()
+                for name in self.reference_objects[intacct_object]["maps"]
+            }
+            self.merge_reference_rows(intacct_object, rows, maps)
+            for name, values in maps.items():
+                setattr(IntacctSink, name, values)
+
+    @property
+    def reference_refresh_interval(self) -> float:
+        return float(self.config.get("reference_refresh_interval") or 60)
+
+    def refresh_reference(self, intacct_object, interval=0):
+        """Merge the rows modified since the last load into the object's maps.
+
+        The rows are fetched without holding reference_lock. Nothing is sent
+        if the object was refreshed less than interval seconds ago, and misses
+        during a refresh wait for it.
+        """
+        reference = self.reference_objects[intacct_object]
+        with IntacctSink.reference_refresh_locks[intacct_object]:
+            refreshed_at = IntacctSink.reference_refreshed_at.get(intacct_object)
+            if refreshed_at is not None and time.monotonic() - refreshed_at < interval:
+                return
+            IntacctSink.reference_refreshed_at[intacct_object] = time.monotonic()
+            synced_at = IntacctSink.reference_synced_at.get(intacct_object)
+            filter = None
+            if synced_at:
+                filter = {
+                    "filter": {
+                        "greaterthanorequalto": {"field": "WHENMODIFIED", "value": synced_at}
+                    }
+                }
+            self.logger.info(f"Refreshing {intacct_object} records modified since {synced_at}")
+            with self.stage_timer("reference_refresh"):
+                rows = self.get_records(
+                    intacct_object, reference["fields"] + ["WHENMODIFIED"], filter=filter
+                )
+                self.swap_reference_rows(intacct_object, rows)
+
+    def get_reference(self, name, key, refresh=True):
+        """Return the value of key in the reference map name, or None if it doesn't exist.
+
+        A miss refreshes the object once with the rows modified since it was
+        loaded, so records created in Intacct during the run are still found.
+        Set refresh to False for keys that are skipped when missing.
+        """
+        values = self.load_reference_map(name)
+        if key is None or key in values:
+            return values.get(key)
+        self.refresh_reference_on_miss(name, key, refresh)
+        return getattr(IntacctSink, name).get(key)
+
+    def has_reference_value(self, name, value):
+        """Return whether value is one of the values of the reference map name."""
+        values = self.load_reference_map(name)
+        if value is None or values.has_value(value):
+            return value is not None
+        self.refresh_reference_on_miss(name, ("value", value))
+        return getattr(IntacctSink, name).has_value(value)
+
+    def has_reference_key(self, name, key):
+        """Return whether key is in the reference map name, without refreshing it on a miss."""
+        values = self.load_reference_map(name)
+        if key is None or key in values:
+            return key is not None
+        if self.reference_map_objects[name] in IntacctSink.reference_targeted:
+            self.lookup_reference_value(name, key)
+        return key in getattr(IntacctSink, name)
+
+    def load_reference_map(self, name):
+        self.load_reference(self.reference_map_objects[name])
+        return getattr(IntacctSink, name)
+
+    def lookup_reference_value(self, name, key):
+        """Query the row of a key, or a ("value", value), missing from a targeted object."""
+        intacct_object = self.reference_map_objects[name]
+        key_field, value_field = self.reference_objects[intacct_object]["maps"][name]
+        if isinstance(key, tuple):
+            field, key = value_field, key[1]
+        else:
+            field = key_field
+        try:
+            self.load_reference_values(intacct_object, {field: {key}})
+        except Exception as e:
+            self.logger.warning(f"Failed to look up {intacct_object} {field} {key}: {e.__repr__()}")
+
+    def refresh_reference_on_miss(self, name, key, refresh=True):
+        intacct_object = self.reference_map_objects[name]
+        # a targeted object only holds the values looked up so far
+        if intacct_object in IntacctSink.reference_targeted:
+            return self.lookup_reference_value(name, key)
+        if (
+            refresh
+            and self.config.get("reference_refresh_on_miss", True)
+            and (name, key) not in IntacctSink.reference_misses
+        ):
+            IntacctSink.reference_misses.add((name, key))
+            try:
+                self.refresh_reference(intacct_object, self.reference_refresh_interval)
+            except Exception as e:
+                self.logger.warning(f"Failed to refresh {intacct_object} records: {e.__repr__()}")
+
+    @property
+    def attachment_workers(self) -> int:
+        """Return how many attachments of a record are fetched at once."""
+        return int(self.config.get("attachment_workers") or 4)
+
+    def get_attachment_path(self, attachment) -> str:
+        return f"{self.config.get('input_path')}/{attachment.get('id')}_{attachment.get('name')}"
+
+    def get_attachment_size(self, attachment) -> int:
+        """Return the expected base64 size of an attachment before it's fetched.
+
+        The size is its declared size or the size of its input file, one
+        chunk when neither is known.
+        """
+        try:
+            size = int(attachment.get("size") or 0)
+        except (TypeError, ValueError):
+            size = 0
+        if not size and not attachment.get("url"):
+            try:
+                size = os.path.getsize(self.get_attachment_path(attachment))
+            except OSError:
+                size = 0
+        size = size or self.attachment_chunk_size
+        return 4 * -(-size // 3)
+
+    def fetch_attachment(self, attachment, hold=None):
+        """Return the base64 content of an attachment's url or input file and the sha256 of its bytes.
+
+        The content is streamed, encoded and hashed chunk by chunk, and added
+        to hold, a MemoryHold, as it's encoded. Both are None if it can't be read.
+        """
+        size = self.attachment_chunk_size
+        digest = hashlib.sha256()
+        url = attachment.get("url")
+        if url:
+            try:
+                with self._target.http_session.get(
+                    url, timeout=self._target.request_timeout, stream=True
+                ) as response:
+                    data = encode_base64(response.iter_content(size), digest, hold)
+            except requests.RequestException as e:
+                self.logger.error(f"Failed to fetch attachment from {url}: {e.__repr__()}")
+                return None, None
+        else:
+            try:
+                att_path = self.get_attachment_path(attachment)
+                with open(att_path, "rb") as attach_file:
+                    data = encode_base64(iter(lambda: attach_file.read(size), b""), digest, hold)
+            except FileNotFoundError as e:
+                self.logger.error(f"File not found for attachment: {att_path}. Error: {e.__repr__()}")
+                return None, None
+            except OSError as e:
+                self.logger.error(f"Failed to read file {att_path}. Error: {e.__repr__()}")
+                return None, None
+        return data, digest.hexdigest()
+
+    def fetch_attachments(self, attachments, hold=None) -> list:
+        """Return the (content, digest) of each attachment, fetching attachment_workers at a time."""
+        return self.map_concurrently(
+            lambda attachment: self.fetch_attachment(attachment, hold),
+            attachments,
+            max_workers=self.attachment_workers,
+        )
+
     def prepare_attachment_payload(
-        self, attachments, supdoc_id, existing_attachments=None, folder_id=None
+        self, attachments, supdoc_id, existing_attachments=None, folder_id=None, contents=None
     ):
+        """Return the supdoc function posting the attachments not posted yet.
+
+        existing_attachments has the names and sha256 digests of the
+        attachments in the supdoc. contents are the (base64 content, digest)
+        of the attachments, fetched here when not given.
+        """
         if existing_attachments is None:
-            existing_attachments = {"names": [], "content": []}
+            existing_attachments = {"names": [], "digests": []}
+        existing_digests = set(existing_attachments.get("digests", []))
 
         if isinstance(attachments, str):
             attachments = parse_objs(attachments)
 
-        for attachment in attachments:
-            url = attachment.get("url")
-            if url:
-                try:
-                    response = requests.get(url)
-                    data = base64.b64encode(response.content)
-                    data = data.decode()
-                    attachment["data"] = data
-                except requests.RequestException as e:
-                    self.logger.error(f"Failed to fetch attachment from {url}: {e.__repr__()}")
-                    continue
-            else:
-                try:
-                    att_path = f"{self.config.get('input_path')}/{attachment.get('id')}_{attachment.get('name')}"
-                    with open(att_path, "rb") as attach_file:
-                        data = base64.b64encode(attach_file.read()).decode()
-                        attachment["data"] = data
-                except FileNotFoundError as e:
-                    self.logger.error(f"File not found for attachment: {att_path}. Error: {e.__repr__()}")
-                    continue
-                except OSError as e:
-                    self.logger.error(f"Failed to read file {att_path}. Error: {e.__repr__()}")
-                    continue
+        if contents is None:
+            contents = self.fetch_attachments(attachments)
 
         filtered_attachments = []
-        for att in attachments:
+        for att, (data, digest) in zip(attachments, contents):
             att_name = f'{att.get("id")}_{att.get("name")}' if att.get("id") else att.get("name")
             should_post = False
 
             if att.get("id"):
                 # check if attachment content was previously posted (precoro)
-                should_post = att.get("data") not in existing_attachments.get("content", [])
+                should_post = digest is None or digest not in existing_digests
             else:
                 # check if attachment name was previously posted
                 should_post = att_name not in existing_attachments.get("names", [])
@@ -393,7 +1033,7 @@ class IntacctSink(HotglueSink):
                 filtered_attachments.append({
                         "attachmentname": att_name,
                         "attachmenttype": Path(att_name).suffix,
-                        "attachmentdata": att.get("data"),
+                        "attachmentdata": data,
                 })
             else:
                 self.logger.info(f"Skipping attachment '{att_name}' (duplicate name or content found)")
@@ -413,80 +1053,624 @@ class IntacctSink(HotglueSink):
 
         supdoc_id = str(record_id).replace("-","")[-20:]  # supdocid only allows 20 chars
         self.logger.info(f"Transforming record_id: {record_id} into supdoc_id: {supdoc_id}")
-        # 1. check if supdoc exists and get existing attachments
+        # 1. get the existing attachments from the index, or check the supdoc and its folder
+        # in one request if the supdoc isn't indexed. Folders found or created in the run are
+        # known to exist, folder_exists is None when it's unknown
+        folder_exists = True if record_id in self._target.supdoc_folders else None
+        existing_attachments = self._target.supdoc_index.get(supdoc_id)
+        if existing_attachments is None:
+            try:
+                existing_attachments, folder_exists = self.get_existing_attachments(
+                    supdoc_id, folder_id=None if folder_exists else record_id
+                )
+            except Exception as e:
+                self.logger.error(f"Failed to check existing supdoc for record {supdoc_id}: {e.__repr__()}")
+                return
+        if existing_attachments["names"]:
+            self.logger.info(f"Supdoc with ID {supdoc_id} already exists, updating it.")
+
+        # fetch once the expected size fits in the run's memory budget. The contents are
+        # counted as they're encoded and wait for the budget past the reserved size. They're
+        # only referenced from the payload, and all released once it's posted or has failed
+        if isinstance(attachments, str):
+            attachments = parse_objs(attachments)
+        # attachments deduped by name are skipped without being fetched
+        names = set(existing_attachments["names"])
+        fetch = [att.get("id") or att.get("name") not in names for att in attachments]
+        to_fetch = [att for att, f in zip(attachments, fetch) if f]
+        with self._target.attachment_budget.hold() as hold:
+            hold.reserve(sum(self.get_attachment_size(att) for att in to_fetch))
+            fetched = iter(self.fetch_attachments(to_fetch, hold))
+            hold.trim()
+            contents = [next(fetched) if f else (None, None) for f in fetch]
+            return self._post_attachments(
+                attachments, contents, record_id, supdoc_id, existing_attachments, folder_exists
+            )
+
+    def get_existing_attachments(self, supdoc_id, folder_id=None):
+        """Return the names and sha256 digests of the attachments of a supdoc, indexing them.
+
+        Only needed for supdocs missing from the index, as the attachments are
+        downloaded to be hashed. With folder_id, the folder is checked in the
+        same request, and whether it exists is returned too (None if unknown).
+        """
+        functions = {"get_supdoc": {"get": {"@object": "supdoc", "@key": supdoc_id}}}
+        if folder_id:
+            functions["get_supdocfolder"] = {"get": {"@object": "supdocfolder", "@key": folder_id}}
+        results = self.request_api_batch("POST", functions)
+        result = results.get("get_supdoc") or {}
+        if result.get("status") != "success":
+            raise FatalAPIError(result.get("errormessage") or result)
+        supdoc = (result.get("data") or {}).get("supdoc")
+
+        folder_exists = None
+        folder = results.get("get_supdocfolder") or {}
+        if folder.get("status") == "success":
+            folder_exists = bool((folder.get("data") or {}).get("supdocfolder"))
+            if folder_exists:
+                self._target.supdoc_folders.add(folder_id)
+
+        existing_attachments = {"names": [], "digests": []}
+        if not supdoc:
+            return existing_attachments, folder_exists
+        existing_attachments_data = (supdoc.get("attachments") or {}).get("attachment") or []
+        if isinstance(existing_attachments_data, dict):
+            existing_attachments_data = [existing_attachments_data]
+        for att in existing_attachments_data:
+            existing_attachments["names"].append(att.get("attachmentname"))
+            if att.get("attachmentdata"):
+                existing_attachments["digests"].append(
+                    hashlib.sha256(base64.b64decode(att["attachmentdata"])).hexdigest()
+                )
+        self.index_attachments(supdoc_id, **existing_attachments)
+        return existing_attachments, folder_exists
+
+    def index_attachments(self, supdoc_id, names, digests) -> None:
         try:
-            check_supdoc = {"get": {"@object": "supdoc", "@key": supdoc_id}}
-            supdoc_response = self.request_api("POST", request_data=check_supdoc)
-            supdoc = (supdoc_response.get("data") or {}).get("supdoc")
-        except Exception as e:
-            self.logger.error(f"Failed to check existing supdoc for record {supdoc_id}: {e.__repr__()}")
-            return
-        
+            self._target.supdoc_index.set(supdoc_id, names, digests)
+        except OSError as e:
+            self.logger.warning(f"Failed to index attachments of supdoc {supdoc_id}: {e.__repr__()}")
 
-        # getting existing attachments
-        existing_attachments = {"names": [], "content": []}
-        if supdoc:
-            self.logger.info(f"Supdoc with ID {supdoc_id} already exists, updating it.")
-            existing_attachments_data = supdoc.get("attachments", {}).get("attachment")
-            if isinstance(existing_attachments_data, dict):
-                existing_attachments["names"] = [existing_attachments_data.get("attachmentname")]
-                existing_attachments["content"] = existing_attachments_data.get("attachmentdata")
-            elif isinstance(existing_attachments_data, list):
-                existing_attachments["names"] = [att.get("attachmentname") for att in existing_attachments_data]
-                existing_attachments["content"] = [att.get("attachmentdata") for att in existing_attachments_data]
+    def delete_attachments(self, supdoc_id) -> None:
+        """Delete a supdoc and drop it from the index."""
+        self._target.supdoc_index.discard(supdoc_id)
+        self.request_api("POST", request_data={"delete_supdoc": {"@key": supdoc_id}})
 
+    def _post_attachments(
+        self, attachments, contents, record_id, supdoc_id, existing_attachments, folder_exists=None
+    ):
         # prepare attachments payload
         try:
-            att_payload = self.prepare_attachment_payload(attachments, supdoc_id, existing_attachments, folder_id=record_id)
+            att_payload = self.prepare_attachment_payload(
+                attachments, supdoc_id, existing_attachments, folder_id=record_id, contents=contents
+            )
         except Exception as e:
             self.logger.error(f"Failed to prepare attachment payload for record {record_id}: {e.__repr__()}")
             return
 
         if att_payload:
             try:
-                # Check if the folder exists
-                check_folder = {"get": {"@object": "supdocfolder", "@key": record_id}}
-                folder_response = self.request_api("POST", request_data=check_folder)
-                folder_exists = folder_response.get("data", {}).get("supdocfolder")
-
+                # Create the folder unless it exists, in the same request as the attachments.
+                # Functions run in order, and a failed create of a folder that turns out to
+                # exist doesn't stop the attachments from being posted to it
+                functions = {}
                 if folder_exists:
                     self.logger.info(f"Folder with name {record_id} already exists.")
                 else:
-                    # Create folder if it doesn't exist
-                    folder_payload = {"create_supdocfolder": {"supdocfoldername": record_id}}
-                    self.request_api("POST", request_data=folder_payload)
-                    self.logger.info(f"Created folder with name {record_id}.")
+                    functions["create_supdocfolder"] = {"create_supdocfolder": {"supdocfoldername": record_id}}
+                functions["supdoc"] = att_payload
 
                 # Post the attachments
-                self.request_api("POST", request_data=att_payload)
+                results = self.request_api_batch("POST", functions, log_payload=False)
+                result = results.get("supdoc") or {}
+                if result.get("status") != "success":
+                    raise FatalAPIError(result.get("errormessage") or result)
+                if (results.get("create_supdocfolder") or {}).get("status") == "success":
+                    self.logger.info(f"Created folder with name {record_id}.")
+                self._target.supdoc_folders.add(record_id)
                 self.logger.info(f"Attachments for record {record_id} have been posted successfully.")
+                posted = next(iter(att_payload.values()))["attachments"]["attachment"]
+                self.index_attachments(
+                    supdoc_id,
+                    names=list(existing_attachments["names"]) + [att["attachmentname"] for att in posted],
+                    digests=dict.fromkeys(
+                        list(existing_attachments["digests"]) + [digest for _, digest in contents if digest]
+                    ),
+                )
                 return supdoc_id
             except Exception as e:
+                # the supdoc may be partly written, get it again next time
+                self._target.supdoc_index.discard(supdoc_id)
                 raise Exception(f"Failed to post attachments or folder for record {record_id}: {e.__repr__()}")
 
         self.logger.info(f"No new attachments to post for record {record_id}.")
         return
 
     def get_employee_id_by_recordno(self, recordno):
-        employee = self.request_api("POST", request_data={"query": {"object": "EMPLOYEE", "select": {"field": ["EMPLOYEEID", "RECORDNO"]}, "filter": {"equalto": {"field": "RECORDNO", "value": f"{recordno}"}}}})
-        if employee:
-            return employee.get("data", {}).get("EMPLOYEE", {}).get("EMPLOYEEID")
-        raise Exception(f"Employee with recordno {recordno} not found.")
+        return self.lookup_by_recordno("employee_ids", recordno)
 
     def get_account_no_by_account_id(self, account_id):
-        account = self.request_api("POST", request_data={"query": {"object": "GLACCOUNT", "select": {"field": ["ACCOUNTNO", "RECORDNO"]}, "filter": {"equalto": {"field": "RECORDNO", "value": f"{account_id}"}}}})
-        if account:
-            return account.get("data", {}).get("GLACCOUNT", {}).get("ACCOUNTNO")
-        raise Exception(f"Account with account_id {account_id} not found.")
-    
+        return self.lookup_by_recordno("account_nos", account_id)
+
+    @property
+    def lookup_cache_size(self) -> int:
+        return int(self.config.get("lookup_cache_size") or 10000)
+
+    def get_point_lookup_cache(self, name):
+        with IntacctSink.reference_lock:
+            if name not in IntacctSink.point_lookup_caches:
+                IntacctSink.point_lookup_caches[name] = LRUCache(self.lookup_cache_size)
+            return IntacctSink.point_lookup_caches[name]
+
+    def lookup_by_recordno(self, name, recordno):
+        """Return the field of the point lookup name for the record with RECORDNO recordno."""
+        intacct_object, field = self.point_lookups[name]
+        cache = self.get_point_lookup_cache(name)
+        value = cache.get(str(recordno))
+        if value is not None:
+            return value
+
+        response = self.request_api("POST", request_data={"query": {"object": intacct_object, "select": {"field": [field, "RECORDNO"]}, "filter": {"equalto": {"field": "RECORDNO", "value": f"{recordno}"}}}})
+        if not response:
+            raise Exception(f"{intacct_object} with RECORDNO {recordno} not found.")
+        value = response.get("data", {}).get(intacct_object, {}).get(field)
+        if value is not None:
+            cache[str(recordno)] = value
+        return value
+
+    def prefetch_by_recordno(self, name, recordnos):
+        """Resolve the uncached RECORDNOs of a batch with `in` queries."""
+        intacct_object, field = self.point_lookups[name]
+        cache = self.get_point_lookup_cache(name)
+        recordnos = [
+            recordno
+            for recordno in dict.fromkeys(str(r) for r in recordnos if r)
+            if recordno not in cache
+        ]
+        size = self.prefetch_chunk_size
+        results = self.map_concurrently(
+            lambda chunk: self.get_records(
+                intacct_object,
+                fields=[field, "RECORDNO"],
+                filter={"filter": {"in": {"field": "RECORDNO", "value": chunk}}},
+            ),
+            [recordnos[i:i + size] for i in range(0, len(recordnos), size)],
+        )
+        for rows in results:
+            for row in rows:
+                if row.get(field) is not None:
+                    cache[row["RECORDNO"]] = row[field]
+
+    def prefetch_line_lookups(self, records, line_keys):
+        """Resolve the accountId and employeeId of every line in a batch."""
+        lines = [
+            line
+            for record in records
+            for key in line_keys
+            for line in parse_objs(record.get(key) or "[]") or []
+            if isinstance(line, dict)
+        ]
+        self.prefetch_by_recordno("account_nos", [line.get("accountId") for line in lines])
+        self.prefetch_by_recordno("employee_ids", [line.get("employeeId") for line in lines])
 
     def get_record_url(self, object, record_id, state_updates):
+        if not self.config.get("output_record_url"):
+            return state_updates
+        if self.pending_record_urls is not None:
+            self.pending_record_urls.append((object, record_id, state_updates))
+            return state_updates
         try:
-            if self.config.get("output_record_url"):
+            with self.stage_timer("record_url"):
                 record_url = self.request_api("POST", request_data={"readByQuery": {"object": object, "fields": "RECORD_URL", "query": f"RECORDNO = {record_id}"}})
-                if record_url:
-                    record_url = record_url.get("data", {}).get(object.lower(), {}).get("RECORD_URL")
-                    state_updates["record_url"] = record_url
+            if record_url:
+                record_url = record_url.get("data", {}).get(object.lower(), {}).get("RECORD_URL")
+                state_updates["record_url"] = record_url
         except Exception as e:
             self.logger.error(f"Failed to get record url for {object} with record_id {record_id}: {str(e)}")
         return state_updates
+
+    def resolve_record_urls(self, pending) -> None:
+        """Set the record_url of the state updates deferred by get_record_url.
+
+        The RECORDNOs of each object are read with one readByQuery per chunk.
+        """
+        state_updates_by_object = {}
+        for object, record_id, state_updates in pending:
+            records = state_updates_by_object.setdefault(object, {})
+            records.setdefault(str(record_id), []).append(state_updates)
+
+        size = self.prefetch_chunk_size
+        chunks = []
+        for object, records in state_updates_by_object.items():
+            record_ids = list(records)
+            chunks += [(object, record_ids[i:i + size]) for i in range(0, len(record_ids), size)]
+
+        def fetch(chunk):
+            object, record_ids = chunk
+            try:
+                response = self.request_api("POST", request_data={"readByQuery": {"object": object, "fields": "RECORDNO,RECORD_URL", "query": f"RECORDNO IN ({','.join(record_ids)})", "pagesize": len(record_ids)}})
+                rows = (response or {}).get("data", {}).get(object.lower()) or []
+                return rows if isinstance(rows, list) else [rows]
+            except Exception as e:
+                self.logger.error(f"Failed to get record urls for {object} with record_ids {record_ids}: {str(e)}")
+                return []
+
+        with self.stage_timer("record_url"):
+            fetched = self.map_concurrently(fetch, chunks)
+        for (object, _), rows in zip(chunks, fetched):
+            for row in rows:
+                for state_updates in state_updates_by_object[object].get(str(row.get("RECORDNO")), []):
+                    state_updates["record_url"] = row.get("RECORD_URL")
+
+    def prefetch_bills(self, fields, keys=(), recordnos=()):
+        """Look up the existing APBILLs of a batch with a few `in` queries.
+
+        keys are (RECORDID, VENDORID) pairs. Keys and RECORDNOs that aren't
+        found are cached as missing, so get_existing_bill won't query them.
+        """
+        self.existing_bills, self.existing_bills_by_recordno = {}, {}
+        keys = list(dict.fromkeys((str(r), str(v)) for r, v in keys if r and v))
+        recordnos = list(dict.fromkeys(str(r) for r in recordnos if r))
+        existing_bills = dict.fromkeys(keys)
+        existing_bills_by_recordno = dict.fromkeys(recordnos)
+        fields = list(dict.fromkeys(fields + ["RECORDNO", "RECORDID", "VENDORID"]))
+
+        size = self.prefetch_chunk_size
+        filters = [
+            {"and": {"in": [
+                {"field": "RECORDID", "value": sorted({k[0] for k in keys[i:i + size]})},
+                {"field": "VENDORID", "value": sorted({k[1] for k in keys[i:i + size]})},
+            ]}}
+            for i in range(0, len(keys), size)
+        ] + [
+            {"in": {"field": "RECORDNO", "value": recordnos[i:i + size]}}
+            for i in range(0, len(recordnos), size)
+        ]
+        results = self.map_concurrently(
+            lambda filter: self.get_records("APBILL", fields=fields, filter={"filter": filter}),
+            filters,
+        )
+        for rows in results:
+            for row in rows:
+                # RECORDID and VENDORID are matched separately, so drop cross pairs
+                key = (row.get("RECORDID"), row.get("VENDORID"))
+                if key in existing_bills and existing_bills[key] is None:
+                    existing_bills[key] = row
+                recordno = row.get("RECORDNO")
+                if recordno in existing_bills_by_recordno:
+                    existing_bills_by_recordno[recordno] = row
+        self.existing_bills = existing_bills
+        self.existing_bills_by_recordno = existing_bills_by_recordno
+
+    def get_existing_bill(self, fields, record_id=None, vendor_id=None, recordno=None):
+        """Return the APBILLs matching RECORDNO or RECORDID and VENDORID, using the prefetched batch when possible."""
+        if recordno:
+            if str(recordno) in self.existing_bills_by_recordno:
+                row = self.existing_bills_by_recordno[str(recordno)]
+                return [row] if row else []
+            filter = {"equalto": {"field": "RECORDNO", "value": recordno}}
+        else:
+            key = (str(record_id), str(vendor_id))
+            if record_id and vendor_id and key in self.existing_bills:
+                row = self.existing_bills[key]
+                return [row] if row else []
+            filter = {
+                "and": {
+                    "equalto": [
+                        {"field": "RECORDID", "value": record_id},
+                        {"field": "VENDORID", "value": vendor_id},
+                    ]
+                }
+            }
+        return self.get_records("APBILL", fields=fields, filter={"filter": filter})
+
+    @property
+    def batch_size(self) -> int:
+        """Return how many records are written per multi-function request."""
+        if not self.batchable:
+            return 1
+        return int(self.config.get("batch_size") or 1)
+
+    @property
+    def max_workers(self) -> int:
+        """Return how many requests of this sink may be in flight at once."""
+        return int(self.config.get("max_workers") or 1)
+
+    @property
+    def buffer_size(self) -> int:
+        """Return how many records are buffered before they are written.
+
+        The requests in flight and, when pipelined, the functions built ahead of them.
+        """
+        return self.batch_size * (self.max_workers + self.attachment_pipeline)
+
+    def preprocess_record(self, record: dict, context: dict) -> dict:
+        # buffered records are mapped when the buffer is written
+        if self.buffer_size > 1:
+            return record
+        self.prefetch([record])
+        with self.stage_timer("preprocess_record"):
+            return self.map_record(record, context)
+
+    def map_record(self, record: dict, context: dict) -> dict:
+        raise NotImplementedError()
+
+    def prefetch_records(self, records: list) -> None:
+        """Load what a batch of raw records needs before they are mapped."""
+        pass
+
+    def prefetch(self, records: list) -> None:
+        try:
+            with self.stage_timer("prefetch"):
+                self.prefetch_references(records)
+                self.prefetch_records(records)
+        except Exception as e:
+            # records are still looked up one by one while mapping
+            self.logger.warning(f"Failed to prefetch {self.name} records: {e.__repr__()}")
+
+    def get_write_key(self, record: dict):
+        """Return what a mapped record writes to when a later record may update it, or None.
+
+        Records of a buffer with the same key are written in separate batches.
+        """
+        return None
+
+    def build_upsert_function(self, record: dict, state_updates: dict) -> dict:
+        """Return the Intacct function that writes the mapped record."""
+        raise NotImplementedError()
+
+    def handle_upsert_response(self, function: dict, response: dict, state_updates: dict):
+        """Return the id, success flag and state updates of a written record."""
+        raise NotImplementedError()
+
+    def handle_upsert_error(self, function: dict, error: Exception) -> Exception:
+        """Clean up after a failed write, returning the error to report."""
+        return error
+
+    def upsert_record(self, record: dict, context: dict) -> None:
+        """Process the record."""
+        state_updates = dict()
+        function = self.build_upsert_function(record, state_updates)
+        try:
+            response = self.request_api("POST", request_data=function)
+            return self.handle_upsert_response(function, response, state_updates)
+        except Exception as e:
+            raise self.handle_upsert_error(function, e)
+
+    def process_record(self, record: dict, context: dict) -> None:
+        """Process the record, buffering it when batched or concurrent writes are enabled."""
+        if self.buffer_size <= 1:
+            if not self.config.get("output_record_url"):
+                return super().process_record(record, context)
+            self.pending_record_urls = []
+            try:
+                super().process_record(record, context)
+            finally:
+                pending_record_urls, self.pending_record_urls = self.pending_record_urls, None
+            state = self.latest_state["bookmarks"][self.name][-1]
+            if pending_record_urls and state.get("success"):
+                self.deferred_record_urls += [(object, record_id, state) for object, record_id, _ in pending_record_urls]
+            if len(self.deferred_record_urls) >= self.prefetch_chunk_size:
+                self.resolve_deferred_record_urls()
+            return
+
+        if not self.latest_state:
+            self.init_state()
+
+        self.pending_records.append((record, context))
+        if len(self.pending_records) >= self.buffer_size:
+            self.process_pending_records()
+
+    @property
+    def current_size(self) -> int:
+        # records are written one by one unless buffered, drains skip sinks of size 0
+        return len(self.pending_records) + len(self.deferred_record_urls)
+
+    def resolve_deferred_record_urls(self) -> None:
+        """Set the record_url of the states of the records written one by one."""
+        deferred_record_urls, self.deferred_record_urls = self.deferred_record_urls, []
+        if deferred_record_urls:
+            self.resolve_record_urls(deferred_record_urls)
+
+    def process_batch(self, context: dict) -> None:
+        # every drain writes the buffer, including the drains of a sink retired by a
+        # schema change, which are cleared without reaching _process_endofpipe
+        self.process_pending_records()
+
+    def clean_up(self) -> None:
+        self.process_pending_records()
+        super().clean_up()
+
+    def process_pending_records(self) -> None:
+        """Map the buffered records and write them."""
+        self.resolve_deferred_record_urls()
+        if not self.pending_records:
+            return
+        pending, self.pending_records = self.pending_records, []
+        self.prefetch([raw_record for raw_record, _ in pending])
+
+        def map_pending_record(raw_record, context):
+            with self.stage_timer("preprocess_record"):
+                record = self.map_record(raw_record, context)
+            if record and raw_record.get("externalId"):
+                record["externalId"] = raw_record["externalId"]
+            return record
+
+        batch = []
+        hashes = set()
+        keys = set()
+        for raw_record, context in pending:
+            record = map_pending_record(raw_record, context)
+            key = self.get_write_key(record)
+            if key is not None and key in keys:
+                # the first record creates what this one updates, so write it and map
+                # this one again against what exists now, as in serial mode
+                self.write_batch(batch)
+                batch, hashes, keys = [], set(), set()
+                self.existing_bills.pop(key, None)
+                record = map_pending_record(raw_record, context)
+
+            hash = self.build_record_hash(record)
+            if hash in hashes:
+                # write the first copy so this one is reported as a duplicate
+                self.write_batch(batch)
+                batch, hashes, keys = [], set(), set()
+            batch.append((record, context, hash))
+            hashes.add(hash)
+            if key is not None:
+                keys.add(key)
+
+        if batch:
+            self.write_batch(batch)
+
+    def map_concurrently(self, func, items, max_workers=None) -> list:
+        """Apply func to each item on a pool of max_workers threads, keeping their order."""
+        max_workers = max_workers or self.max_workers
+        if max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    def write_batch(self, batch) -> None:
+        """Write mapped records and update their states in input order."""
+        entries = []
+        for record, context, hash in batch:
+            existing_state = self.get_existing_state(hash)
+            if existing_state:
+                entries.append({"existing_state": existing_state})
+                continue
+
+            if self.name in self.allows_externalid:
+                external_id = record.get("externalId")
+            else:
+                external_id = record.pop("externalId", None)
+
+            entries.append({
+                "record": record,
+                "context": context,
+                "state": {"hash": hash},
+                "external_id": external_id,
+            })
+
+        new_entries = [entry for entry in entries if "state" in entry]
+        self.pending_record_urls = []
+        try:
+            with self.stage_timer("write"):
+                if self.batchable:
+                    outcomes = self.write_functions(new_entries)
+                else:
+                    outcomes = self.map_concurrently(self.write_entry, new_entries)
+        finally:
+            pending_record_urls, self.pending_record_urls = self.pending_record_urls, None
+        if pending_record_urls:
+            self.resolve_record_urls(pending_record_urls)
+
+        for entry, (id, success, state_updates) in zip(new_entries, outcomes):
+            entry["outcome"] = (id, success, state_updates)
+
+        for entry in entries:
+            if entry.get("existing_state"):
+                self.update_state(entry["existing_state"], is_duplicate=True)
+                continue
+
+            id, success, state_updates = entry["outcome"]
+            if success:
+                self.logger.info(f"{self.name} processed id: {id}")
+
+            state = entry["state"]
+            state["success"] = success
+
+            if id:
+                state["id"] = id
+
+            if entry["external_id"]:
+                state["externalId"] = entry["external_id"]
+
+            if state_updates and isinstance(state_updates, dict):
+                state = dict(state, **state_updates)
+
+            self.update_state(state)
+
+    def write_entry(self, entry):
+        """Write one buffered record on its own, returning its outcome."""
+        try:
+            return self.upsert_record(entry["record"], entry["context"])
+        except Exception as e:
+            self.logger.exception(f"Upsert record error {str(e)}")
+            return None, False, {"error": str(e)}
+
+    @property
+    def attachment_pipeline(self) -> int:
+        """Return how many functions are built at once while earlier ones are written, 0 to build them first."""
+        return int(self.config.get("attachment_pipeline") or 0)
+
+    def write_functions(self, entries) -> list:
+        """Write the records as functions, batch_size per request, returning their outcomes.
+
+        Building a function posts the record's attachments. With
+        attachment_pipeline set, functions are built that many at a time and
+        each request is sent as soon as its functions are built, so the next
+        records' attachments are posted while the earlier ones are written.
+        """
+        outcomes = [None] * len(entries)
+
+        def build(index):
+            state_updates = dict()
+            try:
+                function = self.build_upsert_function(entries[index]["record"], state_updates)
+                return str(uuid.uuid4()), index, function, state_updates
+            except Exception as e:
+                self.logger.exception(f"Upsert record error {str(e)}")
+                state_updates["error"] = str(e)
+                outcomes[index] = (None, False, state_updates)
+
+        def groups(functions):
+            group = []
+            for function in functions:
+                if function:
+                    group.append(function)
+                if len(group) == self.batch_size:
+                    yield group
+                    group = []
+            if group:
+                yield group
+
+        def send(group):
+            try:
+                return self.request_api_batch(
+                    "POST", {controlid: function for controlid, _, function, _ in group}
+                )
+            except Exception as e:
+                return e
+
+        def handle(group, results):
+            for controlid, index, function, state_updates in group:
+                try:
+                    if isinstance(results, Exception):
+                        raise results
+                    result = results.get(controlid) or {}
+                    if result.get("status") != "success":
+                        raise FatalAPIError(result.get("errormessage") or result)
+                    outcomes[index] = self.handle_upsert_response(
+                        function, result, state_updates
+                    )
+                except Exception as e:
+                    error = self.handle_upsert_error(function, e)
+                    self.logger.exception(f"Upsert record error {str(error)}")
+                    state_updates["error"] = str(error)
+                    outcomes[index] = (None, False, state_updates)
+
+        if self.attachment_pipeline and len(entries) > 1:
+            with ThreadPoolExecutor(max_workers=self.attachment_pipeline) as builders, \
+                    ThreadPoolExecutor(max_workers=self.max_workers) as senders:
+                sent = [
+                    (group, senders.submit(send, group))
+                    for group in groups(builders.map(build, range(len(entries))))
+                ]
+                for group, results in sent:
+                    handle(group, results.result())
+        else:
+            built = list(groups(map(build, range(len(entries)))))
+            for group, results in zip(built, self.map_concurrently(send, built)):
+                handle(group, results)
+        return outcomes
@@ -1,7 +1,55 @@
+"""Real-time handler, running the target in the Lambda's own process.
+
+The target_hotglue handler runs the target CLI in a subprocess for each
+invocation, so every push logs in and loads the reference objects again.
+Here the target runs in process instead. The HTTP pool, the API sessions
+and the reference maps are kept in module scope between the warm
+invocations of a container with the same config. The reference maps are
+cleared after reference_cache_ttl seconds (default 3600). Set
+real_time_subprocess in the config to use the target_hotglue handler.
+"""
+
+import time
+
+import_started = time.perf_counter()
+
+import hashlib
 import importlib
+import io
+import json
+import logging
+from contextlib import redirect_stdout
 from logging import Logger
 
-def real_time_handler(
+from target_intacct_v3.client import IntacctSink
+from target_intacct_v3.target import TargetIntacctV3
+
+# seconds the cold start spent importing the target
+import_seconds = time.perf_counter() - import_started
+
+LOG_FORMAT = "time=%(asctime)s name=%(name)s level=%(levelname)s message=%(message)s"
+
+
+class WarmState:
+    """What a container keeps between the invocations of a config."""
+
+    def __init__(self):
+        self.http_session = None
+        self.sessions = {}
+        self.references = None
+        self.references_cleared_at = 0.0
+        self.invocations = 0
+
+
+# warm state by config hash
+warm_states = {}
+
+
+def get_config_key(config: dict) -> str:
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def subprocess_real_time_handler(
     config: dict,
     stream_name: str,
     schema_line: str,
@@ -24,3 +72,74 @@ def real_time_handler(
         logger,
         cli_cmd="target-intacct-v3",
     )
+
+
+def real_time_handler(
+    config: dict,
+    stream_name: str,
+    schema_line: str,
+    record_line: str,
+    logger: Logger,
+):
+    if config.get("real_time_subprocess"):
+        return subprocess_real_time_handler(config, stream_name, schema_line, record_line, logger)
+
+    invocation_started = time.perf_counter()
+    container_cold = not warm_states
+    key = get_config_key(config)
+    warm_start = key in warm_states
+    warm = warm_states.setdefault(key, WarmState())
+    warm.invocations += 1
+
+    # the reference maps are class level, swap in the ones of this config
+    ttl = float(config.get("reference_cache_ttl") or 3600)
+    if warm.references is not None and time.monotonic() - warm.references_cleared_at < ttl:
+        IntacctSink.set_reference_state(warm.references)
+    else:
+        IntacctSink.set_reference_state()
+        warm.references_cleared_at = time.monotonic()
+
+    logger.info(f"Running target in process: stream_name={stream_name}, warm_start={warm_start}")
+    logs = io.StringIO()
+    log_handler = logging.StreamHandler(logs)
+    log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    TargetIntacctV3.logger.addHandler(log_handler)
+    output = io.StringIO()
+    target = None
+    try:
+        with redirect_stdout(output):
+            target = TargetIntacctV3(config=dict(config))
+            if warm.http_session is not None:
+                target.http_session = warm.http_session
+            target.sessions = warm.sessions
+            target.listen(io.StringIO(f"{schema_line}\n{record_line}\n"))
+            warm.http_session = target.http_session
+    except Exception:
+        TargetIntacctV3.logger.exception(f"Real-time run of {stream_name} failed")
+    finally:
+        TargetIntacctV3.logger.removeHandler(log_handler)
+        warm.references = IntacctSink.get_reference_state()
+
+    seconds = time.perf_counter() - invocation_started
+    logger.info(
+        f"{'Warm' if warm_start else 'Cold'} real-time run of {stream_name} took {seconds:.3f}s"
+        f" (invocation {warm.invocations} of this config)"
+    )
+
+    lines = output.getvalue().splitlines()
+    try:
+        state = json.loads(lines[-1].strip())
+    except (IndexError, ValueError):
+        state = output.getvalue()
+    logs = logs.getvalue().strip()
+    return {
+        "state": state,
+        "metrics": {
+            "tracebackInLogs": "Traceback" in logs,
+            "logs": logs,
+            "warm_start": warm_start,
+            "seconds": round(seconds, 6),
+            "import_seconds": round(import_seconds, 6) if container_cold else 0.0,
+            "stages": target.metrics.summary()["streams"] if target else {},
+        },
+    }
@@ -0,0 +1,84 @@
+"""Stage timers and request counters for a target run."""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    """Thread-safe timers per stage and counters, both kept per stream.
+
+    Stages nest (a reference load includes its requests), so their times
+    are not meant to add up to the run time. Metrics are written as Singer
+    METRIC log lines to logger at level, logger is None when they are disabled.
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        # (stream, stage) -> [count, seconds, max seconds]
+        self.timers = {}
+        # (stream, metric, tags) -> count
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, stream, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stream, stage, time.perf_counter() - started)
+
+    def add_time(self, stream, stage, seconds):
+        with self.lock:
+            timer = self.timers.setdefault((stream, stage), [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def count(self, stream, metric, value=1, **tags):
+        key = (stream, metric, tuple(sorted(tags.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @property
+    def enabled(self) -> bool:
+        """Whether METRIC lines would be logged, checked before building them."""
+        return self.logger is not None and self.logger.isEnabledFor(self.level)
+
+    def emit(self, metric_type, metric, value, tags):
+        if self.enabled:
+            metric = {"type": metric_type, "metric": metric, "value": value, "tags": tags}
+            self.logger.log(self.level, "METRIC: %s", json.dumps(metric))
+
+    def summary(self) -> dict:
+        """Return the timers and counters of the run by stream."""
+        streams = {}
+        with self.lock:
+            for (stream, stage), (count, seconds, longest) in sorted(self.timers.items()):
+                stages = streams.setdefault(stream, {}).setdefault("stages", {})
+                stages[stage] = {
+                    "count": count,
+                    "seconds": round(seconds, 6),
+                    "max_seconds": round(longest, 6),
+                }
+            for (stream, metric, tags), value in sorted(self.counters.items(), key=repr):
+                counters = streams.setdefault(stream, {}).setdefault(metric, {})
+                counters[",".join(f"{k}={v}" for k, v in tags) or "total"] = value
+        return {"seconds": round(time.perf_counter() - self.started, 6), "streams": streams}
+
+    def emit_summary(self) -> None:
+        """Write the totals of the run as timer and counter metrics."""
+        with self.lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items(), key=repr)
+        for (stream, stage), (count, seconds, longest) in timers:
+            self.emit("timer", "stage_duration", round(seconds, 6), {
+                "stream": stream, "stage": stage, "count": count, "max": round(longest, 6),
+            })
+        for (stream, metric, tags), value in counters:
+            self.emit("counter", metric, value, {"stream": stream, **dict(tags)})
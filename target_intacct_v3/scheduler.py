@@ -0,0 +1,82 @@
+"""Rate limit and adaptive concurrency shared by the requests of a company."""
+
+import threading
+import time
+
+
+class RequestScheduler:
+    """Token bucket and AIMD concurrency limit for the requests to one company.
+
+    acquire blocks until fewer than limit requests are in flight and, when
+    rate is set, a token is available. Tokens refill at rate per second up
+    to burst. release lowers the limit by half on a 429, a 5xx, a failed
+    connection or a response slower than slow_seconds. Healthy responses
+    grow it back by about one request per limit responses, up to
+    max_concurrency.
+    """
+
+    def __init__(self, max_concurrency=1, rate=None, burst=None, slow_seconds=None):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst or max(1.0, self.rate or 1.0))
+        self.slow_seconds = slow_seconds
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.tokens = self.burst
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    def refill(self, now) -> None:
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def wait_time(self, now):
+        """Return how long to wait before sending, 0 to send now or None to wait for a release."""
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.rate and self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0
+
+    def acquire(self) -> float:
+        """Wait for a request slot, returning when it was granted."""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                wait = self.wait_time(now)
+                if wait == 0:
+                    self.in_flight += 1
+                    if self.rate:
+                        self.tokens -= 1
+                    return now
+                self.condition.wait(wait)
+
+    def release(self, started, status_code=None, seconds=0.0, retry_after=None) -> bool:
+        """Free the slot of a request granted at started, returning whether the limit was lowered."""
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            congested = (
+                status_code is None
+                or status_code == 429
+                or status_code >= 500
+                or (self.slow_seconds is not None and seconds > self.slow_seconds)
+            )
+            decreased = False
+            # requests sent before the last decrease saw the old limit, they don't lower it again
+            if congested and started >= self.decreased_at:
+                self.limit = max(1.0, self.limit / 2)
+                self.decreased_at = now
+                decreased = True
+            elif not congested:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+            return decreased
@@ -0,0 +1,95 @@
+"""Serialize Intacct XML gateway requests.
+
+The output is the same as xmltodict.unparse (with its default options), but
+the document is written straight into a list of strings, and the request
+envelope around the operation content is rendered once per session. The
+content is rendered on its own so its bytes can be digested for the
+request's control id.
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+
+def render(key, value, parts):
+    """Append the XML of element key with value to parts, like xmltodict does."""
+    if not hasattr(value, "__iter__") or isinstance(value, (str, dict)):
+        value = [value]
+    for v in value:
+        if v is None:
+            parts.append(f"<{key}></{key}>")
+            continue
+        if isinstance(v, bool):
+            v = "true" if v else "false"
+        elif not isinstance(v, dict):
+            v = str(v)
+        if isinstance(v, str):
+            parts.append(f"<{key}>{escape(v)}</{key}>" if v else f"<{key}></{key}>")
+            continue
+
+        start = len(parts)
+        parts.append(None)
+        attrs = []
+        cdata = None
+        for child_key, child in v.items():
+            if child_key == "#text":
+                cdata = child
+            elif child_key.startswith("@"):
+                if child_key == "@xmlns" and isinstance(child, dict):
+                    for prefix, uri in child.items():
+                        name = f"xmlns:{prefix}" if prefix else "xmlns"
+                        attrs.append(f" {name}={quoteattr(str(uri))}")
+                    continue
+                attrs.append(f" {child_key[1:]}={quoteattr(str(child))}")
+            else:
+                render(child_key, child, parts)
+        parts[start] = f"<{key}{''.join(attrs)}>"
+        if cdata:
+            parts.append(escape(cdata))
+        parts.append(f"</{key}>")
+
+
+def unparse(document) -> bytes:
+    """Return the utf-8 XML document of a dict with a single root."""
+    if len(document) != 1:
+        raise ValueError("Document must have exactly one root.")
+    parts = [XML_DECLARATION]
+    for key, value in document.items():
+        render(key, value, parts)
+    return "".join(parts).encode("utf-8")
+
+
+class RequestEnvelope:
+    """Pre-rendered request around the content of an authenticated operation."""
+
+    def __init__(self, sender_id, sender_password, session_id):
+        head = [XML_DECLARATION, "<request><control>"]
+        render("senderid", sender_id, head)
+        render("password", sender_password, head)
+        self.head = "".join(head).encode("utf-8")
+
+        middle = []
+        render("uniqueid", False, middle)
+        render("dtdversion", 3.0, middle)
+        render("includewhitespace", False, middle)
+        middle.append("</control><operation>")
+        render("authentication", {"sessionid": session_id}, middle)
+        middle.append("<content>")
+        self.middle = "".join(middle).encode("utf-8")
+        self.tail = b"</content></operation></request>"
+
+    def render_content(self, content) -> bytes:
+        """Return the xml of content, a dict of the elements inside <content>."""
+        parts = []
+        for key, value in content.items():
+            render(key, value, parts)
+        return "".join(parts).encode("utf-8")
+
+    def render(self, controlid, content_xml) -> bytes:
+        """Return the request for the rendered content."""
+        controlid_xml = []
+        render("controlid", controlid, controlid_xml)
+        return b"".join(
+            (self.head, controlid_xml[0].encode("utf-8"), self.middle, content_xml, self.tail)
+        )
@@ -12,8 +12,11 @@ class Suppliers(IntacctSink):
     """IntacctV3 target sink class."""
 
     name = "Suppliers"
+    reference_fields = {
+        "VENDOR": {"VENDORID": ["vendorNumber"], "NAME": ["vendorName"]},
+    }
 
-    def preprocess_record(self, record: dict, context: dict) -> dict:
+    def map_record(self, record: dict, context: dict) -> dict:
         try:
             # get list of vendors
             self.get_vendors()
@@ -62,7 +65,7 @@ class Suppliers(IntacctSink):
                     
                 else:
                     if doc_seq_enabled:
-                        vendor_name_count_on_intacct = list(IntacctSink.vendors_by_id.values()).count(payload["NAME"])
+                        vendor_name_count_on_intacct = IntacctSink.vendors_by_id.count_value(payload["NAME"])
                         if vendor_name_count_on_intacct == 1:
                             payload["VENDORID"] = IntacctSink.vendors.get(payload["NAME"])
                         elif vendor_name_count_on_intacct > 1:
@@ -77,32 +80,41 @@ class Suppliers(IntacctSink):
         except Exception as e:
             return {"error": e.__repr__()}
 
-    def upsert_record(self, record: dict, context: dict) -> None:
-        """Process the record."""
-        state_updates = dict()
+    def build_upsert_function(self, record: dict, state_updates: dict) -> dict:
         if record.get("error"):
             raise Exception(record["error"])
-        if record:
-            vendor_recordno = record.get("VENDOR", {}).get("RECORDNO")
-            vendor_id = record.get("VENDOR", {}).get("VENDORID")
-            if vendor_recordno or \
-                (vendor_id and IntacctSink.vendors_by_id is not None and vendor_id in IntacctSink.vendors_by_id):
-                action = "update"
-                state_updates["is_updated"] = True
-            else:
-                action = "create"
-            response = self.request_api("POST", request_data={action: record})
-            id = response["data"]["vendor"]["RECORDNO"]
-            state_updates = self.get_record_url("VENDOR", id, state_updates)
-            return id, True, state_updates
+        if not record:
+            raise Exception("Received an empty record, skipping.")
+
+        vendor_recordno = record.get("VENDOR", {}).get("RECORDNO")
+        vendor_id = record.get("VENDOR", {}).get("VENDORID")
+        if vendor_recordno or (vendor_id and self.has_reference_key("vendors_by_id", vendor_id)):
+            action = "update"
+            state_updates["is_updated"] = True
+        else:
+            action = "create"
+        return {action: record}
+
+    def handle_upsert_response(self, function: dict, response: dict, state_updates: dict):
+        id = response["data"]["vendor"]["RECORDNO"]
+        state_updates = self.get_record_url("VENDOR", id, state_updates)
+        return id, True, state_updates
 
 
 class APAdjustments(IntacctSink):
     """IntacctV3 target sink class."""
 
     name = "APAdjustment"
-
-    def preprocess_record(self, record: dict, context: dict) -> dict:
+    reference_fields = {
+        "VENDOR": {"VENDORID": ["vendorId"], "NAME": ["lineItems.vendorName"]},
+        "GLACCOUNT": {"TITLE": ["lineItems.accountName"]},
+        "PROJECT": {"NAME": ["lineItems.projectName"]},
+        "LOCATION": {"NAME": ["lineItems.locationName"]},
+        "CLASS": {"NAME": ["lineItems.className"]},
+        "DEPARTMENT": {"TITLE": ["lineItems.departmentName"]},
+    }
+
+    def map_record(self, record: dict, context: dict) -> dict:
         try:
             payload = {
                 "vendorid": record.get("vendorId"),
@@ -125,7 +137,7 @@ class APAdjustments(IntacctSink):
             self.get_vendors()
             if (
                 payload.get("vendorname")
-                and payload.get("vendorid") not in IntacctSink.vendors.values()
+                and not self.has_reference_value("vendors", payload.get("vendorid"))
             ):
                 payload["vendorid"] = IntacctSink.vendors.get(payload["vendorname"])
 
@@ -152,59 +164,46 @@ class APAdjustments(IntacctSink):
 
                 accountlabel = item.pop("accountlabel", None)
                 if accountlabel and not item.get("glaccountno"):
-                    self.get_accounts()
-                    item["glaccountno"] = IntacctSink.accounts.get(item["accountlabel"])
+                    item["glaccountno"] = self.get_reference("accounts", accountlabel)
 
                 vendorname = item.pop("vendorname", None)
                 if vendorname and not item.get("vendorid"):
-                    self.get_vendors()
-                    try:
-                        item["vendorid"] = IntacctSink.vendors[item["vendorname"]]
-                    except:
+                    item["vendorid"] = self.get_reference("vendors", vendorname)
+                    if not item["vendorid"]:
                         raise Exception(
-                            f"ERROR: vendorname {item['vendorname']} not found for this account."
+                            f"ERROR: vendorname {vendorname} not found for this account."
                         )
 
                 projectname = item.pop("projectname", None)
                 if projectname and not item.get("projectid"):
-                    self.get_projects()
-                    try:
-                        item["projectid"] = IntacctSink.projects[item["projectname"]]
-                    except:
+                    item["projectid"] = self.get_reference("projects", projectname)
+                    if not item["projectid"]:
                         raise Exception(
-                            f"ERROR: projectname {item['projectname']} not found for this account."
+                            f"ERROR: projectname {projectname} not found for this account."
                         )
 
                 locationname = item.pop("locationname", None)
                 if locationname and not item.get("locationid"):
-                    self.get_locations()
-                    try:
-                        item["locationid"] = IntacctSink.locations[item["locationname"]]
-                    except:
+                    item["locationid"] = self.get_reference("locations", locationname)
+                    if not item["locationid"]:
                         raise Exception(
-                            f"ERROR: locationname {item['locationname']} not found for this account."
+                            f"ERROR: locationname {locationname} not found for this account."
                         )
 
                 classname = item.pop("classname", None)
                 if classname and not item.get("classid"):
-                    self.get_classes()
-                    try:
-                        item["classid"] = IntacctSink.classes[item["classname"]]
-                    except:
+                    item["classid"] = self.get_reference("classes", classname)
+                    if not item["classid"]:
                         raise Exception(
-                            f"ERROR: classname {item['classname']} not found for this account."
+                            f"ERROR: classname {classname} not found for this account."
                         )
 
                 departmentname = item.pop("departmentname", None)
                 if departmentname and not item.get("departmentid"):
-                    self.get_departments()
-                    try:
-                        item["departmentid"] = IntacctSink.departments[
-                            item["departmentname"]
-                        ]
-                    except:
+                    item["departmentid"] = self.get_reference("departments", departmentname)
+                    if not item["departmentid"]:
                         raise Exception(
-                            f"ERROR: departmentname {item['departmentname']} not found for this account."
+                            f"ERROR: departmentname {departmentname} not found for this account."
                         )
 
                 payload["apadjustmentitems"]["lineitem"].append(item)
@@ -214,27 +213,34 @@ class APAdjustments(IntacctSink):
         except Exception as e:
             return {"error": e.__repr__()}
 
-    def upsert_record(self, record: dict, context: dict) -> None:
-        """Process the record."""
-        state_updates = dict()
+    def build_upsert_function(self, record: dict, state_updates: dict) -> dict:
         if record.get("error"):
             raise Exception(record["error"])
-        if record:
-            response = self.request_api(
-                "POST", request_data={"create_apadjustment": record}
-            )
-            id = response["key"]
+        if not record:
+            raise Exception("Received an empty record, skipping.")
+        return {"create_apadjustment": record}
+
+    def handle_upsert_response(self, function: dict, response: dict, state_updates: dict):
+        id = response["key"]
 
-            state_updates = self.get_record_url("APADJUSTMENT", id, state_updates)
-            return id, True, state_updates
+        state_updates = self.get_record_url("APADJUSTMENT", id, state_updates)
+        return id, True, state_updates
 
 
 class JournalEntries(IntacctSink):
     """IntacctV3 target sink class."""
 
     name = "JournalEntries"
-
-    def preprocess_record(self, record: dict, context: dict) -> dict:
+    reference_fields = {
+        "GLACCOUNT": {"ACCOUNTNO": ["lines.accountNumber"], "TITLE": ["lines.ACCOUNTNAME"]},
+        "DEPARTMENT": {"TITLE": ["lines.departmentName", "lines.department"]},
+        "LOCATION": {"NAME": ["lines.locationName"]},
+        "CLASS": {"NAME": ["lines.className"]},
+        "CUSTOMER": {"NAME": ["lines.customerName"]},
+        "VENDOR": {"NAME": ["lines.vendorName"]},
+    }
+
+    def map_record(self, record: dict, context: dict) -> dict:
         try:
             payload = {
                 "JOURNAL": record.get("type"),
@@ -266,41 +272,34 @@ class JournalEntries(IntacctSink):
                 accountname = je.get("ACCOUNTNAME", None)
                 if (
                     accountname
-                    and item.get("ACCOUNTNO") not in IntacctSink.accounts.values()
+                    and not self.has_reference_value("accounts", item.get("ACCOUNTNO"))
                 ):
-                    try:
-                        item["ACCOUNTNO"] = IntacctSink.accounts.get(
-                            item["ACCOUNTNAME"]
-                        )
-                    except:
+                    account_number = item.get("ACCOUNTNO")
+                    item["ACCOUNTNO"] = self.get_reference("accounts", accountname)
+                    if not item["ACCOUNTNO"]:
                         return {
-                            "error": f"ACCOUNTNO '{item.get('ACCOUNTNO')}' and ACCOUNTNAME '{accountname}' were not found or invalid for this account. \n Intacct Requires an ACCOUNTNO associated with each line item"
+                            "error": f"ACCOUNTNO '{account_number}' and ACCOUNTNAME '{accountname}' were not found or invalid for this account. \n Intacct Requires an ACCOUNTNO associated with each line item"
                         }
 
                 departmentname = je.get("departmentName", je.get("department", None))
                 if departmentname and not item.get("DEPARTMENT"):
-                    self.get_departments()
-                    item["DEPARTMENT"] = IntacctSink.departments.get(departmentname)
+                    item["DEPARTMENT"] = self.get_reference("departments", departmentname)
 
                 locationname = je.get("locationName")
                 if locationname and not item.get("LOCATION"):
-                    self.get_locations()
-                    item["LOCATION"] = IntacctSink.locations.get(locationname)
+                    item["LOCATION"] = self.get_reference("locations", locationname)
 
                 classname = je.get("className")
                 if classname and not item.get("CLASSID"):
-                    self.get_classes()
-                    item["CLASSID"] = IntacctSink.classes.get(classname)
+                    item["CLASSID"] = self.get_reference("classes", classname)
 
                 customername = je.get("customerName")
                 if customername and not item.get("CUSTOMERID"):
-                    self.get_customers()
-                    item["CUSTOMERID"] = IntacctSink.customers.get(customername)
+                    item["CUSTOMERID"] = self.get_reference("customers", customername)
 
                 vendorname = je.get("vendorName")
                 if vendorname and not item.get("VENDORID"):
-                    self.get_vendors()
-                    item["VENDORID"] = IntacctSink.vendors.get(vendorname)
+                    item["VENDORID"] = self.get_reference("vendors", vendorname)
 
                 payload["ENTRIES"]["GLENTRY"].append(item)
 
@@ -309,25 +308,59 @@ class JournalEntries(IntacctSink):
         except Exception as e:
             return {"error": e.__repr__()}
 
-    def upsert_record(self, record: dict, context: dict) -> None:
-        """Process the record."""
-        state_updates = dict()
+    def build_upsert_function(self, record: dict, state_updates: dict) -> dict:
         if record.get("error"):
             raise Exception(record["error"])
-        if record:
-            response = self.request_api("POST", request_data={"create": record})
-            id = response["data"]["glbatch"]["RECORDNO"]
+        if not record:
+            raise Exception("Received an empty record, skipping.")
+        return {"create": record}
+
+    def handle_upsert_response(self, function: dict, response: dict, state_updates: dict):
+        id = response["data"]["glbatch"]["RECORDNO"]
 
-            state_updates = self.get_record_url("GLBATCH", id, state_updates)
-            return id, True, state_updates
+        state_updates = self.get_record_url("GLBATCH", id, state_updates)
+        return id, True, state_updates
 
 
 class Bills(IntacctSink):
     """IntacctV3 target sink class."""
 
     name = "Bills"
-
-    def preprocess_record(self, record: dict, context: dict) -> dict:
+    reference_fields = {
+        "VENDOR": {
+            "NAME": ["vendorName", "lineItems.vendorName", "expenses.vendorName"],
+            "VENDORID": ["vendorNum"],
+        },
+        "LOCATION": {"NAME": ["location"]},
+        "CLASS": {"NAME": ["lineItems.className", "expenses.className"]},
+        "GLACCOUNT": {
+            "ACCOUNTNO": ["lineItems.accountNumber", "expenses.accountNumber"],
+            "TITLE": ["lineItems.accountName", "expenses.accountName"],
+        },
+        "DEPARTMENT": {
+            "TITLE": [
+                "lineItems.department",
+                "lineItems.departmentName",
+                "expenses.department",
+                "expenses.departmentName",
+            ],
+        },
+    }
+
+    def prefetch_records(self, records: list) -> None:
+        # look up the bills matching RECORDID and VENDORID for the whole batch
+        keys = []
+        for record in records:
+            vendor_id = record.get("vendorId")
+            if not vendor_id and record.get("vendorName"):
+                vendor_id = self.get_reference("vendors", record["vendorName"])
+            if not vendor_id and self.has_reference_value("vendors", record.get("vendorNum")):
+                vendor_id = record["vendorNum"]
+            keys.append((record.get("invoiceNumber"), vendor_id))
+        self.prefetch_bills(["RECORDNO"], keys=keys)
+        self.prefetch_line_lookups(records, ["lineItems", "expenses"])
+
+    def map_record(self, record: dict, context: dict) -> dict:
         try:
             # Map bill
             payload = {
@@ -348,18 +381,15 @@ class Bills(IntacctSink):
             # look for vendorName, vendorNumber and vendorId
             vendorname = record.get("vendorName")
             if vendorname and not payload.get("VENDORID"):
-                self.get_vendors()
-                try:
-                    payload["VENDORID"] = IntacctSink.vendors[vendorname]
-                except:
+                payload["VENDORID"] = self.get_reference("vendors", vendorname)
+                if not payload["VENDORID"]:
                     return {
                         "error": f"ERROR: Vendor {vendorname} does not exist. Did you mean any of these: {list(IntacctSink.vendors.keys())}?"
                     }
 
             vendor_number = record.get("vendorNum")
             if not payload.get("VENDORID") and vendor_number:
-                self.get_vendors()
-                if vendor_number in IntacctSink.vendors.values():
+                if self.has_reference_value("vendors", vendor_number):
                     payload["VENDORID"] = vendor_number
                 else:
                     return {
@@ -384,25 +414,10 @@ class Bills(IntacctSink):
 
             # check if bill exists matching RECORDID and VENDORID
             if payload.get("RECORDID"):
-                existing_bill = self.get_records(
-                    "APBILL",
-                    fields=["RECORDNO"],
-                    filter={
-                        "filter": {
-                            "and": {
-                                "equalto": [
-                                    {
-                                        "field": "RECORDID",
-                                        "value": payload.get("RECORDID"),
-                                    },
-                                    {
-                                        "field": "VENDORID",
-                                        "value": payload.get("VENDORID", ""),
-                                    }
-                                ]
-                            }
-                        }
-                    },
+                existing_bill = self.get_existing_bill(
+                    ["RECORDNO"],
+                    record_id=payload.get("RECORDID"),
+                    vendor_id=payload.get("VENDORID", ""),
                 )
                 if existing_bill:
                     payload["RECORDNO"] = existing_bill[0].get("RECORDNO")
@@ -410,10 +425,8 @@ class Bills(IntacctSink):
             # include locationid at header level
             locationname = record.get("location")
             if locationname and not payload.get("LOCATIONID"):
-                self.get_locations()
-                try:
-                    payload["LOCATIONID"] = IntacctSink.locations[locationname]
-                except:
+                payload["LOCATIONID"] = self.get_reference("locations", locationname)
+                if not payload["LOCATIONID"]:
                     return {
                         "error": f"ERROR: Location '{locationname}' does not exist. Did you mean any of these: {list(IntacctSink.locations.keys())}?"
                     }
@@ -434,15 +447,14 @@ class Bills(IntacctSink):
                 }
 
                 if line.get("vendorName") and not item.get("VENDORID"):
-                    self.get_vendors()
-                    item["VENDORID"] = IntacctSink.vendors[line["vendorName"]]
+                    item["VENDORID"] = self.get_reference("vendors", line["vendorName"])
+                    if not item["VENDORID"]:
+                        raise KeyError(line["vendorName"])
 
                 class_name = line.get("className")
                 if class_name and not item.get("CLASSID"):
-                    self.get_classes()
-                    try:
-                        item["CLASSID"] = IntacctSink.classes[class_name]
-                    except:
+                    item["CLASSID"] = self.get_reference("classes", class_name, refresh=False)
+                    if not item["CLASSID"]:
                         self.logger.info(
                             f"Skipping class due Class {class_name} does not exist. Did you mean any of these: {list(IntacctSink.classes.keys())}?"
                         )
@@ -455,11 +467,11 @@ class Bills(IntacctSink):
                 if account_id:
                     item["ACCOUNTNO"] = self.get_account_no_by_account_id(account_id)
                     
-                elif account_number and account_number in IntacctSink.accounts.values():
+                elif account_number and self.has_reference_value("accounts", account_number):
                     item["ACCOUNTNO"] = account_number
 
-                elif account_name and account_name in IntacctSink.accounts:
-                    item["ACCOUNTNO"] = IntacctSink.accounts.get(account_name)
+                elif account_name:
+                    item["ACCOUNTNO"] = self.get_reference("accounts", account_name)
                     
                 if not item.get("ACCOUNTNO"):
                     return {
@@ -470,10 +482,9 @@ class Bills(IntacctSink):
                 department = line.get("department")
                 department_name = line.get("departmentName")
                 if department or department_name:
-                    self.get_departments()
-                    item["DEPARTMENTID"] = IntacctSink.departments.get(
-                        department
-                    ) or IntacctSink.departments.get(department_name)
+                    item["DEPARTMENTID"] = self.get_reference(
+                        "departments", department
+                    ) or self.get_reference("departments", department_name)
                 payload["APBILLITEMS"]["APBILLITEM"].append(item)
 
                 # get employee id
@@ -489,9 +500,13 @@ class Bills(IntacctSink):
         except Exception as e:
             return {"error": e.__repr__()}
 
-    def upsert_record(self, record: dict, context: dict) -> None:
-        """Process the record."""
-        state_updates = {}
+    def get_write_key(self, record: dict):
+        # a later record of the same RECORDID and VENDORID updates the bill this one creates
+        bill = ((record or {}).get("payload") or {}).get("APBILL") or {}
+        if bill.get("RECORDID") and bill.get("VENDORID"):
+            return str(bill["RECORDID"]), str(bill["VENDORID"])
+
+    def build_upsert_function(self, record: dict, state_updates: dict) -> dict:
         if not record:
             raise Exception("Received an empty record, skipping.")
 
@@ -501,7 +516,6 @@ class Bills(IntacctSink):
         payload, attachments = record.values()
         record_id = payload.get("APBILL",{}).get("RECORDID","")
         # post/update attachments if exist
-        supdoc_id = None
         if attachments:
             if not record_id:
                 self.logger.error("No RECORDID found in the payload. Skipping sending attachments as no pk was found to create the folder and/or supdoc.")
@@ -513,37 +527,76 @@ class Bills(IntacctSink):
                 raise
 
         # post/update bill
-        try:
-            # post/update bill
-            action = "update" if payload["APBILL"].get("RECORDNO") else "create"
-            response = self.request_api("POST", request_data={action: payload})
-            bill_id = response["data"]["apbill"]["RECORDNO"]
+        action = "update" if payload["APBILL"].get("RECORDNO") else "create"
+        return {action: payload}
 
-            state_updates = self.get_record_url("APBILL", bill_id, state_updates)
+    def handle_upsert_response(self, function: dict, response: dict, state_updates: dict):
+        action = next(iter(function))
+        bill_id = response["data"]["apbill"]["RECORDNO"]
 
-            self.logger.info(f"Successfully {action}d bill with RECORDNO {bill_id}")
-            return bill_id, True, state_updates
-        except Exception as e:
-            self.logger.error(f"Failed to {action} bill with RECORDID {record_id}: {e}")
+        state_updates = self.get_record_url("APBILL", bill_id, state_updates)
 
-            # if bill is new and attachments were sent delete the sent attachments
-            if supdoc_id and action == "create":
-                try:
-                    self.logger.info(
-                        f"Deleting attachments for failed bill creation with RECORDID {record_id}..."
-                    )
-                    self.request_api("POST", request_data={"delete_supdoc": {"@key": supdoc_id}})
-                except Exception as delete_error:
-                    self.logger.error(f"Failed to delete attachments with SUPDOCID {supdoc_id}: {delete_error}")
-            raise Exception(f"Failed to {action} bill: {e}")
+        self.logger.info(f"Successfully {action}d bill with RECORDNO {bill_id}")
+        return bill_id, True, state_updates
+
+    def handle_upsert_error(self, function: dict, error: Exception) -> Exception:
+        action, payload = next(iter(function.items()))
+        record_id = payload["APBILL"].get("RECORDID", "")
+        supdoc_id = payload["APBILL"].get("SUPDOCID")
+        self.logger.error(f"Failed to {action} bill with RECORDID {record_id}: {error}")
+
+        # if bill is new and attachments were sent delete the sent attachments
+        if supdoc_id and action == "create":
+            try:
+                self.logger.info(
+                    f"Deleting attachments for failed bill creation with RECORDID {record_id}..."
+                )
+                self.delete_attachments(supdoc_id)
+            except Exception as delete_error:
+                self.logger.error(f"Failed to delete attachments with SUPDOCID {supdoc_id}: {delete_error}")
+        return Exception(f"Failed to {action} bill: {error}")
 
 
 class PurchaseInvoices(IntacctSink):
     """IntacctV3 target sink class."""
 
     name = "PurchaseInvoices"
-
-    def preprocess_record(self, record: dict, context: dict) -> dict:
+    reference_fields = {
+        "VENDOR": {
+            "RECORDNO": ["supplierId", "lineItems.supplierId"],
+            "NAME": ["supplierName", "lineItems.supplierName"],
+            "VENDORID": ["vendorNum"],
+        },
+        "LOCATION": {"NAME": ["location", "addresses.name", "lineItems.location"]},
+        "CLASS": {"NAME": ["lineItems.className"]},
+        "GLACCOUNT": {"ACCOUNTNO": ["lineItems.accountNumber"], "TITLE": ["lineItems.accountName"]},
+        "DEPARTMENT": {
+            "RECORDNO": ["lineItems.departmentId"],
+            "TITLE": ["lineItems.department", "lineItems.departmentName"],
+        },
+        "PROJECT": {"NAME": ["lineItems.projectName"]},
+        "ITEM": {"NAME": ["lineItems.productName"]},
+    }
+
+    def prefetch_records(self, records: list) -> None:
+        # look up the bills matching RECORDNO, or RECORDID and VENDORID, for the whole batch
+        keys, recordnos = [], []
+        for record in records:
+            if record.get("id"):
+                recordnos.append(record["id"])
+                continue
+            vendor_id = record.get("supplierCode", record.get("supplierNumber"))
+            if record.get("supplierId"):
+                vendor_id = self.get_reference("vendors_recordno", str(record["supplierId"]))
+            if not vendor_id and record.get("supplierName"):
+                vendor_id = self.get_reference("vendors", record["supplierName"])
+            if not vendor_id and self.has_reference_value("vendors", record.get("vendorNum")):
+                vendor_id = record["vendorNum"]
+            keys.append((record.get("invoiceNumber"), vendor_id))
+        self.prefetch_bills(["RECORDNO", "STATE"], keys=keys, recordnos=recordnos)
+        self.prefetch_line_lookups(records, ["lineItems"])
+
+    def map_record(self, record: dict, context: dict) -> dict:
         bill_state = None
         try:
             # Map bill
@@ -565,9 +618,8 @@ class PurchaseInvoices(IntacctSink):
             }
 
             if record.get("supplierId"):
-                self.get_vendors()
                 supplier_recordno = str(record.get("supplierId"))
-                vendor_id = IntacctSink.vendors_recordno.get(supplier_recordno)
+                vendor_id = self.get_reference("vendors_recordno", supplier_recordno)
                 if not vendor_id:
                     return {
                         "error": f"ERROR: Vendor with RECORDNO '{supplier_recordno}' does not exist."
@@ -577,18 +629,15 @@ class PurchaseInvoices(IntacctSink):
             # look for vendorName, vendorNumber and vendorId
             vendorname = record.get("supplierName")
             if vendorname and not payload.get("VENDORID"):
-                self.get_vendors()
-                try:
-                    payload["VENDORID"] = IntacctSink.vendors[vendorname]
-                except:
+                payload["VENDORID"] = self.get_reference("vendors", vendorname)
+                if not payload["VENDORID"]:
                     return {
                         "error": f"ERROR: Vendor {vendorname} does not exist. Did you mean any of these: {list(IntacctSink.vendors.keys())}?"
                     }
 
             vendor_number = record.get("vendorNum")
             if not payload.get("VENDORID") and vendor_number:
-                self.get_vendors()
-                if vendor_number in IntacctSink.vendors.values():
+                if self.has_reference_value("vendors", vendor_number):
                     payload["VENDORID"] = vendor_number
                 else:
                     return {
@@ -612,38 +661,17 @@ class PurchaseInvoices(IntacctSink):
 
             if not payload.get("RECORDNO"):
                 # check if bill exists matching RECORDID and VENDORID
-                existing_bill = self.get_records(
-                    "APBILL",
-                    fields=["RECORDNO", "STATE"],
-                    filter={
-                        "filter": {
-                            "and": {
-                                "equalto": [
-                                    {
-                                        "field": "RECORDID",
-                                        "value": payload.get("RECORDID"),
-                                    },
-                                    {
-                                        "field": "VENDORID",
-                                        "value": payload.get("VENDORID", ""),
-                                    }
-                                ]
-                            }
-                        }
-                    },
+                existing_bill = self.get_existing_bill(
+                    ["RECORDNO", "STATE"],
+                    record_id=payload.get("RECORDID"),
+                    vendor_id=payload.get("VENDORID", ""),
                 )
                 if existing_bill:
                     payload["RECORDNO"] = existing_bill[0].get("RECORDNO")
                     bill_state = existing_bill[0].get("STATE")
             else:
-                existing_bill = self.get_records(
-                    "APBILL",
-                    fields=["RECORDNO", "STATE"],
-                    filter={
-                        "filter": {
-                            "equalto": {"field": "RECORDNO", "value": payload.get("RECORDNO")}
-                        }
-                    },
+                existing_bill = self.get_existing_bill(
+                    ["RECORDNO", "STATE"], recordno=payload.get("RECORDNO")
                 )
 
                 if not existing_bill:
@@ -657,10 +685,8 @@ class PurchaseInvoices(IntacctSink):
             address_location = address[0].get("name") if address else None
             locationname = record.get("location") or address_location
             if locationname and not payload.get("LOCATIONID"):
-                self.get_locations()
-                try:
-                    payload["LOCATIONID"] = IntacctSink.locations[locationname]
-                except:
+                payload["LOCATIONID"] = self.get_reference("locations", locationname)
+                if not payload["LOCATIONID"]:
                     return {
                         "error": f"ERROR: Location '{locationname}' does not exist. Did you mean any of these: {list(IntacctSink.locations.keys())}?"
                     }
@@ -683,9 +709,8 @@ class PurchaseInvoices(IntacctSink):
                     }
 
                     if line.get("supplierId"):
-                        self.get_vendors()
                         supplier_recordno = str(line.get("supplierId"))
-                        vendor_id = IntacctSink.vendors_recordno.get(supplier_recordno)
+                        vendor_id = self.get_reference("vendors_recordno", supplier_recordno)
                         if not vendor_id:
                             return {
                                 "error": f"ERROR: Vendor with RECORDNO '{supplier_recordno}' does not exist."
@@ -693,15 +718,14 @@ class PurchaseInvoices(IntacctSink):
                         item["VENDORID"] = vendor_id
 
                     if line.get("supplierName") and not item.get("VENDORID"):
-                        self.get_vendors()
-                        item["VENDORID"] = IntacctSink.vendors[line["supplierName"]]
+                        item["VENDORID"] = self.get_reference("vendors", line["supplierName"])
+                        if not item["VENDORID"]:
+                            raise KeyError(line["supplierName"])
 
                     class_name = line.get("className")
                     if class_name and not item.get("CLASSID"):
-                        self.get_classes()
-                        try:
-                            item["CLASSID"] = IntacctSink.classes[class_name]
-                        except:
+                        item["CLASSID"] = self.get_reference("classes", class_name, refresh=False)
+                        if not item["CLASSID"]:
                             self.logger.info(
                                 f"Skipping class because Class {class_name} does not exist. Did you mean any of these: {list(IntacctSink.classes.keys())}?"
                             )
@@ -714,11 +738,11 @@ class PurchaseInvoices(IntacctSink):
                     if account_id:
                         item["ACCOUNTNO"] = self.get_account_no_by_account_id(account_id)
                         
-                    elif account_number and account_number in IntacctSink.accounts.values():
+                    elif account_number and self.has_reference_value("accounts", account_number):
                         item["ACCOUNTNO"] = account_number
                         
-                    elif account_name and account_name in IntacctSink.accounts:
-                        item["ACCOUNTNO"] = IntacctSink.accounts.get(account_name)
+                    elif account_name:
+                        item["ACCOUNTNO"] = self.get_reference("accounts", account_name)
                         
                     if not item.get("ACCOUNTNO"):
                         return {
@@ -730,24 +754,21 @@ class PurchaseInvoices(IntacctSink):
                     department = line.get("department")
                     department_name = line.get("departmentName")
                     if department_id:
-                        self.get_departments()
                         dept_recordno = str(department_id)
-                        department_id_value = IntacctSink.departments_recordno.get(dept_recordno)
+                        department_id_value = self.get_reference("departments_recordno", dept_recordno)
                         if not department_id_value:
                             return {
                                 "error": f"ERROR: Department with RECORDNO '{dept_recordno}' does not exist."
                             }
                         item["DEPARTMENTID"] = department_id_value
                     elif department or department_name:
-                        self.get_departments()
-                        item["DEPARTMENTID"] = IntacctSink.departments.get(
-                            department
-                        ) or IntacctSink.departments.get(department_name)
+                        item["DEPARTMENTID"] = self.get_reference(
+                            "departments", department
+                        ) or self.get_reference("departments", department_name)
 
                     location_name = line.get("location")
                     if location_name and not item["LOCATIONID"]:
-                        self.get_locations()
-                        item["LOCATIONID"] = IntacctSink.locations.get(location_name)
+                        item["LOCATIONID"] = self.get_reference("locations", location_name)
                         if not item["LOCATIONID"]:
                             return {
                                 "error": f"Location '{location_name}' does not exist or is inactive. Did you mean any of these: {list(self.locations.keys())}?"
@@ -757,13 +778,11 @@ class PurchaseInvoices(IntacctSink):
 
                     project_name = line.get("projectName")
                     if project_name and not item["PROJECTID"]:
-                        self.get_projects()
-                        item["PROJECTID"] = IntacctSink.projects.get(project_name)
+                        item["PROJECTID"] = self.get_reference("projects", project_name)
 
                     item_name = line.get("productName")
                     if item_name:
-                        self.get_items()
-                        item["ITEMID"] = IntacctSink.items.get(item_name)
+                        item["ITEMID"] = self.get_reference("items", item_name)
 
                     # add custom fields to the item payload
                     custom_fields = parse_objs(line.get("customFields", "[]"))
@@ -790,10 +809,13 @@ class PurchaseInvoices(IntacctSink):
         except Exception as e:
             return {"error": e.__repr__()}
 
-    def upsert_record(self, record: dict, context: dict) -> None:
-        """Process the record."""
-        state_updates = {}
+    def get_write_key(self, record: dict):
+        # a later record of the same RECORDID and VENDORID updates the bill this one creates
+        bill = ((record or {}).get("payload") or {}).get("APBILL") or {}
+        if bill.get("RECORDID") and bill.get("VENDORID"):
+            return str(bill["RECORDID"]), str(bill["VENDORID"])
 
+    def build_upsert_function(self, record: dict, state_updates: dict) -> dict:
         if not record:
             raise Exception("Received an empty record, skipping.")
 
@@ -807,7 +829,6 @@ class PurchaseInvoices(IntacctSink):
             raise KeyError(f"Missing expected key in record: {e}")
         
         # post/update attachments if exist
-        supdoc_id = None
         if attachments:
             if not record_id:
                 self.logger.error("No RECORDID found in the payload. Skipping sending attachments as no pk was found to create the folder and/or supdoc.")
@@ -820,28 +841,34 @@ class PurchaseInvoices(IntacctSink):
                 raise
 
         # post/update bill
-        try:
-            action = "update" if payload["APBILL"].get("RECORDNO") else "create"
-            response = self.request_api("POST", request_data={action: payload})
-            bill_id = response["data"]["apbill"]["RECORDNO"]
+        action = "update" if payload["APBILL"].get("RECORDNO") else "create"
+        return {action: payload}
 
-            state_updates = self.get_record_url("APBILL", bill_id, state_updates)
+    def handle_upsert_response(self, function: dict, response: dict, state_updates: dict):
+        action = next(iter(function))
+        bill_id = response["data"]["apbill"]["RECORDNO"]
 
-            # Step 3: Log success and return the bill ID, success status, and state updates
-            self.logger.info(f"Successfully {action}d bill with RECORDNO {bill_id}")
-            return bill_id, True, state_updates
-        except Exception as e:
-            self.logger.error(f"Failed to {action} bill with RECORDID {record_id}: {e}")
-
-            # Step 4: If bill creation failed and attachments were sent, delete the attachments
-            if supdoc_id and action == "create":
-                try:
-                    self.logger.info(f"Deleting attachments for failed bill creation with RECORDID {record_id}...")
-                    self.request_api("POST", request_data={"delete_supdoc": {"@key": supdoc_id}})
-                except Exception as delete_error:
-                    self.logger.error(f"Failed to delete attachments with SUPDOCID {supdoc_id}: {delete_error}")
-            
-            raise Exception(f"Failed to {action} bill: {e}")
+        state_updates = self.get_record_url("APBILL", bill_id, state_updates)
+
+        # Log success and return the bill ID, success status, and state updates
+        self.logger.info(f"Successfully {action}d bill with RECORDNO {bill_id}")
+        return bill_id, True, state_updates
+
+    def handle_upsert_error(self, function: dict, error: Exception) -> Exception:
+        action, payload = next(iter(function.items()))
+        record_id = payload["APBILL"].get("RECORDID", None)
+        supdoc_id = payload["APBILL"].get("SUPDOCID")
+        self.logger.error(f"Failed to {action} bill with RECORDID {record_id}: {error}")
+
+        # If bill creation failed and attachments were sent, delete the attachments
+        if supdoc_id and action == "create":
+            try:
+                self.logger.info(f"Deleting attachments for failed bill creation with RECORDID {record_id}...")
+                self.delete_attachments(supdoc_id)
+            except Exception as delete_error:
+                self.logger.error(f"Failed to delete attachments with SUPDOCID {supdoc_id}: {delete_error}")
+
+        return Exception(f"Failed to {action} bill: {error}")
 
 
 class BillPayment(IntacctSink):
@@ -850,7 +877,7 @@ class BillPayment(IntacctSink):
     name = "BillPayment"
 
 
-    def preprocess_record(self, record: dict, context: dict) -> dict:
+    def map_record(self, record: dict, context: dict) -> dict:
         if not record.get("billId"):
             return {"error": "billId is a required field"}
 
@@ -905,25 +932,34 @@ class BillPayment(IntacctSink):
         return {"APPYMT": payload}
 
 
-    def upsert_record(self, record: dict, context: dict) -> None:
-        """Process the record."""
-        state_updates = dict()
+    def build_upsert_function(self, record: dict, state_updates: dict) -> dict:
         if record.get("error"):
             raise Exception(record["error"])
+        if not record:
+            raise Exception("Received an empty record, skipping.")
+        return {"create": record}
 
-        if record:
-            response = self.request_api("POST", request_data={"create": record})
-            id = response["data"]["appymt"]["RECORDNO"]
+    def handle_upsert_response(self, function: dict, response: dict, state_updates: dict):
+        id = response["data"]["appymt"]["RECORDNO"]
 
-            state_updates = self.get_record_url("APPYMT", id, state_updates)
-            return id, True, state_updates
+        state_updates = self.get_record_url("APPYMT", id, state_updates)
+        return id, True, state_updates
 
 class PurchaseOrders(IntacctSink):
     """IntacctV3 target sink class."""
 
     name = "PurchaseOrders"
-
-    def preprocess_record(self, record: dict, context: dict) -> dict:
+    reference_fields = {
+        "VENDOR": {"NAME": ["vendorName"]},
+        "PROJECT": {"NAME": ["lineItems.projectName"]},
+        "LOCATION": {"NAME": ["lineItems.locationName"]},
+        "CLASS": {"NAME": ["lineItems.className"]},
+        "DEPARTMENT": {"TITLE": ["lineItems.departmentName"]},
+    }
+    # the PO key returned by the write needs a follow up query per record
+    batchable = False
+
+    def map_record(self, record: dict, context: dict) -> dict:
         try:
             # Map purchase order
             payload = {
@@ -992,10 +1028,8 @@ class PurchaseOrders(IntacctSink):
             # look for vendorName and vendorId
             vendor_name = record.get("vendorName")
             if vendor_name and not payload.get("vendorid"):
-                self.get_vendors()
-                try:
-                    payload["vendorid"] = IntacctSink.vendors[vendor_name]
-                except:
+                payload["vendorid"] = self.get_reference("vendors", vendor_name)
+                if not payload["vendorid"]:
                     return {
                         "error": f"ERROR: Vendor {vendor_name} does not exist. Did you mean any of these: {list(IntacctSink.vendors.keys())}?"
                     }
@@ -1025,40 +1059,32 @@ class PurchaseOrders(IntacctSink):
 
                 project_name = item.pop("projectName", None)
                 if project_name and not item_payload.get("projectid"):
-                    self.get_projects()
-                    try:
-                        item_payload["projectid"] = IntacctSink.projects[project_name]
-                    except:
+                    item_payload["projectid"] = self.get_reference("projects", project_name)
+                    if not item_payload["projectid"]:
                         raise Exception(
                             f"ERROR: projectname {project_name} not found for this account."
                         )
 
                 location_name = item.pop("locationName", None)
                 if location_name and not item_payload.get("locationid"):
-                    self.get_locations()
-                    try:
-                        item_payload["locationid"] = IntacctSink.locations[location_name]
-                    except:
+                    item_payload["locationid"] = self.get_reference("locations", location_name)
+                    if not item_payload["locationid"]:
                         raise Exception(
                             f"ERROR: locationname {location_name} not found for this account."
                         )
 
                 class_name = item.pop("className", None)
                 if class_name and not item_payload.get("classid"):
-                    self.get_classes()
-                    try:
-                        item_payload["classid"] = IntacctSink.classes[class_name]
-                    except:
+                    item_payload["classid"] = self.get_reference("classes", class_name)
+                    if not item_payload["classid"]:
                         raise Exception(
                             f"ERROR: classname {class_name} not found for this account."
                         )
 
                 department_name = item.pop("departmentName", None)
                 if department_name and not item_payload.get("departmentid"):
-                    self.get_departments()
-                    try:
-                        item_payload["departmentid"] = IntacctSink.departments[department_name]
-                    except:
+                    item_payload["departmentid"] = self.get_reference("departments", department_name)
+                    if not item_payload["departmentid"]:
                         raise Exception(
                             f"ERROR: departmentname {department_name} not found for this account."
                         )
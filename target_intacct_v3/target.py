@@ -1,7 +1,18 @@
 """IntacctV3 target class."""
+import json
+import logging
+import threading
+from pathlib import Path
+
+import requests
+from backports.cached_property import cached_property
+from requests.adapters import HTTPAdapter
 from singer_sdk import typing as th
 from target_hotglue.target import TargetHotglue
 
+from target_intacct_v3.client import IntacctSink
+from target_intacct_v3.metrics import RunMetrics
+from target_intacct_v3.scheduler import RequestScheduler
 from target_intacct_v3.sinks import (
     APAdjustments,
     Bills,
@@ -11,14 +22,13 @@ from target_intacct_v3.sinks import (
     BillPayment,
     PurchaseOrders,
 )
+from target_intacct_v3.util import MemoryBudget, SupdocIndex
 
 
 class TargetIntacctV3(TargetHotglue):
     """Sample target for IntacctV3."""
 
     name = "target-intacct-v3"
-    session_timeout = None
-    session_id = None
     config_jsonschema = th.PropertiesList(
         th.Property(
             "company_id",
@@ -44,9 +54,227 @@ class TargetIntacctV3(TargetHotglue):
             "use_locations",
             th.BooleanType,
         ),
+        th.Property(
+            "base_url",
+            th.StringType,
+            description="XML gateway url. Defaults to the Intacct production gateway.",
+        ),
+        th.Property(
+            "batch_size",
+            th.IntegerType,
+            description="Number of records written per multi-function request. Defaults to 1 (one request per record).",
+        ),
+        th.Property(
+            "max_workers",
+            th.IntegerType,
+            description="Number of requests each sink may have in flight at once. Defaults to 1 (records are written in order, one at a time).",
+        ),
+        th.Property(
+            "page_size",
+            th.IntegerType,
+            description="Number of rows requested per query page. Defaults to 1000.",
+        ),
+        th.Property(
+            "page_workers",
+            th.IntegerType,
+            description="Number of query pages fetched at once after the first page. Defaults to 1.",
+        ),
+        th.Property(
+            "reference_cache_path",
+            th.StringType,
+            description="Directory where reference objects (vendors, accounts, ...) are cached between runs. Caching is disabled when unset.",
+        ),
+        th.Property(
+            "reference_cache_ttl",
+            th.NumberType,
+            description="Seconds a cached reference object stays valid. Defaults to 3600.",
+        ),
+        th.Property(
+            "reference_refresh_on_miss",
+            th.BooleanType,
+            description="Query the rows modified since the last load when a reference lookup misses. Defaults to true.",
+        ),
+        th.Property(
+            "reference_refresh_interval",
+            th.NumberType,
+            description="Seconds after a refresh of a reference object during which misses don't refresh it again. Defaults to 60.",
+        ),
+        th.Property(
+            "reference_load_mode",
+            th.StringType,
+            description="auto, full or targeted. targeted loads only the reference rows a batch looks up. auto picks it for large objects. Defaults to auto.",
+        ),
+        th.Property(
+            "reference_targeted_min_count",
+            th.IntegerType,
+            description="Records a reference object needs before auto mode loads it by value. Defaults to 5000.",
+        ),
+        th.Property(
+            "lookup_cache_size",
+            th.IntegerType,
+            description="Number of account and employee RECORDNO lookups kept in memory. Defaults to 10000.",
+        ),
+        th.Property(
+            "log_payload_size",
+            th.IntegerType,
+            description="Number of characters of each request payload and response that are logged. 0 logs neither. Defaults to 10000.",
+        ),
+        th.Property(
+            "pool_size",
+            th.IntegerType,
+            description="Number of keep-alive connections kept open to the Intacct gateway. Defaults to 10.",
+        ),
+        th.Property(
+            "connect_timeout",
+            th.NumberType,
+            description="Seconds to wait for a connection to be established. Defaults to 10.",
+        ),
+        th.Property(
+            "request_timeout",
+            th.NumberType,
+            description="Seconds to wait for a response once connected. Defaults to 300.",
+        ),
+        th.Property(
+            "attachment_workers",
+            th.IntegerType,
+            description="Attachments of a record fetched at once. Defaults to 4.",
+        ),
+        th.Property(
+            "attachment_memory_budget_mb",
+            th.NumberType,
+            description="Megabytes of attachment content held in memory across the run before fetching more waits. Defaults to 256.",
+        ),
+        th.Property(
+            "attachment_pipeline",
+            th.IntegerType,
+            description="Records whose attachments are posted at once while the bills before them are written. Defaults to 0, posting a batch's attachments before its writes.",
+        ),
+        th.Property(
+            "attachment_index_path",
+            th.StringType,
+            description="Directory where the names and digests of the attachments posted to each supdoc are kept between runs.",
+        ),
+        th.Property(
+            "attachment_index_ttl",
+            th.NumberType,
+            description="Seconds an indexed supdoc stays valid. Defaults to 604800 (a week).",
+        ),
+        th.Property(
+            "requests_per_second",
+            th.NumberType,
+            description="Requests per second sent to the company, with bursts of up to requests_burst. Unlimited by default.",
+        ),
+        th.Property(
+            "requests_burst",
+            th.NumberType,
+            description="Requests that may be sent at once after an idle period. Defaults to requests_per_second.",
+        ),
+        th.Property(
+            "max_concurrent_requests",
+            th.IntegerType,
+            description="Most requests in flight to the company. Defaults to the largest of max_workers plus attachment_pipeline, page_workers and the number of reference objects prefetched at once (8).",
+        ),
+        th.Property(
+            "slow_request_seconds",
+            th.NumberType,
+            description="Responses slower than this lower the request concurrency like a 429 does. Defaults to 60.",
+        ),
+        th.Property(
+            "real_time_subprocess",
+            th.BooleanType,
+            description="Run real-time pushes in a target subprocess per invocation instead of in the Lambda's process.",
+        ),
+        th.Property(
+            "metrics_log_level",
+            th.StringType,
+            description="Level of the METRIC log lines, INFO, DEBUG or NONE. Defaults to INFO.",
+        ),
+        th.Property(
+            "metrics_path",
+            th.StringType,
+            description="Path of a json file the stage timings and request counts of the run are written to.",
+        ),
     ).to_dict()
     SINK_TYPES = [Suppliers, APAdjustments, JournalEntries, Bills, PurchaseInvoices, BillPayment, PurchaseOrders]
 
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # stage timers and request counters shared by all sinks, from the start of the run
+        level = str(self.config.get("metrics_log_level") or "INFO").upper()
+        level = {"INFO": logging.INFO, "DEBUG": logging.DEBUG}.get(level)
+        self.metrics = RunMetrics(self.logger if level else None, level or logging.INFO)
+        # request schedulers by company, see get_scheduler
+        self.schedulers = {}
+        self.schedulers_lock = threading.Lock()
+        # base64 attachment contents held in memory by all sinks
+        budget = float(self.config.get("attachment_memory_budget_mb") or 256)
+        self.attachment_budget = MemoryBudget(int(budget * 1024 * 1024))
+        # supdoc folders found or created in the run
+        self.supdoc_folders = set()
+        # attachments already posted to each supdoc, so they aren't downloaded to dedupe
+        index_path = self.config.get("attachment_index_path")
+        self.supdoc_index = SupdocIndex(
+            Path(index_path) / str(self.config.get("company_id")) if index_path else None,
+            ttl=float(self.config.get("attachment_index_ttl") or 604800),
+        )
+
+    @cached_property
+    def http_session(self) -> requests.Session:
+        """Return the pooled keep-alive session shared by all sinks."""
+        pool_size = int(self.config.get("pool_size") or 10)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_scheduler(self) -> RequestScheduler:
+        """Return the scheduler all requests to the configured company go through."""
+        company_id = self.config.get("company_id")
+        with self.schedulers_lock:
+            if company_id not in self.schedulers:
+                workers = max(
+                    int(self.config.get("max_workers") or 1) + int(self.config.get("attachment_pipeline") or 0),
+                    int(self.config.get("page_workers") or 1),
+                    # the reference objects of a batch are prefetched at once
+                    len(IntacctSink.reference_objects),
+                )
+                self.schedulers[company_id] = RequestScheduler(
+                    max_concurrency=self.config.get("max_concurrent_requests") or workers,
+                    rate=self.config.get("requests_per_second"),
+                    burst=self.config.get("requests_burst"),
+                    slow_seconds=float(self.config.get("slow_request_seconds") or 60),
+                )
+            return self.schedulers[company_id]
+
+    @cached_property
+    def sessions(self) -> dict:
+        """Return the open API sessions, keyed by (company, user, location) login."""
+        return {}
+
+    @property
+    def request_timeout(self) -> tuple:
+        """Return the (connect, read) timeout used for every request."""
+        return (
+            float(self.config.get("connect_timeout") or 10),
+            float(self.config.get("request_timeout") or 300),
+        )
+
+    def _process_endofpipe(self) -> None:
+        # write the records still buffered by batched sinks before the final state is emitted
+        for sink in self._sinks_to_clear + list(self._sinks_active.values()):
+            if sink:
+                sink.process_pending_records()
+        super()._process_endofpipe()
+        self.write_metrics()
+
+    def write_metrics(self) -> None:
+        """Log the totals of the run as METRIC lines and write them to metrics_path."""
+        self.metrics.emit_summary()
+        if self.config.get("metrics_path"):
+            with open(self.config["metrics_path"], "w") as metrics_file:
+                json.dump(self.metrics.summary(), metrics_file, indent=2)
+
 
 if __name__ == "__main__":
     TargetIntacctV3.cli()
@@ -0,0 +1,60 @@
+"""Fixtures running the target against the benchmark gateway."""
+
+import io
+import json
+
+import pytest
+
+from benchmarks.gateway import MockGateway
+from benchmarks.streams import seed_reference_data, singer_messages
+from target_intacct_v3.client import IntacctSink
+from target_intacct_v3.target import TargetIntacctV3
+
+
+@pytest.fixture
+def gateway():
+    """A gateway seeded with the reference objects, the class level reference state is cleared after."""
+    gateway = MockGateway().start()
+    seed_reference_data(gateway.state)
+    try:
+        yield gateway
+    finally:
+        gateway.stop()
+        IntacctSink.set_reference_state()
+
+
+@pytest.fixture
+def config(gateway, tmp_path):
+    return {
+        "company_id": "company",
+        "sender_id": "sender",
+        "sender_password": "password",
+        "user_id": "user",
+        "user_password": "password",
+        "input_path": str(tmp_path),
+        "base_url": gateway.url,
+    }
+
+
+@pytest.fixture
+def run_target(config):
+    """Return a function reading singer messages into a new target with config and options."""
+
+    def run_target(messages=(), **options):
+        target = TargetIntacctV3(config={**config, **options})
+        target._process_lines(io.StringIO("".join(json.dumps(message) + "\n" for message in messages)))
+        return target
+
+    return run_target
+
+
+@pytest.fixture
+def make_sink(run_target):
+    """Return a function creating the sink of a stream in a new target with options."""
+
+    def make_sink(stream="Bills", **options):
+        schema, *_ = singer_messages(stream, 1, seed=1)
+        return run_target([schema], **options)._sinks_active[stream]
+
+    return make_sink
+
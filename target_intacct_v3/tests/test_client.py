@@ -0,0 +1,235 @@
+"""Tests the requests of the sinks against the benchmark gateway."""
+
+import datetime as dt
+import json
+import threading
+import time
+
+import pytest
+import xmltodict
+
+from benchmarks.streams import singer_messages
+from target_intacct_v3.client import IntacctSink
+
+
+def test_same_supdoc_is_checked_and_posted_twice(gateway, make_sink):
+    """Identical supdoc checks and posts are sent again instead of failing as duplicates."""
+    sink = make_sink("Bills")
+    assert sink.get_existing_attachments("SUP1", "F1") == ({"names": [], "digests": []}, False)
+    assert sink.get_existing_attachments("SUP1", "F1") == ({"names": [], "digests": []}, False)
+
+    base = gateway.url.rsplit("/ia/", 1)[0]
+    attachments = [{"name": "receipt.pdf", "url": f"{base}/attachments/receipt?size=100"}]
+    for _ in range(2):
+        assert sink.post_attachments(attachments, "REC-1") == "REC1"
+        assert gateway.state.supdocs["REC1"]["attachments"]["attachment"]["attachmentname"] == "receipt.pdf"
+        # forget the supdoc on both ends so the same requests are sent again
+        gateway.state.supdocs.clear()
+        gateway.state.folders.clear()
+        sink._target.supdoc_index.discard("REC1")
+        sink._target.supdoc_folders.clear()
+
+
+def test_same_request_gets_a_new_controlid(gateway, make_sink):
+    """Sending the same xml again, as a refresh or a retry does, isn't rejected as a duplicate."""
+    sink = make_sink("Bills")
+    first = sink.get_controlid(b"<function><get></get></function>")
+    second = sink.get_controlid(b"<function><get></get></function>")
+    assert first != second and len(first) == len(second) == 32
+    sink.load_reference("VENDOR")
+    sink.refresh_reference("VENDOR")
+    sink.refresh_reference("VENDOR")
+
+
+def test_prefetch_loads_reference_objects_concurrently(gateway, make_sink):
+    """With the default config the reference objects of a batch are still loaded at once."""
+    sink = make_sink("Bills")
+    sink.login()
+    gateway.latency = 0.05
+    scheduler = sink._target.get_scheduler()
+    in_flight = []
+    acquire = scheduler.acquire
+
+    def track_acquire():
+        granted = acquire()
+        in_flight.append(scheduler.in_flight)
+        return granted
+
+    scheduler.acquire = track_acquire
+    _, *messages = singer_messages("Bills", 5, seed=1)
+    sink.prefetch_references([message["record"] for message in messages])
+    assert IntacctSink.vendors and IntacctSink.locations
+    assert max(in_flight) > 1
+
+
+def test_failed_attachment_fetch_releases_memory(gateway, make_sink):
+    """Attachments fetched before another one raises don't stay counted in the budget."""
+    sink = make_sink("Bills")
+    fetch_attachment = sink.fetch_attachment
+
+    def fail_on_bad(attachment, hold=None):
+        if attachment["name"] == "bad.pdf":
+            raise KeyError("url")
+        return fetch_attachment(attachment, hold)
+
+    sink.fetch_attachment = fail_on_bad
+    base = gateway.url.rsplit("/ia/", 1)[0]
+    attachments = [
+        {"name": "good.pdf", "url": f"{base}/attachments/receipt?size=3000"},
+        {"name": "bad.pdf", "url": f"{base}/attachments/receipt?size=3000"},
+    ]
+    with pytest.raises(KeyError):
+        sink.post_attachments(attachments, "REC-2")
+    budget = sink._target.attachment_budget
+    assert budget.used == 0 and budget.holders == 0
+
+
+def test_refresh_merges_modified_rows_once_per_interval(gateway, make_sink):
+    """A miss merges the rows modified since the load into new maps, later misses reuse that refresh."""
+    sink = make_sink("Bills")
+    sink.load_reference("VENDOR")
+    loaded = IntacctSink.vendors
+    gateway.state.add("VENDOR", {"VENDORID": "V-NEW", "NAME": "New Vendor"})
+    sent = len(gateway.requests)
+    assert sink.get_reference("vendors", "New Vendor") == "V-NEW"
+    assert sink.has_reference_value("vendors", "V-NEW")
+    assert "New Vendor" not in loaded and len(IntacctSink.vendors) == len(loaded) + 1
+    assert len(gateway.requests) == sent + 1
+    assert sink.get_reference("vendors", "Another Vendor") is None
+    assert len(gateway.requests) == sent + 1
+
+
+def test_skipped_key_and_refresh_io_leave_lookups_alone(gateway, make_sink):
+    """Keys skipped when missing don't refresh, and a refresh doesn't block reference_lock."""
+    sink = make_sink("Bills")
+    sink.load_reference("CLASS")
+    sent = len(gateway.requests)
+    assert sink.get_reference("classes", "Unknown Class", refresh=False) is None
+    assert len(gateway.requests) == sent
+
+    gateway.latency = 0.3
+    refresh = threading.Thread(target=sink.refresh_reference, args=("CLASS",))
+    refresh.start()
+    time.sleep(0.1)
+    started = time.monotonic()
+    with IntacctSink.reference_lock:
+        waited = time.monotonic() - started
+    refresh.join()
+    assert waited < 0.1
+
+
+def test_sinks_share_a_session_refreshed_before_expiry(gateway, run_target):
+    """Streams with the same login reuse one session, which is renewed ahead of its timeout."""
+    target = run_target([next(singer_messages(stream, 1, seed=1)) for stream in ("Bills", "Suppliers")])
+    query = {"readByQuery": {"object": "VENDOR", "fields": "RECORDNO", "query": "RECORDNO = 1"}}
+    for stream in ("Bills", "Suppliers", "Bills"):
+        target._sinks_active[stream].request_api("POST", request_data=query)
+    logins = lambda: sum(request["functions"] == ["getAPISession"] for request in gateway.requests)
+    assert logins() == 1 and len(target.sessions) == 1
+
+    sink = target._sinks_active["Bills"]
+    session = target.sessions[sink.session_key]
+    session["session_timeout"] = dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=sink.session_refresh_margin - 5)
+    sink.request_api("POST", request_data=query)
+    assert logins() == 2 and target.sessions[sink.session_key]["session_id"] != session["session_id"]
+
+
+def test_concurrent_pages_are_yielded_once_in_order(gateway, make_sink):
+    """Pages fetched page_workers at a time give every row once, in the order of the object."""
+    sink = make_sink("Bills", page_size=30, page_workers=4)
+    gateway.jitter = 0.02
+    offsets = []
+    get_page = sink.get_page
+    sink.get_page = lambda intacct_object, *args: offsets.append(args[3]) or get_page(intacct_object, *args)
+    records = sink.iter_records("VENDOR", ["RECORDNO"])
+    first = next(records)
+    assert offsets == [0]
+    rows = [first, *records]
+    assert [row["RECORDNO"] for row in rows] == [row["RECORDNO"] for row in gateway.state.tables["VENDOR"]]
+    assert sorted(offsets) == list(range(0, 200, 30))
+
+
+def test_reference_cache_is_reused_until_stale(gateway, make_sink, tmp_path):
+    """A reference object cached on disk is loaded without queries until its ttl runs out."""
+    options = {"reference_cache_path": str(tmp_path / "cache"), "reference_load_mode": "full"}
+    make_sink("Bills", **options).load_reference("VENDOR")
+    path = tmp_path / "cache" / "company" / "VENDOR.json"
+    assert path.exists()
+
+    IntacctSink.set_reference_state()
+    sent = len(gateway.requests)
+    make_sink("Bills", **options).load_reference("VENDOR")
+    assert len(gateway.requests) == sent and len(IntacctSink.vendors) == 200
+
+    cache = json.loads(path.read_text())
+    path.write_text(json.dumps(dict(cache, synced_at=cache["synced_at"] - 61)))
+    IntacctSink.set_reference_state()
+    make_sink("Bills", reference_cache_ttl=60, **options).load_reference("VENDOR")
+    assert len(gateway.requests) > sent and len(IntacctSink.vendors) == 200
+    assert json.loads(path.read_text())["synced_at"] > cache["synced_at"]
+
+
+def test_recordno_lookups_are_prefetched_and_evicted(gateway, make_sink):
+    """A batch's RECORDNOs are read with `in` queries, the least recently used are dropped past the cache size."""
+    sink = make_sink("Bills", lookup_cache_size=150)
+    sink.login()
+    sent = len(gateway.requests)
+    sink.prefetch_by_recordno("account_nos", [str(i) for i in range(1, 201)] + ["1", None])
+    assert len(gateway.requests) == sent + 2
+    cache = IntacctSink.point_lookup_caches["account_nos"]
+    assert len(cache) == 150 and "50" not in cache and "51" in cache
+
+    sent = len(gateway.requests)
+    assert sink.get_account_no_by_account_id(51) == "6050"
+    assert sink.get_account_no_by_account_id(200) == "6199"
+    assert len(gateway.requests) == sent
+    assert sink.get_account_no_by_account_id(1) == "6000"
+    assert len(gateway.requests) == sent + 1
+    # 51 was used since the prefetch, so the next oldest made room for 1
+    assert "51" in cache and "52" not in cache
+
+
+def test_each_response_is_parsed_once(gateway, make_sink, monkeypatch):
+    """A response is parsed once for its status, its errors and the results handed back."""
+    sink = make_sink("Bills")
+    sink.login()
+    parse = xmltodict.parse
+    parsed = []
+
+    def count_responses(xml, *args, **kwargs):
+        # the gateway parses the requests in the same process
+        if b"<response>" in xml:
+            parsed.append(xml)
+        return parse(xml, *args, **kwargs)
+
+    monkeypatch.setattr(xmltodict, "parse", count_responses)
+    response = sink.request_api("POST", request_data={"query": {"object": "VENDOR", "select": {"field": ["NAME"]}, "pagesize": 5}})
+    assert len(response["data"]["VENDOR"]) == 5
+    results = sink.request_api_batch("POST", {"a": {"get": {"@object": "VENDOR", "@key": "1"}}, "b": {"get": {"@object": "VENDOR", "@key": "2"}}})
+    assert set(results) == {"a", "b"}
+    assert len(parsed) == 2
+
+
+def test_attachments_are_deduped_against_the_supdoc_index(gateway, make_sink):
+    """Indexed supdocs aren't downloaded, attachments are skipped by name or, with an id, by content."""
+    sink = make_sink("Bills")
+    base = gateway.url.rsplit("/ia/", 1)[0]
+    receipt = {"name": "receipt.pdf", "url": f"{base}/attachments/receipt?size=100"}
+    scan = {"id": "7", "name": "scan.pdf", "url": f"{base}/attachments/scan?size=300"}
+    assert sink.post_attachments([receipt, scan], "REC-3") == "REC3"
+    assert sink._target.supdoc_index.get("REC3")["names"] == ["receipt.pdf", "7_scan.pdf"]
+
+    sent = len(gateway.requests)
+    fetched = []
+    fetch_attachment = sink.fetch_attachment
+    sink.fetch_attachment = lambda attachment, hold=None: fetched.append(attachment["name"]) or fetch_attachment(attachment, hold)
+    rescan = dict(scan, id="8")
+    other = {"id": "9", "name": "other.pdf", "url": f"{base}/attachments/other?size=200"}
+    assert sink.post_attachments([receipt, rescan], "REC-3") is None
+    assert len(gateway.requests) == sent and fetched == ["scan.pdf"]
+
+    assert sink.post_attachments([receipt, rescan, other], "REC-3") == "REC3"
+    assert [name for request in gateway.requests[sent:] for name in request["functions"]] == ["update_supdoc"]
+    posted = gateway.state.supdocs["REC3"]["attachments"]["attachment"]
+    assert [attachment["attachmentname"] for attachment in posted] == ["receipt.pdf", "7_scan.pdf", "9_other.pdf"]
+    assert sink._target.supdoc_index.get("REC3")["names"] == ["receipt.pdf", "7_scan.pdf", "9_other.pdf"]
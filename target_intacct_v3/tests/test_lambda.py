@@ -0,0 +1,32 @@
+"""Tests the in-process real-time handler against the benchmark gateway."""
+
+import importlib
+import json
+import logging
+
+from benchmarks.streams import singer_messages
+
+real_time = importlib.import_module("target_intacct_v3.lambda")
+
+
+def test_warm_invocations_reuse_session_and_references(gateway, config):
+    """Only the first push of a config logs in and loads the reference objects."""
+    schema, *records = [json.dumps(message) for message in singer_messages("Bills", 2, seed=1)]
+    logger = logging.getLogger("test_lambda")
+    try:
+        results = []
+        for record in records:
+            gateway.requests.clear()
+            results.append(real_time.real_time_handler(config, "Bills", schema, record, logger))
+            results[-1]["functions"] = [name for request in gateway.requests for name in request["functions"]]
+
+        cold, warm = results
+        assert not cold["metrics"]["warm_start"] and warm["metrics"]["warm_start"]
+        assert [bookmark["success"] for bookmark in cold["state"]["bookmarks"]["Bills"]] == [True]
+        assert [bookmark["success"] for bookmark in warm["state"]["bookmarks"]["Bills"]] == [True]
+        assert "getAPISession" in cold["functions"] and "query" in cold["functions"]
+        assert "getAPISession" not in warm["functions"]
+        assert warm["functions"].count("query") < cold["functions"].count("query")
+        assert not warm["metrics"]["tracebackInLogs"]
+    finally:
+        real_time.warm_states.clear()
@@ -0,0 +1,53 @@
+"""Tests the run metrics."""
+
+import json
+import logging
+from unittest import mock
+
+from target_intacct_v3.metrics import RunMetrics
+
+
+def test_summary_and_metric_lines(caplog):
+    """Timers and counters are totalled per stream and logged as METRIC lines."""
+    caplog.set_level(logging.INFO, logger="test_metrics")
+    metrics = RunMetrics(logging.getLogger("test_metrics"))
+    metrics.add_time("Bills", "network", 0.5)
+    metrics.add_time("Bills", "network", 1.5)
+    with metrics.timer("Bills", "serialize"):
+        pass
+    metrics.count("Bills", "function_count", function="create")
+    metrics.count("Bills", "function_count", value=2, function="create")
+    metrics.count("Bills", "http_request_count", http_status_code=None)
+    metrics.count("Bills", "http_request_count", http_status_code=200)
+
+    bills = metrics.summary()["streams"]["Bills"]
+    assert bills["stages"]["network"] == {"count": 2, "seconds": 2.0, "max_seconds": 1.5}
+    assert bills["stages"]["serialize"]["count"] == 1
+    assert bills["function_count"] == {"function=create": 3}
+
+    metrics.emit_summary()
+    lines = caplog.messages
+    assert lines and all(line.startswith("METRIC: ") for line in lines)
+    points = [json.loads(line[len("METRIC: "):]) for line in lines]
+    assert {"type": "timer", "metric": "stage_duration", "value": 2.0, "tags": {"stream": "Bills", "stage": "network", "count": 2, "max": 1.5}} in points
+    assert {"type": "counter", "metric": "function_count", "value": 3, "tags": {"stream": "Bills", "function": "create"}} in points
+
+
+def test_disabled_log():
+    """No lines are logged without a log function."""
+    metrics = RunMetrics()
+    metrics.add_time("Bills", "network", 0.5)
+    metrics.emit_summary()
+    assert metrics.summary()["streams"]["Bills"]["stages"]["network"]["count"] == 1
+
+
+def test_metric_lines_below_the_level_are_not_built():
+    """Metrics aren't serialized when their level isn't enabled."""
+    logger = logging.getLogger("test_metrics_debug")
+    logger.setLevel(logging.INFO)
+    metrics = RunMetrics(logger, logging.DEBUG)
+    metrics.count("Bills", "function_count", function="create")
+    with mock.patch("target_intacct_v3.metrics.json.dumps") as dumps:
+        metrics.emit_summary()
+        metrics.emit("timer", "http_request_duration", 0.1, {"stream": "Bills"})
+    assert not metrics.enabled and not dumps.called
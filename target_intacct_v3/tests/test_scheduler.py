@@ -0,0 +1,47 @@
+"""Tests the request scheduler."""
+
+import threading
+import time
+
+from target_intacct_v3.scheduler import RequestScheduler
+
+
+def test_limit_halves_once_per_congestion_and_grows_back():
+    """Concurrent failures lower the limit once, healthy responses raise it again."""
+    scheduler = RequestScheduler(max_concurrency=8, slow_seconds=5)
+    started = [scheduler.acquire() for _ in range(3)]
+    assert scheduler.release(started[0], 429)
+    assert scheduler.limit == 4
+    # sent before the decrease, so they saw the old limit
+    assert not scheduler.release(started[1], 503)
+    assert not scheduler.release(started[2], None)
+    assert scheduler.limit == 4
+
+    assert scheduler.release(scheduler.acquire(), 200, seconds=10)
+    assert scheduler.limit == 2
+    for _ in range(40):
+        scheduler.release(scheduler.acquire(), 200, seconds=0.1)
+    assert scheduler.limit == 8
+
+
+def test_acquire_waits_for_a_slot():
+    """No more than limit requests are in flight."""
+    scheduler = RequestScheduler(max_concurrency=1)
+    started = scheduler.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (scheduler.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.05)
+    scheduler.release(started, 200)
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_token_bucket_rate():
+    """Requests past the burst are sent at rate per second."""
+    scheduler = RequestScheduler(max_concurrency=4, rate=50, burst=2)
+    begin = time.monotonic()
+    for _ in range(7):
+        scheduler.release(scheduler.acquire(), 200)
+    # 2 from the burst, then 5 at 50 per second
+    assert time.monotonic() - begin >= 0.09
@@ -0,0 +1,55 @@
+"""Tests the request serializer against xmltodict."""
+
+import xmltodict
+
+from target_intacct_v3.serializer import RequestEnvelope, unparse
+
+CONTENT = {
+    "function": [
+        {
+            "@controlid": "a\"'<&>",
+            "create": {
+                "APBILL": {
+                    "RECORDID": "INV <1> & 'co'",
+                    "ACTION": None,
+                    "TOTAL": 10.5,
+                    "LINES": 3,
+                    "DRAFT": False,
+                    "APBILLITEMS": {"APBILLITEM": [{"ACCOUNTNO": "1000"}, {"ACCOUNTNO": "ünï\tcode"}]},
+                    "EMPTY": [],
+                    "TEXT": {"@attr": "tab\tnew\nline", "#text": "value", "CHILD": ""},
+                }
+            },
+        },
+        {"@controlid": "b", "getAPISession": None},
+    ]
+}
+
+
+def test_unparse_matches_xmltodict():
+    """Serialized documents are byte-identical to xmltodict's."""
+    document = {"request": {"operation": {"content": CONTENT}}}
+    assert unparse(document) == xmltodict.unparse(document).encode("utf-8")
+
+
+def test_envelope_matches_request_body():
+    """The pre-rendered envelope gives the same bytes as the full request body."""
+    request_body = {
+        "request": {
+            "control": {
+                "senderid": "sender&",
+                "password": "pass<word>",
+                "controlid": -1234,
+                "uniqueid": False,
+                "dtdversion": 3.0,
+                "includewhitespace": False,
+            },
+            "operation": {
+                "authentication": {"sessionid": "session\""},
+                "content": CONTENT,
+            },
+        }
+    }
+    envelope = RequestEnvelope("sender&", "pass<word>", "session\"")
+    content_xml = envelope.render_content(CONTENT)
+    assert envelope.render(-1234, content_xml) == xmltodict.unparse(request_body).encode("utf-8")
@@ -0,0 +1,168 @@
+"""Tests the buffered writes of the target against the benchmark gateway."""
+
+import io
+import json
+import time
+
+import pytest
+import requests
+from singer_sdk.exceptions import FatalAPIError
+
+from benchmarks.streams import singer_messages
+from target_intacct_v3.client import IntacctSink
+
+
+def test_drain_writes_buffer_of_retired_sink(gateway, run_target):
+    """A sink retired by a schema change writes its buffered records when drained mid-run."""
+    schema, *records = singer_messages("JournalEntries", 3, seed=1)
+    changed = dict(schema, key_properties=["type"])
+    target = run_target([schema, *records[:2], changed, records[2]], batch_size=10)
+    retired = target._sinks_to_clear[0]
+    assert len(retired.pending_records) == 2
+    target.drain_all()
+    assert retired.pending_records == []
+    assert target._sinks_active["JournalEntries"].pending_records == []
+    functions = [name for request in gateway.requests for name in request["functions"]]
+    assert functions.count("create") == 3
+
+
+def test_repeated_bill_key_is_updated(gateway, run_target):
+    """A bill created earlier in the same buffer is updated, as in serial mode."""
+    schema, _, first, second = singer_messages("Bills", 3, seed=1)
+    second["record"].update(invoiceNumber=first["record"]["invoiceNumber"], vendorName=first["record"]["vendorName"])
+    target = run_target([schema, first, second], batch_size=10)
+    target._process_endofpipe()
+    functions = [name for request in gateway.requests for name in request["functions"]]
+    assert [name for name in functions if name in ("create", "update")] == ["create", "update"]
+
+
+def test_read_timeout_is_retried_for_reads_only(make_sink, monkeypatch):
+    """A lookup that times out is sent again, a write that times out is not."""
+    sink = make_sink("Bills")
+    request = sink._target.http_session.request
+    sent = []
+
+    def time_out_once(method, url, data=None, **kwargs):
+        body = data or b""
+        function = "readByQuery" if b"<readByQuery" in body else "create" if b"<create" in body else None
+        if function:
+            sent.append(function)
+            if sent.count(function) == 1:
+                raise requests.exceptions.ReadTimeout("timed out")
+        return request(method, url, data=data, **kwargs)
+
+    monkeypatch.setattr(sink._target.http_session, "request", time_out_once)
+    sink.request_api("POST", request_data={"readByQuery": {"object": "VENDOR", "fields": "RECORDNO", "query": "RECORDNO = 1"}})
+    assert sent == ["readByQuery", "readByQuery"]
+    with pytest.raises(FatalAPIError):
+        sink.request_api("POST", request_data={"create": {"VENDOR": {"VENDORID": "V-TIMEOUT"}}})
+    assert sent.count("create") == 1
+
+
+def test_reference_load_after_count_reuses_first_page(make_sink):
+    """An object the auto mode loads whole isn't asked for its first page twice."""
+    sink = make_sink("Bills", page_size=50)
+    offsets = []
+    get_page = sink.get_page
+    sink.get_page = lambda intacct_object, *args: offsets.append(args[3]) or get_page(intacct_object, *args)
+    sink.prefetch_reference("VENDOR", {"NAME": {"Vendor 1"}})
+    assert sorted(offsets) == [0, 50, 100, 150]
+    assert len(IntacctSink.vendors) == 200
+    assert "VENDOR" not in IntacctSink.reference_targeted
+
+
+def test_targeted_reference_stays_targeted_until_loaded(make_sink):
+    """An object whose lookups run out of budget is still looked up by value while it's loaded whole."""
+    sink = make_sink("Bills", page_size=100, reference_targeted_min_count=1)
+    targeted_while_loading = []
+    load_reference_rows = sink.load_reference_rows
+
+    def record_targeted(intacct_object, *args):
+        targeted_while_loading.append(intacct_object in IntacctSink.reference_targeted)
+        load_reference_rows(intacct_object, *args)
+
+    sink.load_reference_rows = record_targeted
+    sink.prefetch_reference("VENDOR", {"NAME": {"Vendor 1"}})
+    assert len(IntacctSink.vendors) == 1
+    # two pages' worth of queries, the prefetch and this one
+    sink.lookup_reference_value("vendors", "Vendor 2")
+    assert targeted_while_loading == [True]
+    assert "VENDOR" not in IntacctSink.reference_targeted
+    assert len(IntacctSink.vendors) == 200
+
+
+@pytest.mark.parametrize("options", [{}, {"batch_size": 2, "max_workers": 2}])
+def test_record_urls_are_read_together(gateway, run_target, monkeypatch, options):
+    """Records written one by one or in batches get their record urls from one query per drain."""
+    request = requests.Session.request
+    url_queries = []
+
+    def count_url_queries(session, method, url, data=None, **kwargs):
+        if data and b"RECORD_URL" in data:
+            url_queries.append(data)
+        return request(session, method, url, data=data, **kwargs)
+
+    monkeypatch.setattr(requests.Session, "request", count_url_queries)
+    target = run_target(singer_messages("Bills", 3, seed=1), output_record_url=True, **options)
+    sink = target._sinks_active["Bills"]
+    assert url_queries == []
+    target.drain_all()
+    assert len(url_queries) == 1 and sink.deferred_record_urls == []
+    states = sink.latest_state["bookmarks"]["Bills"]
+    assert len(states) == 3
+    assert all(state["record_url"].endswith(f"/APBILL/{state['id']}") for state in states)
+
+
+def test_concurrent_writes_keep_the_order_of_a_key(gateway, run_target):
+    """With several workers, records with the same bill key are written in input order."""
+    gateway.jitter = 0.05
+    schema, *records = singer_messages("Bills", 8, seed=1)
+    repeated = records[1]["record"]
+    for day, message in enumerate(records[1::2], start=1):
+        message["record"].update(
+            invoiceNumber=repeated["invoiceNumber"], vendorName=repeated["vendorName"], dueDate=f"2024-04-0{day}"
+        )
+    target = run_target([schema, *records], max_workers=4)
+    target._process_endofpipe()
+    rows = [row for row in gateway.state.tables["APBILL"] if row.get("RECORDID") == repeated["invoiceNumber"]]
+    assert len(rows) == 1 and rows[0]["WHENDUE"] == "2024-04-04"
+    states = target._sinks_active["Bills"].latest_state["bookmarks"]["Bills"]
+    assert [state["success"] for state in states] == [True] * 8
+    assert {state["id"] for state in states[1::2]} == {rows[0]["RECORDNO"]}
+
+
+def test_pipelined_writes_keep_their_order_and_errors(gateway, run_target):
+    """Bills are sent as their attachments are posted, and failed builds or writes only fail their record."""
+    gateway.latency = 0.05
+    schema, *records = singer_messages("Bills", 6, seed=1, attachments=1, attachment_size=100, gateway_url=gateway.url)
+    target = run_target([schema], max_workers=2, attachment_pipeline=2)
+    sink = target._sinks_active["Bills"]
+    build_upsert_function = sink.build_upsert_function
+    failing = {records[2]["record"]["invoiceNumber"]: "build", records[4]["record"]["invoiceNumber"]: "write"}
+
+    def fail_some(record, state_updates):
+        failure = failing.get(record["payload"]["APBILL"].get("RECORDID"))
+        if failure == "build":
+            raise ValueError("bad attachment")
+        function = build_upsert_function(record, state_updates)
+        if failure == "write":
+            bill = next(iter(function.values()))["APBILL"]
+            return {"update": {"APBILL": dict(bill, RECORDNO="missing")}}
+        return function
+
+    sink.build_upsert_function = fail_some
+    post_attachments = sink.post_attachments
+    sink.post_attachments = lambda *args: time.sleep(0.1) or post_attachments(*args)
+    target._process_lines(io.StringIO("".join(json.dumps(message) + "\n" for message in records)))
+    target._process_endofpipe()
+
+    states = sink.latest_state["bookmarks"]["Bills"]
+    assert [state["success"] for state in states] == [True, True, False, True, False, True]
+    assert "bad attachment" in states[2]["error"] and "not found" in states[4]["error"]
+    functions = [request["functions"] for request in gateway.requests]
+    supdocs = [i for i, names in enumerate(functions) if "create_supdoc" in names]
+    bills = [i for i, names in enumerate(functions) if names in (["create"], ["update"])]
+    assert len(supdocs) == 5 and len(bills) == 5
+    # each bill waits for its own supdoc only, the next ones of the buffer are posted while it's written
+    assert all(supdoc < bill for supdoc, bill in zip(supdocs, bills))
+    assert supdocs[2] > bills[0]
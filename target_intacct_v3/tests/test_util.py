@@ -0,0 +1,149 @@
+"""Tests the helpers in util."""
+
+import base64
+import copy
+import hashlib
+import json
+import pickle
+import threading
+
+import pytest
+
+from target_intacct_v3.serializer import RequestEnvelope
+from target_intacct_v3.util import (
+    MemoryBudget,
+    ReferenceIndex,
+    SupdocIndex,
+    encode_base64,
+    iter_path_values,
+    summarize,
+)
+
+
+def test_iter_path_values():
+    """Values are read from records and from the lines of lists or their json."""
+    record = {
+        "vendorName": "Acme",
+        "supplierId": 12,
+        "lineItems": json.dumps([{"className": "A"}, {"className": None}, {}]),
+        "expenses": [{"className": "B"}, {"className": ""}],
+    }
+    assert list(iter_path_values(record, "vendorName")) == ["Acme"]
+    assert list(iter_path_values(record, "supplierId")) == ["12"]
+    assert list(iter_path_values(record, "lineItems.className")) == ["A"]
+    assert list(iter_path_values(record, "expenses.className")) == ["B"]
+    assert list(iter_path_values(record, "missing.className")) == []
+
+
+def test_reference_index_counts_values():
+    """Value counts follow every change to the items, and copies count their own."""
+    index = ReferenceIndex([{"NAME": "Acme", "ID": "V1"}, {"NAME": "Acme Inc", "ID": "V1"}], "NAME", "ID")
+    assert index.count_value("V1") == 2
+    index.update({"Acme": "V2"}, Other="V3")
+    index |= {"Last": "V4"}
+    assert index.setdefault("Acme", "V9") == "V2"
+    assert index.setdefault("New", "V5") == "V5"
+    del index["Acme Inc"]
+    index.pop("Other")
+    index.pop("missing", None)
+    assert dict(index.value_counts) == {"V2": 1, "V4": 1, "V5": 1}
+    for clone in (index.copy(), copy.copy(index), copy.deepcopy(index), pickle.loads(pickle.dumps(index))):
+        assert isinstance(clone, ReferenceIndex)
+        assert clone == index and clone.value_counts == index.value_counts
+    key, value = index.popitem()
+    assert not index.has_value(value)
+    index.clear()
+    assert not index.value_counts
+
+
+def test_encode_base64_in_chunks():
+    """Chunks of any size encode to the base64 of the whole content."""
+    content = bytes(range(256)) * 41
+    for size in (1, 2, 3, 64, 1000, len(content)):
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        digest = hashlib.sha256()
+        assert encode_base64(chunks, digest) == base64.b64encode(content).decode()
+        assert digest.hexdigest() == hashlib.sha256(content).hexdigest()
+    assert encode_base64([]) == ""
+
+
+def test_encode_base64_counts_budget():
+    """Encoded bytes are added to the hold as they're produced, and released on failure."""
+    budget = MemoryBudget(1024)
+    with budget.hold() as hold:
+        assert len(encode_base64([b"abcd", b"ef", b"g"], hold=hold)) == budget.used == 12
+
+        def failing():
+            yield b"abcdef"
+            raise OSError("connection reset")
+
+        with pytest.raises(OSError):
+            encode_base64(failing(), hold=hold)
+        assert hold.used == 12
+    assert budget.used == 0 and budget.holders == 0
+
+
+def wait_in_thread(func):
+    """Run func on a thread, returning the thread and an event set once func returns."""
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (func(), done.set()), daemon=True)
+    thread.start()
+    return thread, done
+
+
+def test_memory_budget_is_a_hard_limit():
+    """Holding past the limit waits, unless the caller holds everything or all holders wait."""
+    budget = MemoryBudget(100)
+    first, second = budget.hold(), budget.hold()
+    first.reserve(60)
+    # used up reservations then wait for the budget like new ones
+    thread, done = wait_in_thread(lambda: second.add(50))
+    assert not done.wait(0.1)
+    first.close()
+    assert done.wait(1)
+    thread.join()
+
+    # alone in the budget, a hold goes past the limit
+    second.add(200)
+    assert budget.used == 250
+    second.close()
+    assert budget.used == 0 and budget.holders == 0
+
+    # holders waiting on each other don't wait forever
+    first.reserve(60)
+    second.reserve(30)
+    thread, done = wait_in_thread(lambda: first.add(80))
+    assert not done.wait(0.1)
+    second.add(50)
+    assert budget.used == 110
+    second.close()
+    assert done.wait(1)
+    thread.join()
+    first.trim()
+    assert budget.used == first.held == 80
+    first.close()
+    assert budget.used == 0 and budget.holders == 0
+
+
+def test_supdoc_index(tmp_path):
+    """Indexed supdocs are read back by later runs until they expire or are discarded."""
+    index = SupdocIndex(tmp_path, ttl=60)
+    assert index.get("INV/1") is None
+    index.set("INV/1", ["a.pdf"], ["abc"])
+    assert SupdocIndex(tmp_path, ttl=60).get("INV/1") == {"names": ["a.pdf"], "digests": ["abc"]}
+    assert SupdocIndex(tmp_path, ttl=-1).get("INV/1") is None
+    index.discard("INV/1")
+    assert SupdocIndex(tmp_path, ttl=60).get("INV/1") is None
+    index.discard("INV/1")
+
+
+def test_summarize_is_one_line_without_passwords():
+    """A logged request fits one line and shows no password, even one the cut goes through."""
+    envelope = RequestEnvelope("sender", "s3cret<1>", "session")
+    request = envelope.render("1", b"<login><password>us3r</password></login>")
+    text = summarize(request, 1000)
+    assert "\n" not in text and "s3cret" not in text and "us3r" not in text
+    assert "<password>***</password>" in text
+    cut = summarize(request, request.index(b"s3cret") + 3)
+    assert "s3c" not in cut and cut.endswith("<password>***... (truncated)")
+    assert "secret" not in summarize({"user_password": "secret", "size": 1}, 1000)
@@ -1,6 +1,19 @@
 import ast
+import binascii
 import datetime as dt
 import json
+import os
+import re
+import reprlib
+import tempfile
+import threading
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from pathlib import Path
+from urllib.parse import quote
+
+# bump when the shape of the cached reference rows changes
+REFERENCE_CACHE_VERSION = 1
 
 
 def parse_objs(record):
@@ -13,11 +26,107 @@ def parse_objs(record):
             return record
 
 
-def dictify(array, key, value):
-    array_ = {}
-    for i in array:
-        array_[i[key]] = i[value]
-    return array_
+def iter_path_values(record, path):
+    """Yield the non-empty values at path in record as strings.
+
+    "lineItems.className" yields the className of each of the lineItems,
+    whether they are a list or its json.
+    """
+    key, _, rest = path.partition(".")
+    value = record.get(key) if isinstance(record, dict) else None
+    if rest:
+        value = parse_objs(value) if isinstance(value, str) else value
+        for item in value if isinstance(value, list) else [value]:
+            yield from iter_path_values(item, rest)
+    elif value is not None and value != "":
+        yield str(value)
+
+
+class ReferenceIndex(dict):
+    """Map of reference keys to values that also counts its values.
+
+    Reverse membership and value multiplicity are O(1) instead of a scan
+    over values(). Every dict method that changes items keeps the counts
+    in sync, and copies or pickles count their own.
+    """
+
+    def __init__(self, rows=(), key=None, value=None):
+        super().__init__()
+        self.value_counts = Counter()
+        for row in rows:
+            self[row[key]] = row[value]
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._discount(self[key])
+        super().__setitem__(key, value)
+        self.value_counts[value] += 1
+
+    def __delitem__(self, key):
+        value = self[key]
+        super().__delitem__(key)
+        self._discount(value)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._discount(self[key])
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._discount(value)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self.value_counts.clear()
+
+    def copy(self):
+        return ReferenceIndex(self.items(), 0, 1)
+
+    def __reduce__(self):
+        # rebuilt from its items, as copy and pickle would otherwise count them twice
+        return ReferenceIndex, (list(self.items()), 0, 1)
+
+    def _discount(self, value):
+        self.value_counts[value] -= 1
+        if not self.value_counts[value]:
+            del self.value_counts[value]
+
+    def has_value(self, value):
+        return value in self.value_counts
+
+    def count_value(self, value):
+        return self.value_counts.get(value, 0)
+
+
+def parse_intacct_datetime(value):
+    """Parse an Intacct MM/DD/YYYY HH:MM:SS timestamp, returning None if it can't be parsed."""
+    try:
+        return dt.datetime.strptime(value, "%m/%d/%Y %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_after(response):
+    """Return the seconds of a response's Retry-After header, or None."""
+    try:
+        return float(response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
 
 
 def clean_convert(input):
@@ -50,3 +159,322 @@ def convert_date(date):
     else:
         date = ""
     return date
+
+
+def read_reference_cache(path, version, ttl):
+    """Return the rows cached at path, or None if missing, expired or of another version."""
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != version:
+        return None
+    if dt.datetime.now(dt.timezone.utc).timestamp() - cache.get("synced_at", 0) > ttl:
+        return None
+    return cache.get("rows")
+
+
+def write_reference_cache(path, version, rows):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    cache = {
+        "version": version,
+        "synced_at": dt.datetime.now(dt.timezone.utc).timestamp(),
+        "rows": rows,
+    }
+    # write to a temp file first so concurrent runs never read a partial cache
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, delete=False) as cache_file:
+        json.dump(cache, cache_file, separators=(",", ":"))
+    os.replace(cache_file.name, path)
+
+
+class LRUCache:
+    """Thread-safe map that keeps only the maxsize most recently used keys."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+class ControlIdRegistry:
+    """Thread-safe set of the last maxsize control ids sent."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.ids = set()
+        self.order = deque()
+        self.lock = threading.Lock()
+
+    def __contains__(self, controlid):
+        with self.lock:
+            return controlid in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def register(self, controlid) -> bool:
+        """Add controlid, returning False if it was already registered."""
+        with self.lock:
+            if controlid in self.ids:
+                return False
+            self.ids.add(controlid)
+            self.order.append(controlid)
+            if len(self.order) > self.maxsize:
+                self.ids.discard(self.order.popleft())
+            return True
+
+
+class SummaryRepr(reprlib.Repr):
+    """Bounded repr that keeps the order of dict keys."""
+
+    def repr_dict(self, x, level):
+        if not x:
+            return "{}"
+        if level <= 0:
+            return "{...}"
+        pieces = [
+            f"{self.repr1(key, level - 1)}: {self.repr1(value, level - 1)}"
+            for key, value in islice(x.items(), self.maxdict)
+        ]
+        if len(x) > self.maxdict:
+            pieces.append("...")
+        return "{" + ", ".join(pieces) + "}"
+
+
+# bounded repr for parsed responses, so large pages aren't fully formatted
+summary_repr = SummaryRepr()
+summary_repr.maxlevel = 10
+summary_repr.maxdict = summary_repr.maxlist = 100
+summary_repr.maxstring = summary_repr.maxother = 1000
+
+
+# the password elements of a request and password items of a dict, or what's
+# left of them before the cut
+SECRET_PATTERNS = [
+    (re.compile(r"<(\w*password)>[^<]*(?:</\w*password>|$)", re.IGNORECASE), r"<\1>***</\1>"),
+    (re.compile(r"""(['"]\w*password['"]: )(['"])(?:(?!\2).)*\2?""", re.IGNORECASE), r"\1'***'"),
+]
+
+
+def summarize(value, size):
+    """Return value as one line of text for logging, cut to size characters.
+
+    Whitespace runs are collapsed and passwords are redacted.
+    """
+    if isinstance(value, bytes):
+        length = len(value)
+        text = value[:size].decode("utf-8", "ignore")
+    else:
+        text = summary_repr.repr(value)
+        length = len(text)
+    text = " ".join(text.split())
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    if length > size:
+        return f"{text[:size]}... (truncated)"
+    return text
+
+
+def encode_base64(chunks, digest=None, hold=None) -> str:
+    """Base64-encode an iterable of byte chunks, holding only one raw chunk at a time.
+
+    digest, a hashlib object, is updated with the raw content when given.
+    hold, a MemoryHold, is added the encoded bytes as they're produced, and
+    they're released if the chunks fail.
+    """
+    encoded = bytearray()
+    carry = b""
+    try:
+        for chunk in chunks:
+            if digest is not None:
+                digest.update(chunk)
+            if carry:
+                chunk = carry + chunk
+            # encode whole 3-byte groups so the pieces concatenate to the full encoding
+            cut = len(chunk) - len(chunk) % 3
+            piece = binascii.b2a_base64(chunk[:cut], newline=False)
+            if hold is not None:
+                hold.add(len(piece))
+            encoded += piece
+            carry = chunk[cut:]
+        piece = binascii.b2a_base64(carry, newline=False)
+        if hold is not None:
+            hold.add(len(piece))
+        encoded += piece
+    except BaseException:
+        if hold is not None:
+            hold.release(len(encoded))
+        raise
+    return encoded.decode("ascii")
+
+
+class MemoryBudget:
+    """Thread-safe count of the bytes held in memory against a limit.
+
+    Bytes are held through a MemoryHold, see hold. Holding more waits until
+    the bytes fit under the limit. It doesn't wait when the caller holds
+    everything counted, so a single large record still goes through. A
+    holder also goes on when every holder is waiting, as none of them would
+    release anything. Releasing never waits.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        # callers holding bytes, and how many of them wait for more
+        self.holders = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def hold(self) -> "MemoryHold":
+        return MemoryHold(self)
+
+    def acquire(self, size, held=0) -> None:
+        """Wait for size more bytes to fit and count them, held being what the caller already holds."""
+        with self.condition:
+            if held:
+                self.waiting += 1
+            try:
+                while (
+                    self.used > held
+                    and self.used + size > self.limit
+                    and not (held and self.waiting >= self.holders)
+                ):
+                    self.condition.wait()
+            finally:
+                if held:
+                    self.waiting -= 1
+            self.used += size
+            if size and not held:
+                self.holders += 1
+
+    def release(self, size, held=0) -> None:
+        """Stop counting size bytes, held being what the caller still holds after."""
+        with self.condition:
+            self.used -= size
+            if size and not held:
+                self.holders -= 1
+            self.condition.notify_all()
+
+
+class MemoryHold:
+    """The bytes one caller holds in a MemoryBudget, all released on close.
+
+    reserve holds bytes ahead of use, and add uses them up before holding
+    more. Both wait for the bytes to fit in the budget. release gives used
+    bytes back to the hold and trim returns the unused ones to the budget.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.held = 0
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def grow(self, size) -> None:
+        if size > 0:
+            self.budget.acquire(size, self.held)
+            self.held += size
+
+    def reserve(self, size) -> None:
+        with self.lock:
+            self.grow(self.used + size - self.held)
+
+    def add(self, size) -> None:
+        with self.lock:
+            self.grow(self.used + size - self.held)
+            self.used += size
+
+    def release(self, size) -> None:
+        with self.lock:
+            self.used -= size
+
+    def trim(self) -> None:
+        with self.lock:
+            if self.held > self.used:
+                self.budget.release(self.held - self.used, self.used)
+                self.held = self.used
+
+    def close(self) -> None:
+        with self.lock:
+            if self.held:
+                self.budget.release(self.held)
+            self.held = self.used = 0
+
+
+class SupdocIndex:
+    """Names and sha256 digests of the attachments posted to each supdoc.
+
+    Entries are kept in memory and, when path is set, in a json file per
+    supdoc so later runs don't download the existing attachments again.
+    Files older than ttl seconds are ignored.
+    """
+
+    version = "supdoc:1"
+
+    def __init__(self, path=None, ttl=None):
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def file(self, supdoc_id) -> Path:
+        return self.path / f"{quote(str(supdoc_id), safe='')}.json"
+
+    def get(self, supdoc_id):
+        """Return the {"names", "digests"} of a supdoc, or None if it isn't indexed."""
+        with self.lock:
+            if supdoc_id in self.entries:
+                return self.entries[supdoc_id]
+        if not self.path:
+            return None
+        entry = read_reference_cache(self.file(supdoc_id), self.version, self.ttl)
+        if entry is not None:
+            with self.lock:
+                self.entries[supdoc_id] = entry
+        return entry
+
+    def set(self, supdoc_id, names, digests) -> None:
+        entry = {"names": list(names), "digests": list(digests)}
+        with self.lock:
+            self.entries[supdoc_id] = entry
+        if self.path:
+            write_reference_cache(self.file(supdoc_id), self.version, entry)
+
+    def discard(self, supdoc_id) -> None:
+        with self.lock:
+            self.entries.pop(supdoc_id, None)
+        if self.path:
+            try:
+                os.remove(self.file(supdoc_id))
+            except FileNotFoundError:
+                pass